@@ -15,13 +15,16 @@ SECRET_KEY = os.environ.get('SECRET_KEY', 'a_secret_key_for_dev')
 DATABASE_URI = 'sqlite:///milky_shaky.db' # SQLite DB file
 MAX_DRINKS = 10  # configurable limit
 
-def create_app():
+def create_app(test_config=None):
     app = Flask(__name__)
     
     # Configure App
     app.config['SECRET_KEY'] = SECRET_KEY
     app.config['SQLALCHEMY_DATABASE_URI'] = DATABASE_URI
     app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+    # Overrides for tests/tools, e.g. db_snapshot.template_app_config()
+    if test_config:
+        app.config.update(test_config)
 
     # Initialize extensions with the app
     db.init_app(app)
@@ -29,6 +32,22 @@ def create_app():
     bcrypt.init_app(app)
     login_manager.login_view = 'login' # Set the view function for login
 
+    # Read-only engine/session for admin reports (see reporting.py)
+    from reporting import init_reporting, report_session, reporting_view
+    init_reporting(app)
+    # In-process dashboard counters, seeded after the tables exist (see live_kpis.py)
+    from live_kpis import init_live_kpis, live_kpis
+    # Token-bucket limits and load shedding for hot endpoints (see rate_limit.py)
+    from rate_limit import init_rate_limits, rate_limited
+    init_rate_limits(app)
+    # Per-request query counting and N+1 detection for development/tests (see query_budget.py)
+    from query_budget import init_query_budget
+    init_query_budget(app)
+
+    # Registered after the query budget so its hooks run inside the budget's (see profiler.py)
+    from profiler import init_profiler, profiler
+    init_profiler(app)
+
     # Provide a lightweight "moment" for templates (supports format('YYYY') etc.)
     class _SimpleMoment:
         def __init__(self, dt):
@@ -78,6 +97,7 @@ def create_app():
         return render_template('base.html', title='Welcome')
 
     @app.route('/login', methods=['GET', 'POST'])
+    @rate_limited('login')
     def login():
         if current_user.is_authenticated:
             return redirect(url_for('index'))
@@ -93,7 +113,8 @@ def create_app():
                 # Audit log: successful login
                 try:
                     audit = AuditLog(action='Login Success', actor=user.username or user.email,
-                                     details=json.dumps({'user_id': user.id, 'ip': request.remote_addr}))
+                                     details=json.dumps({'user_id': user.id, 'ip': request.remote_addr}),
+                                     entity_type='user', entity_id=user.id, user_id=user.id, ip=request.remote_addr)
                     db.session.add(audit)
                     db.session.commit()
                 except Exception:
@@ -104,13 +125,19 @@ def create_app():
 
             # Audit log: failed login attempt
             try:
+                # user is set when the email exists and only the password was wrong
                 audit = AuditLog(action='Login Failed', actor=form.email.data,
-                                 details=json.dumps({'reason': 'invalid credentials', 'ip': request.remote_addr}))
+                                 details=json.dumps({'reason': 'invalid credentials', 'ip': request.remote_addr}),
+                                 entity_type='user' if user else None, entity_id=user.id if user else None,
+                                 user_id=user.id if user else None, ip=request.remote_addr)
                 db.session.add(audit)
                 db.session.commit()
             except Exception:
                 db.session.rollback()
 
+            # only failures spend this address's tokens for the email tried
+            from rate_limit import record_failure
+            record_failure('login')
             flash('Invalid email or password.', 'error')
         return render_template('login.html', title='Login', form=form)
 
@@ -148,7 +175,8 @@ def create_app():
             # Audit log: user created
             try:
                 audit = AuditLog(action='User Registered', actor=saved.username or saved.email,
-                                 details=json.dumps({'user_id': saved.id, 'email': saved.email, 'ip': request.remote_addr}))
+                                 details=json.dumps({'user_id': saved.id, 'email': saved.email, 'ip': request.remote_addr}),
+                                 entity_type='user', entity_id=saved.id, user_id=saved.id, ip=request.remote_addr)
                 db.session.add(audit)
                 db.session.commit()
             except Exception:
@@ -171,7 +199,9 @@ def create_app():
         # Audit log: explicit logout
         try:
             audit = AuditLog(action='Logout', actor=getattr(current_user, 'username', str(current_user.get_id())),
-                             details=json.dumps({'user_id': int(current_user.get_id()), 'ip': request.remote_addr}))
+                             details=json.dumps({'user_id': int(current_user.get_id()), 'ip': request.remote_addr}),
+                             entity_type='user', entity_id=int(current_user.get_id()),
+                             user_id=int(current_user.get_id()), ip=request.remote_addr)
             db.session.add(audit)
             db.session.commit()
         except Exception:
@@ -183,6 +213,7 @@ def create_app():
 
     @app.route('/order', methods=['GET', 'POST'])
     @login_required
+    @rate_limited('order')
     def order():
         from forms import OrderForm
         from models import Order, AuditLog, User, Product, Config
@@ -229,6 +260,13 @@ def create_app():
             print("Client IP:", request.remote_addr)
 
         if form.validate_on_submit():
+            # A double-tapped or retried submission replays the first one (see idempotency.py)
+            from idempotency import request_key, lookup, remember
+            from sqlalchemy.exc import IntegrityError
+            idem_key = request_key(form.idempotency_key.data)
+            if lookup(db.session, 'order', int(current_user.get_id()), idem_key):
+                flash('Order created. Status: Pending Payment', 'success')
+                return redirect(url_for('orders'))
             try:
                 # number validation
                 n = int(form.number_of_milkshakes.data)
@@ -264,7 +302,9 @@ def create_app():
                 # Compute totals server-side. Prefer model helper if present.
                 user = db.session.get(User, int(current_user.get_id()))
                 if hasattr(Order, 'compute_totals_for_items'):
-                    valid, errors, subtotal, vat, discount, total, items_with_prices = Order.compute_totals_for_items(items, user=user)
+                    # Priced from the database, not this worker's cache: another worker may have just changed the catalog
+                    valid, errors, subtotal, vat, discount, total, items_with_prices = Order.compute_totals_for_items(
+                        items, user=user, lookup_cache=Order._get_lookup_cache(fresh=True))
                     if not valid:
                         flash('Order data invalid: ' + '; '.join(errors), 'error')
                         return render_template('order.html', form=form)
@@ -305,13 +345,27 @@ def create_app():
                 order.status = 'Pending Payment'
 
                 db.session.add(order)
-                db.session.commit()
+                if idem_key:
+                    # the key is stored in the same transaction as the order
+                    db.session.flush()
+                    remember(db.session, 'order', order.user_id, idem_key, {'order_id': order.id})
+                try:
+                    db.session.commit()
+                except IntegrityError:
+                    # a concurrent duplicate committed first: keep its order, write nothing
+                    db.session.rollback()
+                    if lookup(db.session, 'order', int(current_user.get_id()), idem_key):
+                        flash('Order created. Status: Pending Payment', 'success')
+                        return redirect(url_for('orders'))
+                    raise
                 print(f"Saved order id={order.id} user_id={order.user_id} total={getattr(order,'total',None)}")
+                live_kpis().record_order_created(order.created_at)
 
                 # audit log entry
                 try:
                     audit = AuditLog(action='Order Created', actor=getattr(current_user, 'username', str(current_user.get_id())),
-                                     details=json.dumps({'order_id': order.id, 'total': getattr(order,'total',None)}))
+                                     details=json.dumps({'order_id': order.id, 'total': getattr(order,'total',None)}),
+                                     entity_type='order', entity_id=order.id, user_id=order.user_id, ip=request.remote_addr)
                     db.session.add(audit)
                     db.session.commit()
                 except Exception:
@@ -332,23 +386,69 @@ def create_app():
             print("Form validation failed. errors:", form.errors)
             flash('Form validation failed: ' + str(form.errors), 'error')
 
-        return render_template('order.html', form=form, lookup_data=lookup_data)
+        # Pre-select the best-selling combination (read from the sales counters)
+        from popularity import popular_pick
+        return render_template('order.html', form=form, lookup_data=lookup_data,
+                               popular_pick=popular_pick(db.session))
 
     # --- My Orders & Order Detail ---
     @app.route('/orders')
     @login_required
     def orders():
-        from models import Order
-        # show all orders for current user, newest first
+        from order_history import order_history_page
+        # first page of the current user's orders, newest first; more via /orders/more
         user_id = int(current_user.get_id())
-        orders = db.session.query(Order).filter(Order.user_id == user_id).order_by(Order.created_at.desc()).all()
-        return render_template('orders.html', orders=orders)
+        orders, next_cursor = order_history_page(user_id, request.args.get('cursor'))
+        return render_template('orders.html', orders=orders, next_cursor=next_cursor)
+
+    @app.route('/orders/more')
+    @login_required
+    def orders_more():
+        from flask import jsonify
+        from order_history import order_history_page
+        user_id = int(current_user.get_id())
+        rows, next_cursor = order_history_page(user_id, request.args.get('cursor'))
+        return jsonify({
+            'orders': [{
+                'id': o.id,
+                'created_at': o.created_at.strftime('%Y-%m-%d %H:%M') if o.created_at else None,
+                'status': o.status,
+                'pickup_time': o.pickup_time.strftime('%Y-%m-%d %H:%M') if o.pickup_time else None,
+                'location': o.location,
+                'total': round(o.total or 0, 2),
+                'detail_url': url_for('order_detail', order_id=o.id),
+            } for o in rows],
+            'next_cursor': next_cursor,
+        })
+
+    # Server-side pricing for the order page and partners: {"items": [...]} or {"carts": [[...], ...]}
+    @app.route('/api/quote', methods=['POST'])
+    @rate_limited('quote')
+    def api_quote():
+        from flask import jsonify
+        from models import Order
+        from pricing import quote_cart, quote_carts, QuoteError
+        payload = request.get_json(silent=True)
+        if not isinstance(payload, dict) or ('items' in payload) == ('carts' in payload):
+            return jsonify({'error': 'send either "items" (one cart) or "carts" (a list of carts)'}), 400
+        # One catalog snapshot (cached in memory) and one loyalty lookup per request
+        catalog = Order._get_lookup_cache()
+        completed = current_user.completed_orders_count() if current_user.is_authenticated else None
+        try:
+            if 'items' in payload:
+                quote = quote_cart(payload['items'], catalog, completed)
+                return jsonify({**quote, 'vat_rate': catalog['vat_rate']})
+            quotes = quote_carts(payload['carts'], catalog, completed)
+            return jsonify({'quotes': quotes, 'vat_rate': catalog['vat_rate']})
+        except QuoteError as e:
+            return jsonify({'error': str(e)}), 400
 
     @app.route('/orders/<int:order_id>')
     @login_required
     def order_detail(order_id):
-        from models import Order
-        order = db.session.get(Order, order_id)
+        from archive import get_order
+        # falls back to the archive for old, completed orders
+        order = get_order(order_id)
         if not order or str(order.user_id) != str(current_user.get_id()):
             flash('Order not found or access denied.', 'error')
             return redirect(url_for('orders'))
@@ -358,8 +458,9 @@ def create_app():
     @app.route('/orders/<int:order_id>/receipt')
     @login_required
     def order_receipt(order_id):
-        from models import Order
-        order = db.session.get(Order, order_id)
+        from archive import get_order
+        # falls back to the archive for old, completed orders
+        order = get_order(order_id)
         if not order or str(order.user_id) != str(current_user.get_id()):
             flash('Order not found or access denied.', 'error')
             return redirect(url_for('orders'))
@@ -398,70 +499,173 @@ def create_app():
         if not order or int(order.user_id) != int(current_user.get_id()):
             flash('Order not found or access denied.', 'error')
             return redirect(url_for('orders'))
+
         if getattr(order, 'status', '').lower() != 'pending payment':
             flash('Order is not pending payment.', 'info')
             return redirect(url_for('order_detail', order_id=order_id))
 
+        # A double-tapped or retried "Pay Now" gets the payment session it already created.
+        # Keys are scoped to the order, and only a session that is still open is replayed.
+        from idempotency import request_key, lookup, remember, forget
+        from sqlalchemy.exc import IntegrityError
+        idem_key = request_key(form.idempotency_key.data)
+        idem_scope = f'payment:{order.id}'
+
+        def open_session(replay):
+            payment = db.session.get(Payment, replay['payment_id']) if replay else None
+            if payment and payment.order_id == order.id and payment.status == 'Pending':
+                return payment
+            return None
+
+        replay = lookup(db.session, idem_scope, order.user_id, idem_key)
+        payment = open_session(replay)
+        if payment:
+            return render_template('payment_simulator.html', payment=payment, order=order)
+        if replay:
+            # the earlier session failed or was closed: the key starts a new one
+            forget(db.session, idem_scope, order.user_id, idem_key)
+
         # create a Payment record in DB with a provider_ref token that simulates a gateway session
         provider_ref = secrets.token_urlsafe(24)
         payment = Payment(order_id=order.id, amount=getattr(order, 'total', 0.0),
                           provider='simulated_gateway', provider_ref=provider_ref, status='Pending')
         db.session.add(payment)
-        db.session.commit()
+        if idem_key:
+            db.session.flush()
+            remember(db.session, idem_scope, order.user_id, idem_key, {'payment_id': payment.id})
+        try:
+            db.session.commit()
+        except IntegrityError:
+            # a concurrent duplicate committed first: show its session, not a second one
+            db.session.rollback()
+            payment = open_session(lookup(db.session, idem_scope, order.user_id, idem_key))
+            if not payment:
+                raise
+            return render_template('payment_simulator.html', payment=payment, order=order)
+        # Register the session with an external (simulated) gateway, which calls the webhook itself
+        if app.config.get('PAYMENT_GATEWAY_URL'):
+            import urllib.request
+            try:
+                req = urllib.request.Request(app.config['PAYMENT_GATEWAY_URL'].rstrip('/') + '/sessions',
+                                             data=json.dumps({'provider_ref': provider_ref, 'amount': payment.amount,
+                                                              'order_id': order.id}).encode(),
+                                             headers={'Content-Type': 'application/json'}, method='POST')
+                urllib.request.urlopen(req, timeout=5).close()
+            except Exception as e:
+                print('Payment gateway session error:', e)
         return render_template('payment_simulator.html', payment=payment, order=order)
 
     # Webhook / callback endpoint (simulated). This would be called by the payment provider.
     @app.route('/payments/webhook', methods=['POST'])
+    @rate_limited('payments_webhook')
     def payments_webhook():
-        from models import Payment, Order, AuditLog
-        import json
+        from payment_events import apply_payment_event, PAYMENT_TRANSITIONS, RETRY_AFTER_SECONDS
         # Expect JSON payload: { provider_ref: "...", status: "Success" | "Failed", provider_ref_info: "..." }
-        payload = request.get_json(silent=True) or {}
+        payload = request.get_json(silent=True)
+        if not isinstance(payload, dict):
+            payload = {}
         pr = payload.get('provider_ref')
         new_status = payload.get('status')
         if not pr or not new_status:
             return ('missing provider_ref or status', 400)
-        payment = db.session.query(Payment).filter_by(provider_ref=pr).first()
-        if not payment:
-            return ('payment not found', 404)
         # Accept only certain statuses
-        if new_status not in ('Success', 'Failed'):
+        if new_status not in PAYMENT_TRANSITIONS:
             return ('invalid status', 400)
         try:
-            payment.status = new_status
-            db.session.add(payment)
-            # update order status on success
-            order = db.session.get(Order, payment.order_id)
-            if new_status == 'Success' and order:
-                order.status = 'Confirmed'
-                db.session.add(order)
-                # create audit log
-                audit = AuditLog(action='Payment Received', actor='system', details=json.dumps({'order_id': order.id, 'payment_id': payment.id, 'amount': payment.amount}))
-                db.session.add(audit)
-                # simulate sending receipt email (replace with real mailer later)
-                user_email = getattr(order.user, 'email', None) if hasattr(order, 'user') else None
-                print(f"[SIMULATED EMAIL] To: {user_email} - Subject: Payment receipt for Order {order.id} - Amount: R{payment.amount}")
-            db.session.commit()
-            return ('ok', 200)
+            # compare-and-set on the payment/order versions, so webhooks can run in parallel
+            result = apply_payment_event(db.session, pr, new_status, ip=request.remote_addr)
         except Exception as e:
             db.session.rollback()
             print('Webhook processing error:', e)
             return ('error', 500)
+        headers = {'X-Webhook-Outcome': result['outcome'], 'X-Webhook-Attempts': str(result['attempts'])}
+        if result['outcome'] == 'not_found':
+            return ('payment not found', 404, headers)
+        if result['outcome'] == 'conflict':
+            # every attempt lost a race on this payment; the gateway redelivers
+            headers['Retry-After'] = str(RETRY_AFTER_SECONDS)
+            return ('busy, retry later', 503, headers)
+        if result['outcome'] == 'applied':
+            if new_status == 'Success' and result['order_id'] is not None:
+                # simulate sending receipt email (replace with real mailer later)
+                print(f"[SIMULATED EMAIL] To: {result['user_email']} - Subject: Payment receipt for Order {result['order_id']} - Amount: R{result['amount']}")
+                # counted like its 'Payment Received' audit, which is what the counters are seeded from
+                live_kpis().record_payment_confirmed(result['amount'], order_confirmed=result['newly_confirmed'])
+        # duplicates and superseded events are acknowledged so the gateway stops redelivering them
+        return ('ok', 200, headers)
         
     # ADDED: Manager Dashboard/Lookup List
     @app.route('/admin')
     @login_required
     @manager_required
+    @reporting_view
     def admin_dashboard():
-        from models import Product, Config
-        # Fetch all lookup data
-        products = db.session.query(Product).order_by(Product.type, Product.name).all()
-        configs = db.session.query(Config).all()
-        
-        # Merge for unified display
-        lookup_items = products + configs
-        
-        return render_template('admin_dashboard.html', items=lookup_items)
+        from projections import lookup_items as lookup_rows
+        report_db = report_session()
+        # Fetch all lookup data (products then configs) as plain (id, name, type, value) rows
+        lookup_items = lookup_rows(report_db)
+
+        from forms import RepriceForm
+        return render_template('admin_dashboard.html', items=lookup_items, reprice_form=RepriceForm())
+
+    # Live dashboard KPIs, served from in-memory counters (polled by admin_dashboard.html)
+    @app.route('/admin/kpis.json')
+    @login_required
+    @manager_required
+    def admin_kpis():
+        from flask import jsonify
+        kpis = live_kpis()
+        try:
+            # counters are per worker; re-read the database now and then so workers agree
+            kpis.reseed_if_stale(db.session)
+        except Exception as e:
+            db.session.rollback()
+            print('Live KPI reseed failed; serving the in-memory counters:', e)
+        return jsonify(kpis.snapshot())
+
+    # Limiter state for monitoring: configured limits, in-flight requests, allow/limit/shed counts
+    @app.route('/admin/rate-limits.json')
+    @login_required
+    @manager_required
+    def admin_rate_limits():
+        from flask import jsonify
+        return jsonify(app.extensions['rate_limiter'].state())
+
+    # Re-price orders awaiting payment after a catalog change (see repricing.py)
+    @app.route('/admin/reprice', methods=['POST'])
+    @login_required
+    @manager_required
+    def admin_reprice():
+        from forms import RepriceForm
+        from models import AuditLog
+        from repricing import reprice_pending_orders
+
+        form = RepriceForm()
+        if not form.validate_on_submit():
+            flash('Reprice form validation failed.', 'error')
+            return redirect(url_for('admin_dashboard'))
+
+        try:
+            report = reprice_pending_orders(dry_run=form.dry_run.data)
+        except Exception as e:
+            db.session.rollback()
+            flash(f'Error repricing orders: {e}', 'error')
+            return redirect(url_for('admin_dashboard'))
+
+        if not report['dry_run']:
+            try:
+                audit = AuditLog(action='Orders Repriced', actor=getattr(current_user, 'username', str(current_user.get_id())),
+                                 details=json.dumps({k: report[k] for k in ('scanned', 'changed', 'invalid', 'total_delta')}))
+                db.session.add(audit)
+                db.session.commit()
+            except Exception:
+                db.session.rollback()
+
+        prefix = 'Preview: ' if report['dry_run'] else ''
+        flash(f"{prefix}{report['changed']} of {report['scanned']} pending orders "
+              f"{'would change' if report['dry_run'] else 'repriced'} (net R{report['total_delta']:.2f}); "
+              f"{report['invalid']} contain items no longer on the menu.", 'success')
+        return redirect(url_for('admin_dashboard'))
     
 # ADDED: Create/Edit Lookup Item (Product or Config)
     @app.route('/admin/lookup/edit', methods=['GET', 'POST'])
@@ -469,7 +673,7 @@ def create_app():
     @login_required
     @manager_required
     def admin_lookup_edit(item_id=None):
-        from models import Product, Config
+        from models import Product, Config, invalidate_lookup_cache
         from forms import LookupForm
         
         item = None
@@ -513,6 +717,7 @@ def create_app():
                     db.session.add(item)
 
                 db.session.commit()
+                invalidate_lookup_cache()
                 flash(f'Item "{item.name}" saved successfully.', 'success')
                 return redirect(url_for('admin_dashboard'))
 
@@ -530,17 +735,176 @@ def create_app():
 
         return render_template('admin_lookup_edit.html', form=form, item=item)
     
+    # Bulk catalog export/import (see catalog_io.py)
+    @app.route('/admin/catalog/export.<fmt>')
+    @login_required
+    @manager_required
+    def admin_catalog_export(fmt):
+        from flask import Response, stream_with_context
+        from catalog_io import export_csv, export_json
+        if fmt not in ('csv', 'json'):
+            return ('unsupported export format', 404)
+        generator = export_csv if fmt == 'csv' else export_json
+        mimetype = 'text/csv' if fmt == 'csv' else 'application/json'
+        filename = f"milky_shaky_catalog_{datetime.utcnow().strftime('%Y%m%d')}.{fmt}"
+        # Streamed straight from the reporting session; the catalog is never built in memory
+        return Response(stream_with_context(generator(report_session())), mimetype=mimetype,
+                        headers={'Content-Disposition': f'attachment; filename={filename}'})
+
+    @app.route('/admin/catalog/import', methods=['GET', 'POST'])
+    @login_required
+    @manager_required
+    def admin_catalog_import():
+        from forms import CatalogImportForm
+        from models import AuditLog
+        from catalog_io import import_catalog, summarize, CatalogImportError
+
+        form = CatalogImportForm()
+        changes = None
+        errors = []
+        if form.validate_on_submit():
+            upload = form.file.data
+            try:
+                changes = import_catalog(upload.read(), upload.filename, dry_run=form.preview.data,
+                                         remove_missing=form.remove_missing.data)
+            except CatalogImportError as e:
+                errors = e.errors
+                flash(f'Import rejected: {len(errors)} problem(s) found. Nothing was changed.', 'error')
+            except Exception as e:
+                db.session.rollback()
+                flash(f'Error importing catalog: {e}', 'error')
+            else:
+                counts = summarize(changes)
+                if form.preview.data:
+                    flash('Preview only: no changes were saved.', 'info')
+                else:
+                    try:
+                        audit = AuditLog(action='Catalog Imported', actor=getattr(current_user, 'username', str(current_user.get_id())),
+                                         details=json.dumps({'file': upload.filename, **counts}))
+                        db.session.add(audit)
+                        db.session.commit()
+                    except Exception:
+                        db.session.rollback()
+                    flash(f"Catalog imported: {counts['product_inserts'] + counts['config_inserts']} added, "
+                          f"{counts['product_updates'] + counts['config_updates']} updated, "
+                          f"{counts['product_deletes']} removed, {counts['unchanged']} unchanged.", 'success')
+                    return redirect(url_for('admin_dashboard'))
+
+        return render_template('admin_catalog_import.html', form=form, changes=changes, errors=errors)
+
+    # Full-text search over orders, customers and audit logs (see search.py)
+    @app.route('/admin/search')
+    @login_required
+    @manager_required
+    @reporting_view
+    def admin_search():
+        from flask import jsonify
+        from search import search, SCOPES
+
+        q = (request.args.get('q') or '').strip()
+        scope = request.args.get('scope', 'orders')
+        if scope not in SCOPES:
+            scope = 'orders'
+        try:
+            page = max(1, int(request.args.get('page', 1)))
+        except ValueError:
+            page = 1
+
+        results, has_more = [], False
+        if q and app.config.get('SEARCH_ENABLED'):
+            results, has_more = search(report_session(), scope, q, page=page)
+
+        if request.args.get('format') == 'json':
+            return jsonify({'q': q, 'scope': scope, 'page': page, 'has_more': has_more,
+                            'results': [{k: str(v) if isinstance(v, datetime) else v for k, v in r.items()}
+                                        for r in results]})
+        return render_template('admin_search.html', q=q, scope=scope, scopes=SCOPES, page=page,
+                               results=results, has_more=has_more,
+                               search_enabled=app.config.get('SEARCH_ENABLED', False))
+
+    # Everything audited against one order, in order (see projections.entity_timeline)
+    @app.route('/admin/orders/<int:order_id>/timeline')
+    @login_required
+    @manager_required
+    @reporting_view
+    def admin_order_timeline(order_id):
+        from archive import get_order
+        from projections import entity_timeline
+        report_db = report_session()
+        order = get_order(order_id, session=report_db)
+        events = entity_timeline(report_db, 'order', order_id)
+        if not order and not events:
+            flash('Order not found.', 'error')
+            return redirect(url_for('admin_reports'))
+        return render_template('admin_order_timeline.html', order=order, order_id=order_id, events=events)
+
+    # Sampled request profiles (slowest per endpoint) and the runtime switch
+    @app.route('/admin/profiles')
+    @login_required
+    @manager_required
+    def admin_profiles():
+        from forms import ProfilerSettingsForm
+        settings = profiler().settings()
+        form = ProfilerSettingsForm(data=settings)
+        return render_template('admin_profiles.html', form=form, settings=settings, captures=profiler().captures(),
+                               keep=profiler().keep)
+
+    @app.route('/admin/profiles/settings', methods=['POST'])
+    @login_required
+    @manager_required
+    def admin_profiles_settings():
+        from forms import ProfilerSettingsForm
+        from models import AuditLog
+        form = ProfilerSettingsForm()
+        if not form.validate_on_submit():
+            flash('Profiler settings invalid: ' + str(form.errors), 'error')
+            return redirect(url_for('admin_profiles'))
+        settings = profiler().update(form.enabled.data, form.sample_rate.data)
+        try:
+            audit = AuditLog(action='Profiler Settings Changed', actor=getattr(current_user, 'username', str(current_user.get_id())),
+                             details=json.dumps(settings), user_id=int(current_user.get_id()), ip=request.remote_addr)
+            db.session.add(audit)
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+        flash(f"Profiling {'on' if settings['enabled'] else 'off'} at a sample rate of {settings['sample_rate']:g}.", 'success')
+        return redirect(url_for('admin_profiles'))
+
+    @app.route('/admin/profiles/<route_name>/<name>')
+    @login_required
+    @manager_required
+    def admin_profile_view(route_name, name):
+        meta, stats = profiler().report(route_name, name)
+        if meta is None:
+            flash('Capture not found (it may have been replaced by a slower one).', 'error')
+            return redirect(url_for('admin_profiles'))
+        return render_template('admin_profile_view.html', capture=meta, stats=stats)
+
+    @app.route('/admin/profiles/<route_name>/<name>.prof')
+    @login_required
+    @manager_required
+    def admin_profile_download(route_name, name):
+        from flask import send_file
+        path = profiler().path(route_name, name, '.prof')
+        if path is None:
+            flash('Capture not found (it may have been replaced by a slower one).', 'error')
+            return redirect(url_for('admin_profiles'))
+        return send_file(path, as_attachment=True, download_name=f'{route_name}-{name}.prof',
+                         mimetype='application/octet-stream')
+
     # Management Reports Dashboard
     @app.route('/admin/reports')
     @login_required
     @manager_required
+    @reporting_view
     def admin_reports():
         from models import Order, AuditLog
         from datetime import date, timedelta
         
         # --- Filtering Logic (Simplified for initial implementation) ---
-        from extensions import db
         from sqlalchemy import func
+        # Long analytical reads go through the read-only reporting session
+        report_db = report_session()
 
         # Determine date range from query parameters
         today = date.today()
@@ -563,53 +927,58 @@ def create_app():
 
         # --- Data Fetching ---
         
-        # 1. Fetch Orders within the date range
-        orders = db.session.query(Order).filter(
-            Order.created_at >= start_date,
-            Order.created_at < end_date
-        ).order_by(Order.created_at.desc()).all()
+        # 1. Fetch Orders within the date range (displayed columns and first drink only, see projections.py)
+        # When streaming, the order and audit tables are generators read while the page is sent
+        from projections import count_report_orders, iter_report_orders, iter_report_audit_logs
+        streaming = app.config['REPORTS_STREAMING']
+        orders = iter_report_orders(report_db, start_date, end_date)
+        total_orders = count_report_orders(report_db, start_date, end_date)
         
-        # 2. Fetch Audit Logs within the date range
-        audit_logs = db.session.query(AuditLog).filter(
-            AuditLog.created_at >= start_date,
-            AuditLog.created_at < end_date
-        ).order_by(AuditLog.created_at.desc()).all()
+        # 2. Fetch Audit Logs within the date range (optionally one IP address / action, e.g. failed logins)
+        audit_ip = request.args.get('audit_ip') or None
+        audit_action = request.args.get('audit_action') or None
+        audit_logs = iter_report_audit_logs(report_db, start_date, end_date, ip=audit_ip, action=audit_action)
+        if not streaming:
+            orders, audit_logs = list(orders), list(audit_logs)
 
         # 2. Trends Aggregation (Orders grouped by time periods)
         
         # a. Weekly Orders (Group by day of the week)
+        # Trends count archived orders as well (see archive.py)
+        from archive import orders_union
+        in_range = orders_union('id', 'created_at', start=start_date, end=end_date).c
         # SQLite's strftime('%w', ...) returns 0=Sun, 1=Mon, ..., 6=Sat.
-        weekly_orders_q = db.session.query(
-            func.count(Order.id),
-            func.strftime('%w', Order.created_at)
-        ).filter(
-            Order.created_at >= start_date,
-            Order.created_at < end_date
+        weekly_orders_q = report_db.query(
+            func.count(in_range.id),
+            func.strftime('%w', in_range.created_at)
         ).group_by(
-            func.strftime('%w', Order.created_at)
+            func.strftime('%w', in_range.created_at)
         ).all()
         
         # b. Monthly Orders (Group by month number 01-12)
-        monthly_orders_q = db.session.query(
-            func.count(Order.id),
-            func.strftime('%m', Order.created_at)
-        ).filter(
-            Order.created_at >= start_date,
-            Order.created_at < end_date
+        monthly_orders_q = report_db.query(
+            func.count(in_range.id),
+            func.strftime('%m', in_range.created_at)
         ).group_by(
-            func.strftime('%m', Order.created_at)
+            func.strftime('%m', in_range.created_at)
         ).all()
         
         # c. Yearly Growth (Group by year YYYY)
-        yearly_growth_q = db.session.query(
-            func.count(Order.id),
-            func.strftime('%Y', Order.created_at)
+        all_time = orders_union('id', 'created_at').c
+        yearly_growth_q = report_db.query(
+            func.count(all_time.id),
+            func.strftime('%Y', all_time.created_at)
         ).group_by(
-            func.strftime('%Y', Order.created_at)
+            func.strftime('%Y', all_time.created_at)
         ).order_by(
-            func.strftime('%Y', Order.created_at)
+            func.strftime('%Y', all_time.created_at)
         ).all()
 
+        # d. Best sellers (flavours, consistencies, toppings, combinations) from the sales counters
+        from popularity import rankings
+        top_sellers = rankings(report_db, start=start_date, end=end_date,
+                               location=request.args.get('location') or None)
+
         # --- FIX: Convert Query Results to Lists ---
         # Explicitly convert the list of SQLAlchemy Row/Result objects into lists of lists/tuples
         weekly_trends = [list(r) for r in weekly_orders_q]
@@ -617,34 +986,108 @@ def create_app():
         yearly_trends = [list(r) for r in yearly_growth_q]
         # -------------------------------------------
         
-        # Simplify order items for the table display (get the first item only)
-        for order in orders:
-            items = order.get_items()
-            if items:
-                order.first_item_flavour = items[0].get('flavour', 'N/A').title()
-                order.first_item_topping = items[0].get('topping', 'N/A').title()
-                order.first_item_thick = items[0].get('thick', 'N/A').title()
-            else:
-                order.first_item_flavour = 'Empty'
-                order.first_item_topping = 'Empty'
-                order.first_item_thick = 'Empty'
-                
         context = {
             'orders': orders,
             'audit_logs': audit_logs,
+            'audit_ip': audit_ip,
+            'audit_action': audit_action,
             'trends_data': {
                 'weekly': weekly_trends, # <-- Use converted list
                 'monthly': monthly_trends, # <-- Use converted list
                 'yearly': yearly_trends, # <-- Use converted list
             },
+            'top_sellers': top_sellers,
             'start_date_str': start_date_str,
             'end_date_str': end_date_str,
-            'total_orders': len(orders),
+            'total_orders': total_orders,
             'date_filter_applied': start_date_str != (today - timedelta(days=7)).strftime('%Y-%m-%d')
         }
         
+        if streaming:
+            from reporting import stream_report
+            return stream_report('admin_reports.html', **context)
         return render_template('admin_reports.html', **context)
 
+    # Customer cohorts by first-order month: repeat rate, AOV and monthly retention (see cohorts.py)
+    @app.route('/admin/reports/cohorts')
+    @login_required
+    @manager_required
+    @reporting_view
+    def admin_cohorts():
+        from datetime import date
+        from cohorts import cohort_report
+
+        def parse_month(value):
+            try:
+                return datetime.strptime(value, '%Y-%m').date()
+            except (TypeError, ValueError):
+                return None
+
+        today = date.today()
+        # Default: the last 12 cohorts, including this month
+        first = parse_month(request.args.get('start_month')) or date(today.year - 1, today.month, 1)
+        last = parse_month(request.args.get('end_month')) or date(today.year, today.month, 1)
+        if last < first:
+            first, last = last, first
+        end = date(last.year + last.month // 12, last.month % 12 + 1, 1)
+        report = cohort_report(report_session(), first, end)
+        return render_template('admin_cohorts.html', report=report,
+                               start_month=first.strftime('%Y-%m'), end_month=last.strftime('%Y-%m'))
+
+    # Kitchen prep board: confirmed orders due soon at one location (see kitchen.py)
+    @app.route('/kitchen')
+    @login_required
+    @manager_required
+    def kitchen_board():
+        from kitchen import board, locations, DEFAULT_WINDOW_MINUTES
+        all_locations = locations()
+        location = request.args.get('location') or (all_locations[0] if all_locations else '')
+        minutes = request.args.get('minutes', DEFAULT_WINDOW_MINUTES, type=int)
+        cards, cursor = board(location, minutes)
+        return render_template('kitchen_board.html', location=location, locations=all_locations,
+                               minutes=minutes, cards=cards, cursor=cursor, day=datetime.utcnow().date().isoformat())
+
+    # Polled by the board every few seconds: only cards changed since the cursor
+    @app.route('/kitchen/board.json')
+    @login_required
+    @manager_required
+    def kitchen_board_json():
+        from flask import jsonify
+        from kitchen import board, changes_since, parse_cursor, DEFAULT_WINDOW_MINUTES
+        location = request.args.get('location', '')
+        minutes = request.args.get('minutes', DEFAULT_WINDOW_MINUTES, type=int)
+        since = parse_cursor(request.args.get('cursor'))
+        if since is None:
+            cards, cursor = board(location, minutes)
+            return jsonify({'full': True, 'cards': cards, 'cursor': cursor})
+        cards, cursor = changes_since(location, since, minutes)
+        return jsonify({'full': False, 'cards': cards, 'cursor': cursor})
+
+    # Bulk kitchen transitions: {"order_ids": [...]} or {"location": ..., "day": "YYYY-MM-DD"}
+    @app.route('/kitchen/orders/<action>', methods=['POST'])
+    @login_required
+    @manager_required
+    def kitchen_transition(action):
+        from flask import jsonify
+        from kitchen import transition, TransitionError
+        payload = request.get_json(silent=True)
+        if not isinstance(payload, dict):
+            return jsonify({'error': 'expected a JSON object'}), 400
+        try:
+            day = datetime.strptime(payload['day'], '%Y-%m-%d').date() if payload.get('day') else None
+        except (TypeError, ValueError):
+            return jsonify({'error': 'day must be YYYY-MM-DD'}), 400
+        try:
+            result = transition(action, order_ids=payload.get('order_ids'), location=payload.get('location'), day=day,
+                                actor=getattr(current_user, 'username', str(current_user.get_id())),
+                                user_id=int(current_user.get_id()), ip=request.remote_addr)
+        except TransitionError as e:
+            return jsonify({'error': str(e)}), 400
+        except Exception as e:
+            print('Kitchen transition error:', e)
+            return jsonify({'error': 'could not update orders'}), 500
+        return jsonify(result)
+
     # --- Database Initialization ---
     with app.app_context():
         # Import models so SQLAlchemy knows about them
@@ -652,10 +1095,30 @@ def create_app():
         
         # Create database tables if they don't exist
         db.create_all()
+        # create_all() skips tables that already exist, so add any index declared
+        # on a model after its table was first created
+        from sqlalchemy.exc import OperationalError
+        for table in db.metadata.sorted_tables:
+            for index in table.indexes:
+                try:
+                    index.create(db.engine, checkfirst=True)
+                except OperationalError as e:
+                    # e.g. an index over a column that a migration script still has to add
+                    print(f"Could not create index {index.name}: {e.orig}. Run the scripts in migration_scripts/.")
         print("Database tables created or already exist.")
 
+    # FTS5 indexes for the admin search (see search.py)
+    from search import init_search
+    init_search(app)
+    init_live_kpis(app)
+    # Background expiry of abandoned payment sessions and unpaid orders (see sweeper.py)
+    from sweeper import init_sweeper
+    init_sweeper(app)
+
     return app
 
 if __name__ == '__main__':
-    app = create_app()
+    # debug=True turns on the reloader: this script runs once as the file watcher and
+    # again as the serving child (WERKZEUG_RUN_MAIN set); only the child runs the sweeper
+    app = create_app({'SWEEPER_ENABLED': os.environ.get('WERKZEUG_RUN_MAIN') == 'true'})
     app.run(host='0.0.0.0', debug=True)
\ No newline at end of file
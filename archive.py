@@ -0,0 +1,131 @@
+import heapq
+import json
+import sys
+import time
+from datetime import datetime, timedelta
+
+from sqlalchemy import delete, func, insert, select, union_all
+
+from extensions import db
+
+# --- Archive Defaults (override through app.config) ---
+ARCHIVE_DEFAULTS = {
+    'ARCHIVE_AFTER_MONTHS': 6,     # completed orders older than this move to the archive
+    'ARCHIVE_CHUNK_SIZE': 500,
+}
+# Short pause between chunks so request writers get the lock in between
+CHUNK_PAUSE_SECONDS = 0.05
+
+
+def _columns(table):
+    return [c.name for c in table.columns]
+
+
+def archive_orders(session=None, now=None, months=None, chunk_size=None):
+    """Moves completed orders older than the cutoff, and their payments, to the archive tables.
+
+    Each chunk is one short transaction: INSERT ... SELECT into the archive,
+    DELETE from the hot table (both re-checking status and age), and one
+    audit entry. Returns {'orders': n, 'payments': m}.
+    """
+    from flask import current_app
+    from models import Order, Payment, ArchivedOrder, ArchivedPayment, AuditLog, ARCHIVABLE_ORDER_STATUSES
+    session = session or db.session
+    config = current_app.config
+    now = now or datetime.utcnow()
+    months = months if months is not None else config.get('ARCHIVE_AFTER_MONTHS', ARCHIVE_DEFAULTS['ARCHIVE_AFTER_MONTHS'])
+    chunk_size = chunk_size or config.get('ARCHIVE_CHUNK_SIZE', ARCHIVE_DEFAULTS['ARCHIVE_CHUNK_SIZE'])
+    cutoff = now - timedelta(days=30 * months)
+
+    orders, archive_orders_t = Order.__table__, ArchivedOrder.__table__
+    payments, archive_payments_t = Payment.__table__, ArchivedPayment.__table__
+    order_cols, payment_cols = _columns(orders), _columns(payments)
+    # Never move the newest order or the order owning the newest payment: SQLite
+    # hands out max(id) + 1, so ids already in the archive would be handed out again
+    max_id = session.query(func.max(Order.id)).scalar() or 0
+    newest_payment_order = session.query(Payment.order_id).order_by(Payment.id.desc()).limit(1).scalar()
+    eligible = (orders.c.status.in_(ARCHIVABLE_ORDER_STATUSES), orders.c.created_at < cutoff, orders.c.id < max_id,
+                orders.c.id != (newest_payment_order or 0))
+
+    moved_orders = moved_payments = 0
+    try:
+        while True:
+            ids = session.execute(select(orders.c.id).where(*eligible).order_by(orders.c.id).limit(chunk_size)).scalars().all()
+            if not ids:
+                break
+            chosen = (orders.c.id.in_(ids),) + eligible
+            session.execute(insert(archive_orders_t).from_select(
+                order_cols, select(*[orders.c[c] for c in order_cols]).where(*chosen)))
+            moved = select(orders.c.id).where(*chosen)
+            result = session.execute(insert(archive_payments_t).from_select(
+                payment_cols, select(*[payments.c[c] for c in payment_cols]).where(payments.c.order_id.in_(moved))))
+            moved_payments += result.rowcount
+            session.execute(delete(payments).where(payments.c.order_id.in_(moved)))
+            archived = session.execute(delete(orders).where(*chosen).returning(orders.c.id)).scalars().all()
+            moved_orders += len(archived)
+            audit = AuditLog(action='Orders Archived', actor='system', details=json.dumps({
+                'count': len(archived), 'order_ids': ids, 'cutoff': cutoff.isoformat()}))
+            session.add(audit)
+            audit.link(session, 'order', archived)
+            session.commit()
+            if len(ids) < chunk_size:
+                break
+            time.sleep(CHUNK_PAUSE_SECONDS)
+    except Exception:
+        session.rollback()
+        raise
+    return {'orders': moved_orders, 'payments': moved_payments}
+
+
+# --- Read paths ---
+
+def get_order(order_id, session=None):
+    """The order from the hot table, or from the archive once it has been moved."""
+    from models import Order, ArchivedOrder
+    session = session or db.session
+    return session.get(Order, order_id) or session.get(ArchivedOrder, order_id)
+
+
+def orders_union(*column_names, start=None, end=None):
+    """Subquery over orders UNION ALL orders_archive with the given columns (for reports).
+
+    The created_at range is applied inside each branch so both tables use their
+    own index; a recent range costs almost nothing on the archive side.
+    """
+    from models import Order, ArchivedOrder
+    branches = []
+    for model in (Order, ArchivedOrder):
+        q = select(*[model.__table__.c[name] for name in column_names])
+        if start is not None:
+            q = q.where(model.created_at >= start)
+        if end is not None:
+            q = q.where(model.created_at < end)
+        branches.append(q)
+    return union_all(*branches).subquery('all_orders')
+
+
+def merge_newest_first(queries, limit):
+    """Merges per-tier result lists that are each sorted by (created_at, id) descending.
+
+    Rows without created_at come last, as in SQLite's descending order.
+    """
+    merged = heapq.merge(*queries, key=lambda r: (r.created_at is not None, r.created_at or datetime.min, r.id),
+                         reverse=True)
+    return [row for _, row in zip(range(limit), merged)]
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    from app import create_app
+    app = create_app({'SWEEPER_ENABLED': False})
+    with app.app_context():
+        months = int(argv[argv.index('--months') + 1]) if '--months' in argv else None
+        started = time.perf_counter()
+        result = archive_orders(months=months)
+    print(f"Archived {result['orders']} orders and {result['payments']} payments "
+          f"in {time.perf_counter() - started:.2f} s")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
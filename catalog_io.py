@@ -0,0 +1,220 @@
+import csv
+import io
+import json
+from datetime import datetime
+
+from sqlalchemy import bindparam, insert, update, delete
+
+from extensions import db
+
+# Columns of the exchange format, shared by CSV and JSON
+FIELDS = ['type', 'name', 'value', 'description']
+PRODUCT_TYPES = ('Flavour', 'Topping', 'Consistency')
+CONFIG_TYPE = 'Config'
+# Rows fetched per round-trip while streaming an export
+EXPORT_BATCH = 500
+
+
+class CatalogImportError(ValueError):
+    """Raised when an import file fails validation; .errors lists every problem found."""
+
+    def __init__(self, errors):
+        super().__init__('; '.join(errors[:5]) + (f' (and {len(errors) - 5} more)' if len(errors) > 5 else ''))
+        self.errors = errors
+
+
+# --- Export ---
+
+def _catalog_rows(session):
+    """Yields the whole catalog as plain dicts without hydrating ORM objects."""
+    from models import Product, Config
+    products = session.query(Product.type, Product.name, Product.value, Product.description) \
+        .order_by(Product.type, Product.name).execution_options(yield_per=EXPORT_BATCH)
+    for r in products:
+        yield {'type': r.type, 'name': r.name, 'value': r.value, 'description': r.description or ''}
+    configs = session.query(Config.name, Config.value).order_by(Config.name) \
+        .execution_options(yield_per=EXPORT_BATCH)
+    for r in configs:
+        yield {'type': CONFIG_TYPE, 'name': r.name, 'value': r.value, 'description': ''}
+
+
+def export_csv(session):
+    """Streams the catalog as CSV text, one chunk per row."""
+    buf = io.StringIO()
+    writer = csv.DictWriter(buf, fieldnames=FIELDS)
+    writer.writeheader()
+    for row in _catalog_rows(session):
+        writer.writerow(row)
+        yield buf.getvalue()
+        buf.seek(0)
+        buf.truncate(0)
+    # header-only export of an empty catalog
+    if buf.getvalue():
+        yield buf.getvalue()
+
+
+def export_json(session):
+    """Streams the catalog as a JSON array, one chunk per row."""
+    yield '['
+    first = True
+    for row in _catalog_rows(session):
+        yield ('\n' if first else ',\n') + json.dumps(row)
+        first = False
+    yield '\n]\n'
+
+
+# --- Import ---
+
+def parse_rows(data, filename=''):
+    """Parses an uploaded CSV or JSON file into a list of dicts."""
+    text = data.decode('utf-8-sig') if isinstance(data, bytes) else data
+    if filename.lower().endswith('.json') or text.lstrip().startswith('['):
+        try:
+            rows = json.loads(text)
+        except ValueError as e:
+            raise CatalogImportError([f'Invalid JSON: {e}'])
+        if not isinstance(rows, list) or not all(isinstance(r, dict) for r in rows):
+            raise CatalogImportError(['JSON import must be a list of objects'])
+        return rows
+    reader = csv.DictReader(io.StringIO(text))
+    missing = [f for f in ('type', 'name', 'value') if f not in (reader.fieldnames or [])]
+    if missing:
+        raise CatalogImportError([f'CSV header is missing column(s): {", ".join(missing)}'])
+    return list(reader)
+
+
+def validate_rows(rows):
+    """Normalises rows and checks every one before anything is written.
+
+    Returns (products, configs) keyed by (type, lowercased name) and lowercased
+    name respectively; raises CatalogImportError listing all problems at once.
+    """
+    errors = []
+    products, configs = {}, {}
+    for line, row in enumerate(rows, start=1):
+        kind = str(row.get('type') or '').strip().title()
+        name = str(row.get('name') or '').strip()
+        value = row.get('value')
+        description = str(row.get('description') or '').strip() or None
+        where = f'Row {line}'
+
+        if not name or len(name) > 120:
+            errors.append(f'{where}: name is required (max 120 characters)')
+            continue
+        if description and len(description) > 255:
+            errors.append(f'{where}: description is longer than 255 characters')
+
+        if kind in PRODUCT_TYPES:
+            try:
+                price = float(value)
+                if price < 0:
+                    raise ValueError
+            except (TypeError, ValueError):
+                errors.append(f'{where}: {name} needs a non-negative price, got {value!r}')
+                continue
+            key = (kind, name.lower())
+            if key in products:
+                errors.append(f'{where}: duplicate {kind} "{name}"')
+            products[key] = {'type': kind, 'name': name, 'value': price, 'description': description}
+        elif kind == CONFIG_TYPE:
+            value = '' if value is None else str(value).strip()
+            if not value or len(value) > 255:
+                errors.append(f'{where}: config {name} needs a value (max 255 characters)')
+                continue
+            if name.lower() in configs:
+                errors.append(f'{where}: duplicate config "{name}"')
+            configs[name.lower()] = {'name': name, 'value': value}
+        else:
+            errors.append(f'{where}: unknown type {row.get("type")!r} '
+                          f'(expected one of {", ".join(PRODUCT_TYPES + (CONFIG_TYPE,))})')
+
+    if errors:
+        raise CatalogImportError(errors)
+    return products, configs
+
+
+def diff_catalog(session, products, configs, remove_missing=False):
+    """Compares validated rows with the current catalog and returns the change set."""
+    from models import Product, Config
+    current_products = {(r.type, r.name.lower()): r for r in
+                        session.query(Product.id, Product.type, Product.name, Product.value, Product.description)}
+    current_configs = {r.name.lower(): r for r in session.query(Config.id, Config.name, Config.value)}
+
+    changes = {'product_inserts': [], 'product_updates': [], 'product_deletes': [],
+               'config_inserts': [], 'config_updates': [], 'unchanged': 0}
+
+    for key, row in products.items():
+        existing = current_products.get(key)
+        if existing is None:
+            changes['product_inserts'].append(row)
+        elif (existing.name, existing.value, existing.description or None) != \
+                (row['name'], row['value'], row['description']):
+            changes['product_updates'].append({**row, 'id': existing.id, 'old_value': existing.value})
+        else:
+            changes['unchanged'] += 1
+
+    for key, row in configs.items():
+        existing = current_configs.get(key)
+        if existing is None:
+            changes['config_inserts'].append(row)
+        elif (existing.name, existing.value) != (row['name'], row['value']):
+            changes['config_updates'].append({**row, 'id': existing.id, 'old_value': existing.value})
+        else:
+            changes['unchanged'] += 1
+
+    if remove_missing:
+        # Configs are never removed: VAT and Maximum Drinks must always exist
+        changes['product_deletes'] = [{'id': r.id, 'type': r.type, 'name': r.name}
+                                      for key, r in current_products.items() if key not in products]
+    return changes
+
+
+def apply_changes(session, changes):
+    """Writes a change set with executemany statements in a single transaction."""
+    from models import Product, Config, invalidate_lookup_cache
+    products, configs = Product.__table__, Config.__table__
+    now = datetime.utcnow()
+    try:
+        if changes['product_inserts']:
+            session.execute(insert(products), [
+                {'type': r['type'], 'name': r['name'], 'value': r['value'], 'price': r['value'],
+                 'description': r['description'], 'created_at': now}
+                for r in changes['product_inserts']])
+        if changes['product_updates']:
+            session.execute(
+                update(products).where(products.c.id == bindparam('b_id')).values(
+                    name=bindparam('b_name'), value=bindparam('b_value'), price=bindparam('b_value'),
+                    description=bindparam('b_description')),
+                [{'b_id': r['id'], 'b_name': r['name'], 'b_value': r['value'], 'b_description': r['description']}
+                 for r in changes['product_updates']])
+        if changes['product_deletes']:
+            session.execute(delete(products).where(products.c.id.in_([r['id'] for r in changes['product_deletes']])))
+        if changes['config_inserts']:
+            session.execute(insert(configs), [
+                {'name': r['name'], 'type': CONFIG_TYPE, 'value': r['value'], 'created_at': now}
+                for r in changes['config_inserts']])
+        if changes['config_updates']:
+            session.execute(
+                update(configs).where(configs.c.id == bindparam('b_id')).values(
+                    name=bindparam('b_name'), value=bindparam('b_value')),
+                [{'b_id': r['id'], 'b_name': r['name'], 'b_value': r['value']} for r in changes['config_updates']])
+        session.commit()
+    except Exception:
+        session.rollback()
+        raise
+    # One invalidation for the whole import
+    invalidate_lookup_cache()
+
+
+def summarize(changes):
+    return {k: (len(v) if isinstance(v, list) else v) for k, v in changes.items()}
+
+
+def import_catalog(data, filename='', session=None, dry_run=False, remove_missing=False):
+    """Parses, validates, diffs and (unless dry_run) applies a catalog file. Returns the change set."""
+    session = session or db.session
+    products, configs = validate_rows(parse_rows(data, filename))
+    changes = diff_catalog(session, products, configs, remove_missing=remove_missing)
+    if not dry_run:
+        apply_changes(session, changes)
+    return changes
@@ -0,0 +1,143 @@
+import heapq
+import threading
+from collections import OrderedDict
+from datetime import date, datetime
+from itertools import groupby
+from operator import attrgetter
+
+from sqlalchemy import func, select
+
+# Rows fetched per round trip from the server-side cursors
+STREAM_BATCH = 2000
+# Retention columns shown (months after the first order)
+MAX_RETENTION_MONTHS = 12
+# Date ranges kept in the per-process result cache
+CACHE_SIZE = 32
+
+_cache_lock = threading.Lock()
+
+
+def _month_index(d):
+    return d.year * 12 + d.month - 1
+
+
+def _month_label(index):
+    return f'{index // 12:04d}-{index % 12 + 1:02d}'
+
+
+def paid_orders(session, model):
+    """Streams (user_id, created_at, total) of paid orders, ordered by customer then time."""
+    from models import UNPAID_ORDER_STATUSES
+    stmt = select(model.user_id, model.created_at, model.total).where(
+        model.user_id.isnot(None), model.created_at.isnot(None), model.status.notin_(UNPAID_ORDER_STATUSES)
+    ).order_by(model.user_id, model.created_at)
+    # ix_orders_user_created_at already has this order, so no sort step and no buffering
+    return session.execute(stmt, execution_options={'stream_results': True, 'yield_per': STREAM_BATCH})
+
+
+def order_stream(session):
+    """Hot and archived orders merged into one (user_id, created_at) ordered stream."""
+    from models import Order, ArchivedOrder
+    key = attrgetter('user_id', 'created_at')
+    return heapq.merge(paid_orders(session, Order), paid_orders(session, ArchivedOrder), key=key)
+
+
+def customer_summaries(rows):
+    """One (cohort month, orders, revenue, active month offsets) tuple per customer.
+
+    Holds only the current customer's state; the input must be grouped by user_id.
+    """
+    for _, orders in groupby(rows, key=attrgetter('user_id')):
+        cohort = None
+        count, revenue, offsets = 0, 0.0, set()
+        for row in orders:
+            month = _month_index(row.created_at)
+            if cohort is None:
+                cohort = month
+            count += 1
+            revenue += row.total or 0.0
+            offsets.add(month - cohort)
+        yield cohort, count, revenue, offsets
+
+
+def fold_cohorts(summaries, first_month, last_month, current_month, max_offset=MAX_RETENTION_MONTHS):
+    """Aggregates customer summaries into per-cohort rows for cohorts in [first_month, last_month]."""
+    cohorts = {}
+    for cohort, count, revenue, offsets in summaries:
+        if not first_month <= cohort <= last_month:
+            continue
+        c = cohorts.get(cohort)
+        if c is None:
+            c = cohorts[cohort] = {'customers': 0, 'repeat_customers': 0, 'orders': 0, 'revenue': 0.0,
+                                   'active': [0] * (max_offset + 1)}
+        c['customers'] += 1
+        c['repeat_customers'] += count > 1
+        c['orders'] += count
+        c['revenue'] += revenue
+        for offset in offsets:
+            if offset <= max_offset:
+                c['active'][offset] += 1
+
+    report = []
+    for cohort in sorted(cohorts):
+        c = cohorts[cohort]
+        # Months that have not happened yet for this cohort are left blank, not 0%
+        observed = min(max_offset, current_month - cohort)
+        report.append({
+            'cohort': _month_label(cohort),
+            'customers': c['customers'],
+            'repeat_customers': c['repeat_customers'],
+            'repeat_rate': round(100.0 * c['repeat_customers'] / c['customers'], 1),
+            'orders': c['orders'],
+            'revenue': round(c['revenue'], 2),
+            'avg_order_value': round(c['revenue'] / c['orders'], 2),
+            'retention': [round(100.0 * c['active'][k] / c['customers'], 1) for k in range(1, observed + 1)],
+        })
+    return report
+
+
+def data_version(session):
+    """Changes whenever an order is placed, changes (updated_at) or is archived.
+
+    Only order data counts, so audit traffic (logins, settings) keeps the cache.
+    Each max() is one step down an index.
+    """
+    from models import Order, ArchivedOrder
+    # one subquery per max(): SQLite only takes the index shortcut for a lone min/max
+    return tuple(session.execute(select(select(func.max(model.id)).scalar_subquery(),
+                                        select(func.max(model.updated_at)).scalar_subquery())).one()
+                 for model in (Order, ArchivedOrder))
+
+
+def cohort_report(session, start, end, today=None):
+    """Cohorts of customers whose first order fell in [start, end), with their activity since.
+
+    One pass over the paid orders through server-side cursors; memory is bounded
+    by the number of cohorts, not orders. Results are cached per range until
+    data_version() moves.
+    """
+    from flask import current_app
+    today = today or date.today()
+    key = (start, end, today)
+    version = data_version(session)
+    cache = current_app.extensions.setdefault('cohort_cache', OrderedDict())
+    with _cache_lock:
+        hit = cache.get(key)
+        if hit is not None and hit[0] == version:
+            cache.move_to_end(key)
+            return hit[1]
+
+    started = datetime.utcnow()
+    report = {
+        'cohorts': fold_cohorts(customer_summaries(order_stream(session)),
+                                _month_index(start), _month_index(end) - (1 if end.day == 1 else 0),
+                                _month_index(today)),
+        'computed_at': started,
+        'max_retention_months': MAX_RETENTION_MONTHS,
+    }
+    with _cache_lock:
+        cache[key] = (version, report)
+        cache.move_to_end(key)
+        while len(cache) > CACHE_SIZE:
+            cache.popitem(last=False)
+    return report
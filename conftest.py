@@ -0,0 +1,93 @@
+import json
+from datetime import datetime, timedelta
+
+import pytest
+
+import db_snapshot
+from query_budget import assert_max_queries
+
+
+@pytest.fixture(scope='session')
+def template_db(tmp_path_factory):
+    """Seeded, empty database built once per test session (see db_snapshot.py)."""
+    return db_snapshot.build_template(str(tmp_path_factory.mktemp('db') / 'template.db'))
+
+
+@pytest.fixture
+def app_config():
+    """Extra app config; override this fixture in a test module to change it."""
+    return {}
+
+
+@pytest.fixture
+def app(template_db, app_config):
+    """An app on a fresh in-memory copy of the template, with a manager and a customer."""
+    from app import create_app
+    from extensions import db
+    from models import User
+    app = create_app({**db_snapshot.template_app_config(template_db), 'RATE_LIMIT_ENABLED': False, **app_config})
+    with app.app_context():
+        for name, role in (('manager', 'manager'), ('customer', 'client')):
+            user = User(username=name, email=f'{name}@example.com', role=role)
+            user.set_password('password1')
+            db.session.add(user)
+        db.session.commit()
+    return app
+
+
+def _login(app, name):
+    client = app.test_client()
+    response = client.post('/login', data={'email': f'{name}@example.com', 'password': 'password1'})
+    assert response.status_code == 302, response.status_code
+    return client
+
+
+@pytest.fixture
+def customer(app):
+    return _login(app, 'customer')
+
+
+@pytest.fixture
+def manager(app):
+    return _login(app, 'manager')
+
+
+@pytest.fixture
+def place_order():
+    """Places an order of n vanilla shakes through the order form; returns the response."""
+    def place(client, n=1):
+        pickup = (datetime.utcnow() + timedelta(hours=1)).strftime('%Y-%m-%dT%H:%M')
+        items = [{'flavour': 'vanilla', 'thick': 'thick', 'topping': 'nuts'}] * n
+        return client.post('/order', data={'number_of_milkshakes': n, 'pickup_time': pickup,
+                                           'location': 'Main St', 'order_data': json.dumps(items)})
+    return place
+
+
+@pytest.fixture
+def pay(app):
+    """Starts a payment on Pay Now and answers it through the webhook (status=None leaves it open).
+
+    Returns the payment's provider_ref.
+    """
+    def pay(client, order_id, status='Success', idempotency_key=None):
+        from extensions import db
+        from models import Payment
+        data = {'submit': 'y', **({'idempotency_key': idempotency_key} if idempotency_key else {})}
+        assert client.post(f'/orders/{order_id}/pay/submit', data=data).status_code == 200
+        with app.app_context():
+            ref = db.session.query(Payment.provider_ref).filter_by(order_id=order_id).order_by(Payment.id.desc()).first()[0]
+        if status:
+            response = app.test_client().post('/payments/webhook', json={'provider_ref': ref, 'status': status})
+            assert response.status_code == 200, response.status_code
+        return ref
+    return pay
+
+
+@pytest.fixture
+def query_budget():
+    """Returns assert_max_queries, so a test can pin the query count of any block:
+
+        with query_budget(3):
+            client.get('/orders')
+    """
+    return assert_max_queries
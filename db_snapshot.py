@@ -0,0 +1,157 @@
+# milky_shaky/db_snapshot.py
+
+import sqlite3
+import os
+import sys
+import tempfile
+import time
+
+# --- Configuration ---
+DB_PATH = os.path.join(os.path.dirname(__file__), 'instance', 'milky_shaky.db')
+# Default location for the known-good state used by reset_db.py
+SNAPSHOT_PATH = os.path.join(os.path.dirname(__file__), 'instance', 'milky_shaky.snapshot.db')
+# Seeded, empty schema used as a fixture template for tests
+TEMPLATE_PATH = os.path.join(os.path.dirname(__file__), 'instance', 'milky_shaky.template.db')
+
+
+def _copy(src_conn, dest_conn):
+    """Copies every page of src into dest using SQLite's online backup API.
+
+    The backup replaces the destination content as a whole (and truncates the
+    file to the source size), so it costs one sequential page copy instead of a
+    DELETE per row, and other connections to the destination simply see the new
+    state on their next transaction.
+    """
+    src_conn.backup(dest_conn)
+
+
+def snapshot(db_path=DB_PATH, dest_path=SNAPSHOT_PATH):
+    """Writes a consistent copy of db_path to dest_path.
+
+    The copy is written to a temporary file first and moved into place, so a
+    crash half way through never leaves a truncated snapshot behind.
+    """
+    src = sqlite3.connect(f"file:{db_path}?mode=ro", uri=True)
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(dest_path)), suffix='.tmp')
+    os.close(fd)
+    dest = sqlite3.connect(tmp_path)
+    try:
+        _copy(src, dest)
+    finally:
+        dest.close()
+        src.close()
+    os.replace(tmp_path, dest_path)
+    return dest_path
+
+
+def restore(snapshot_path=SNAPSHOT_PATH, db_path=DB_PATH):
+    """Overwrites db_path with the contents of snapshot_path."""
+    if not os.path.exists(snapshot_path):
+        raise FileNotFoundError(f"Snapshot not found at {snapshot_path}")
+    src = sqlite3.connect(f"file:{snapshot_path}?mode=ro", uri=True)
+    dest = sqlite3.connect(db_path)
+    try:
+        _copy(src, dest)
+    finally:
+        dest.close()
+        src.close()
+    return db_path
+
+
+def build_template(dest_path=TEMPLATE_PATH):
+    """Creates a seeded database with the current model schema and no user data.
+
+    Build this once per test session, then hand out copies with clone_template().
+    """
+    # Imported here so the snapshot/restore commands work without Flask installed
+    from app import create_app
+    from reset_db import insert_initial_data
+
+    if os.path.exists(dest_path):
+        os.remove(dest_path)
+    create_app({'SQLALCHEMY_DATABASE_URI': 'sqlite:///' + os.path.abspath(dest_path), 'SWEEPER_ENABLED': False})
+
+    conn = sqlite3.connect(dest_path)
+    try:
+        insert_initial_data(conn)
+        conn.commit()
+        # Compact the file so every clone copies as few pages as possible
+        conn.execute("VACUUM")
+    finally:
+        conn.close()
+    return dest_path
+
+
+def clone_template(template_path=TEMPLATE_PATH, target=':memory:'):
+    """Returns an open sqlite3 connection holding a fresh copy of the template.
+
+    target may be ':memory:' (the default) or a file path. The connection is
+    created with check_same_thread=False so it can back a StaticPool engine.
+    """
+    src = sqlite3.connect(f"file:{template_path}?mode=ro", uri=True)
+    dest = sqlite3.connect(target, check_same_thread=False)
+    try:
+        _copy(src, dest)
+    finally:
+        src.close()
+    return dest
+
+
+def template_app_config(template_path=TEMPLATE_PATH):
+    """Builds a create_app() config that runs on an in-memory clone of the template.
+
+    Example (pytest):
+        TEMPLATE = db_snapshot.build_template(tmp_path_factory.mktemp('db') / 'template.db')
+        app = create_app(db_snapshot.template_app_config(TEMPLATE))
+    """
+    conn = clone_template(template_path)
+    return {
+        'TESTING': True,
+        'WTF_CSRF_ENABLED': False,
+        'SQLALCHEMY_DATABASE_URI': 'sqlite://',
+        # Flask-SQLAlchemy pairs in-memory URIs with a StaticPool, so every
+        # session shares this single pre-populated connection.
+        'SQLALCHEMY_ENGINE_OPTIONS': {'creator': lambda: conn},
+    }
+
+
+USAGE = """usage: python db_snapshot.py <command> [path]
+
+commands:
+  snapshot [dest]   copy the live database to dest (default: instance/milky_shaky.snapshot.db)
+  restore [src]     overwrite the live database with src (default: instance/milky_shaky.snapshot.db)
+  template [dest]   build a seeded test template (default: instance/milky_shaky.template.db)
+"""
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    if not argv or argv[0] not in ('snapshot', 'restore', 'template'):
+        print(USAGE)
+        return 1
+
+    command = argv[0]
+    path = argv[1] if len(argv) > 1 else None
+    started = time.perf_counter()
+    try:
+        if command == 'snapshot':
+            if not os.path.exists(DB_PATH):
+                print("Database not found at", DB_PATH)
+                return 1
+            out = snapshot(DB_PATH, path or SNAPSHOT_PATH)
+            print(f"Snapshot written to {out}")
+        elif command == 'restore':
+            restore(path or SNAPSHOT_PATH, DB_PATH)
+            print(f"Database restored from {path or SNAPSHOT_PATH}")
+        else:
+            out = build_template(path or TEMPLATE_PATH)
+            print(f"Template database written to {out}")
+    except Exception as e:
+        print(f"FATAL ERROR during {command}:", e)
+        return 1
+    print(f"Done in {(time.perf_counter() - started) * 1000:.1f} ms")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -3,8 +3,10 @@ from wtforms import StringField, PasswordField, BooleanField, SubmitField
 from wtforms.validators import DataRequired, Length, Email, EqualTo
 from wtforms import IntegerField, HiddenField
 from wtforms.validators import NumberRange, Optional
-from wtforms import IntegerField, HiddenField, SelectField
+from wtforms import IntegerField, HiddenField, SelectField, FloatField
 from wtforms.validators import NumberRange, Optional, InputRequired
+from flask_wtf.file import FileField, FileRequired, FileAllowed
+from idempotency import new_key
 
 class RegistrationForm(FlaskForm):
     username = StringField('Full Name', validators=[DataRequired(), Length(min=2, max=80)])
@@ -23,9 +25,11 @@ class OrderForm(FlaskForm):
     pickup_time = StringField('Pickup time', validators=[DataRequired()])  # expects HTML datetime-local value
     location = StringField('Pickup location', validators=[DataRequired(), Length(max=255)])
     order_data = HiddenField('Order data (JSON)', validators=[DataRequired()])  # JSON payload of items
+    idempotency_key = HiddenField(default=new_key)  # same value on a double-tap or retry
     submit = SubmitField('Continue')
 
 class PaymentForm(FlaskForm):
+    idempotency_key = HiddenField(default=new_key)
     submit = SubmitField('Pay Now (Simulated)')
 
 # ADDED: Form for managing lookup items (Products and Configs)
@@ -39,4 +43,24 @@ class LookupForm(FlaskForm):
     ], validators=[InputRequired()])
     value = StringField('Value', validators=[DataRequired(), Length(max=255)]) # Used for price or config value (e.g., 15% or 10)
     description = StringField('Description (optional)', validators=[Optional(), Length(max=255)])
-    submit = SubmitField('Save')
\ No newline at end of file
+    submit = SubmitField('Save')
+
+# Re-runs pricing for orders still awaiting payment after a catalog change
+class RepriceForm(FlaskForm):
+    dry_run = BooleanField('Preview only (dry run)', default=True)
+    submit = SubmitField('Reprice Pending Orders')
+
+
+# Bulk catalog upload (CSV or JSON export format) for the admin lookup screens
+class CatalogImportForm(FlaskForm):
+    file = FileField('Catalog file (CSV or JSON)', validators=[FileRequired(), FileAllowed(['csv', 'json'], 'CSV or JSON files only')])
+    preview = BooleanField('Preview changes only', default=True)
+    remove_missing = BooleanField('Remove products missing from the file')
+    submit = SubmitField('Import Catalog')
+
+
+# Runtime switch for the request profiler (profiler.py)
+class ProfilerSettingsForm(FlaskForm):
+    enabled = BooleanField('Sample requests')
+    sample_rate = FloatField('Sample rate (0-1)', validators=[InputRequired(), NumberRange(min=0, max=1)])
+    submit = SubmitField('Save')
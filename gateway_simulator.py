@@ -0,0 +1,383 @@
+"""Local stand-in for the payment gateway.
+
+    python gateway_simulator.py serve --webhook-url http://127.0.0.1:5000/payments/webhook
+    python gateway_simulator.py drive --payments 2000 --rate 200
+
+`serve` runs the gateway on its own: set PAYMENT_GATEWAY_URL (e.g.
+http://127.0.0.1:8099) in the app config and every payment started on
+/orders/<id>/pay/submit is registered here, then confirmed (or failed) by a
+webhook call after the configured latency. `drive` is self-contained: it seeds
+a throwaway database, runs the app and the gateway in this process and reports
+webhook throughput and payment-to-confirmation lag.
+"""
+import argparse
+import heapq
+import itertools
+import json
+import logging
+import os
+import queue
+import random
+import secrets
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.request
+from contextlib import redirect_stdout
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# --- Gateway Defaults ---
+GATEWAY_DEFAULTS = {
+    'rate': 50.0,            # webhook calls per second, across all sessions
+    'latency': 0.2,          # seconds from session start to the first webhook
+    'jitter': 0.1,           # +/- seconds added to each delivery
+    'failure_rate': 0.0,     # share of payments that end Failed
+    'duplicate_rate': 0.0,   # share of payments whose webhook is delivered twice
+    'reorder_rate': 0.0,     # share of payments where a stale 'Failed' attempt arrives after the success
+    'workers': 8,            # concurrent webhook calls
+    'max_retries': 5,        # redeliveries on 429/5xx/connection errors
+    'call_timeout': 10.0,    # seconds per webhook call
+}
+
+
+def _percentile(values, pct):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(pct / 100.0 * (len(values) - 1))))]
+
+
+class Gateway:
+    """Holds payment sessions and delivers their webhooks on a paced schedule."""
+
+    def __init__(self, webhook_url, seed=None, **options):
+        self.webhook_url = webhook_url
+        self.options = {**GATEWAY_DEFAULTS, **{k: v for k, v in options.items() if v is not None}}
+        self.random = random.Random(seed)
+        self.sessions = {}
+        self.codes = {}
+        self.delivered = 0
+        self.gave_up = 0
+        self.first_send = None
+        self.last_ack = None
+        self._heap = []
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+        self._work = queue.Queue(maxsize=self.options['workers'] * 2)
+        self._in_flight = 0
+        self._stop = threading.Event()
+        self._threads = []
+
+    # --- sessions ---
+
+    def open_session(self, provider_ref, amount=None, order_id=None):
+        """Registers a payment and schedules its webhook(s). Returns the planned outcome."""
+        o = self.options
+        now = time.monotonic()
+        outcome = 'Failed' if self.random.random() < o['failure_rate'] else 'Success'
+        with self._cond:
+            self.sessions[provider_ref] = {'opened': now, 'outcome': outcome, 'acked': None,
+                                           'amount': amount, 'order_id': order_id}
+            due = now + max(0.0, o['latency'] + self.random.uniform(-o['jitter'], o['jitter']))
+            self._schedule(due, provider_ref, outcome, 'primary')
+            if outcome == 'Success' and self.random.random() < o['reorder_rate']:
+                # An earlier declined attempt whose notification only arrives after the success
+                self._schedule(due + self.random.uniform(0.01, max(0.02, o['jitter'])), provider_ref, 'Failed', 'stale')
+            if self.random.random() < o['duplicate_rate']:
+                self._schedule(due + self.random.uniform(0.0, max(0.01, o['latency'])), provider_ref, outcome, 'duplicate')
+            self._cond.notify()
+        return outcome
+
+    def _schedule(self, due, provider_ref, status, kind, attempt=0):
+        heapq.heappush(self._heap, (due, next(self._seq), provider_ref, status, kind, attempt))
+
+    # --- delivery ---
+
+    def start(self):
+        self._threads.append(threading.Thread(target=self._dispatch, name='gateway-dispatch', daemon=True))
+        for i in range(self.options['workers']):
+            self._threads.append(threading.Thread(target=self._deliver, name=f'gateway-worker-{i}', daemon=True))
+        for t in self._threads:
+            t.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        with self._cond:
+            self._cond.notify_all()
+
+    def _dispatch(self):
+        # Paces calls to `rate` per second; late items go out as soon as a slot is free
+        interval = 1.0 / self.options['rate']
+        next_slot = time.monotonic()
+        while not self._stop.is_set():
+            with self._cond:
+                while not self._stop.is_set() and (not self._heap or self._heap[0][0] > time.monotonic()):
+                    self._cond.wait(None if not self._heap else self._heap[0][0] - time.monotonic())
+                if self._stop.is_set():
+                    return
+                item = heapq.heappop(self._heap)
+                self._in_flight += 1
+            wait = next_slot - time.monotonic()
+            if wait > 0:
+                time.sleep(wait)
+            next_slot = max(next_slot, time.monotonic()) + interval
+            self._work.put(item)
+
+    def _deliver(self):
+        while not self._stop.is_set():
+            try:
+                due, _, provider_ref, status, kind, attempt = self._work.get(timeout=0.5)
+            except queue.Empty:
+                continue
+            code, retry_after = self._post(provider_ref, status)
+            now = time.monotonic()
+            with self._cond:
+                self.first_send = self.first_send or now
+                self.codes[code] = self.codes.get(code, 0) + 1
+                if isinstance(code, int) and 200 <= code < 300:
+                    self.delivered += 1
+                    self.last_ack = now
+                    session = self.sessions.get(provider_ref)
+                    if kind == 'primary' and session is not None:
+                        session['acked'] = now
+                elif (code == 'error' or code == 429 or code >= 500) and attempt < self.options['max_retries']:
+                    backoff = retry_after if retry_after is not None else 0.1 * 2 ** attempt
+                    self._schedule(now + backoff, provider_ref, status, kind, attempt + 1)
+                else:
+                    self.gave_up += 1
+                self._in_flight -= 1
+                self._cond.notify_all()
+
+    def _post(self, provider_ref, status):
+        body = json.dumps({'provider_ref': provider_ref, 'status': status}).encode()
+        req = urllib.request.Request(self.webhook_url, data=body, method='POST',
+                                     headers={'Content-Type': 'application/json'})
+        try:
+            with urllib.request.urlopen(req, timeout=self.options['call_timeout']) as resp:
+                return resp.status, None
+        except urllib.error.HTTPError as e:
+            retry_after = e.headers.get('Retry-After')
+            return e.code, float(retry_after) if retry_after else None
+        except (urllib.error.URLError, OSError):
+            return 'error', None
+
+    # --- reporting ---
+
+    def wait_idle(self, timeout):
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            while self._heap or self._in_flight:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                self._cond.wait(min(remaining, 0.5))
+        return True
+
+    def stats(self):
+        with self._cond:
+            lags = [s['acked'] - s['opened'] for s in self.sessions.values() if s['acked'] is not None]
+            span = (self.last_ack - self.first_send) if self.first_send and self.last_ack else 0.0
+            return {
+                'sessions': len(self.sessions),
+                'confirmed': len(lags),
+                'delivered': self.delivered,
+                'gave_up': self.gave_up,
+                'queued': len(self._heap),
+                'in_flight': self._in_flight,
+                'status_codes': {str(k): v for k, v in sorted(self.codes.items(), key=str)},
+                'throughput_per_s': round(self.delivered / span, 1) if span > 0 else None,
+                'lag_ms': {p: round(_percentile(lags, p) * 1000, 1) if lags else None for p in (50, 95, 99)},
+                'lag_max_ms': round(max(lags) * 1000, 1) if lags else None,
+            }
+
+
+# --- HTTP front end ---
+
+def make_server(gateway, host='127.0.0.1', port=8099):
+    class Handler(BaseHTTPRequestHandler):
+        def _json(self, code, payload):
+            body = json.dumps(payload).encode()
+            self.send_response(code)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_POST(self):
+            if self.path != '/sessions':
+                return self._json(404, {'error': 'not found'})
+            try:
+                payload = json.loads(self.rfile.read(int(self.headers.get('Content-Length') or 0)) or b'{}')
+            except ValueError:
+                return self._json(400, {'error': 'invalid JSON'})
+            provider_ref = payload.get('provider_ref')
+            if not provider_ref:
+                return self._json(400, {'error': 'missing provider_ref'})
+            outcome = gateway.open_session(provider_ref, payload.get('amount'), payload.get('order_id'))
+            self._json(201, {'provider_ref': provider_ref, 'planned_status': outcome})
+
+        def do_GET(self):
+            if self.path != '/stats':
+                return self._json(404, {'error': 'not found'})
+            self._json(200, gateway.stats())
+
+        def log_message(self, *args):
+            pass
+
+    return ThreadingHTTPServer((host, port), Handler)
+
+
+def serve(args):
+    gateway = Gateway(args.webhook_url, seed=args.seed, **_gateway_options(args)).start()
+    server = make_server(gateway, args.host, args.port)
+    print(f"Gateway simulator on http://{args.host}:{args.port} -> {args.webhook_url}")
+    print("POST /sessions {provider_ref, amount, order_id}; GET /stats")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        gateway.stop()
+        print(json.dumps(gateway.stats(), indent=2))
+    return 0
+
+
+# --- Driver ---
+
+def _seed_payments(app, n):
+    from extensions import db
+    from models import Order, Payment, User
+    with app.app_context():
+        user = User(username='gateway-driver', email='gateway-driver@example.com', password_hash='x')
+        db.session.add(user)
+        db.session.commit()
+        now = datetime.utcnow()
+        item = {'flavour': 'vanilla', 'thick': 'thick', 'topping': 'nuts', 'price': 30.0}
+        db.session.execute(Order.__table__.insert(), [
+            {'user_id': user.id, 'created_at': now, 'pickup_time': now + timedelta(hours=1), 'location': 'Driver',
+             'items': json.dumps([item]), 'status': 'Pending Payment',
+             'subtotal': 30.0, 'vat': 4.5, 'discount': 0.0, 'total': 34.5}
+            for _ in range(n)
+        ])
+        order_ids = [row.id for row in db.session.query(Order.id).filter(Order.user_id == user.id).order_by(Order.id)]
+        refs = [secrets.token_urlsafe(24) for _ in order_ids]
+        db.session.execute(Payment.__table__.insert(), [
+            {'order_id': oid, 'amount': 34.5, 'provider': 'simulated_gateway', 'provider_ref': ref,
+             'status': 'Pending', 'created_at': now}
+            for oid, ref in zip(order_ids, refs)
+        ])
+        db.session.commit()
+    return list(zip(order_ids, refs))
+
+
+def _final_states(app):
+    from extensions import db
+    from models import Order, Payment
+    with app.app_context():
+        return {ref: (p_status, o_status) for ref, p_status, o_status in db.session.query(
+            Payment.provider_ref, Payment.status, Order.status).join(Order, Order.id == Payment.order_id)}
+
+
+def drive(args):
+    """Runs the app and the gateway in-process and pushes args.payments webhooks through."""
+    from werkzeug.serving import make_server as make_wsgi_server
+    from app import create_app
+    from reset_db import insert_initial_data
+    import sqlite3
+
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)
+    workdir = tempfile.mkdtemp(prefix='gateway_drive_')
+    path = os.path.join(workdir, 'drive.db')
+    with redirect_stdout(open(os.devnull, 'w')):
+        app = create_app({'SQLALCHEMY_DATABASE_URI': 'sqlite:///' + path, 'SWEEPER_ENABLED': False,
+                          'RATE_LIMIT_ENABLED': args.rate_limit})
+    conn = sqlite3.connect(path)
+    insert_initial_data(conn)
+    conn.commit()
+    conn.close()
+    sessions = _seed_payments(app, args.payments)
+
+    server = make_wsgi_server('127.0.0.1', 0, app, threaded=True)
+    threading.Thread(target=server.serve_forever, name='app-server', daemon=True).start()
+    webhook_url = f'http://127.0.0.1:{server.server_port}/payments/webhook'
+    gateway = Gateway(webhook_url, seed=args.seed, **_gateway_options(args)).start()
+
+    print(f"Driving {args.payments} payments at {gateway.options['rate']:g} webhooks/s "
+          f"(latency {gateway.options['latency']}s, failure {gateway.options['failure_rate']:.0%}, "
+          f"duplicates {gateway.options['duplicate_rate']:.0%}, out-of-order {gateway.options['reorder_rate']:.0%}, "
+          f"rate limiter {'on' if args.rate_limit else 'off'})")
+    started = time.monotonic()
+    # The app prints a line per webhook; keep the report readable
+    with redirect_stdout(open(os.devnull, 'w')):
+        planned = {ref: gateway.open_session(ref, 34.5, oid) for oid, ref in sessions}
+        finished = gateway.wait_idle(args.timeout)
+    elapsed = time.monotonic() - started
+    gateway.stop()
+    server.shutdown()
+
+    stats = gateway.stats()
+    states = _final_states(app)
+    expected_order = {'Success': 'Confirmed', 'Failed': 'Pending Payment'}
+    wrong_payment = sum(1 for ref, outcome in planned.items() if states[ref][0] != outcome)
+    wrong_order = sum(1 for ref, outcome in planned.items() if states[ref][1] != expected_order[outcome])
+
+    print(f"  finished:        {'yes' if finished else 'NO (timed out)'} in {elapsed:.2f} s")
+    # A refused call is a failure, not throughput: it only shows how fast the app said no
+    refused = sum(n for code, n in stats['status_codes'].items() if not code.startswith('2'))
+    limited = stats['status_codes'].get('429', 0)
+    print(f"  webhooks:        {stats['delivered']} accepted, {stats['gave_up']} given up, codes {stats['status_codes']}")
+    print(f"  failures:        {refused} refused calls ({limited} rate-limited 429s), {stats['gave_up']} calls given up after retries")
+    print(f"  throughput:      {stats['throughput_per_s']} webhooks/s accepted by the app")
+    print(f"  lag p50/p95/p99: {stats['lag_ms'][50]} / {stats['lag_ms'][95]} / {stats['lag_ms'][99]} ms "
+          f"(max {stats['lag_max_ms']} ms), payment start to confirmation")
+    print(f"  final state:     {wrong_payment} payments and {wrong_order} orders differ from the gateway's outcome")
+    if limited:
+        print("  note:            the rate limiter refused calls; throughput and lag above measure the limiter, "
+              "not the webhook path")
+    return stats
+
+
+def _gateway_options(args):
+    return {key: getattr(args, key) for key in GATEWAY_DEFAULTS}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Local payment gateway simulator')
+    sub = parser.add_subparsers(dest='command', required=True)
+    for name in ('serve', 'drive'):
+        p = sub.add_parser(name)
+        p.add_argument('--rate', type=float)
+        p.add_argument('--latency', type=float)
+        p.add_argument('--jitter', type=float)
+        p.add_argument('--failure-rate', dest='failure_rate', type=float)
+        p.add_argument('--duplicate-rate', dest='duplicate_rate', type=float)
+        p.add_argument('--reorder-rate', dest='reorder_rate', type=float)
+        p.add_argument('--workers', type=int)
+        p.add_argument('--max-retries', dest='max_retries', type=int)
+        p.add_argument('--call-timeout', dest='call_timeout', type=float)
+        p.add_argument('--seed', type=int)
+        if name == 'serve':
+            p.add_argument('--webhook-url', dest='webhook_url', default='http://127.0.0.1:5000/payments/webhook')
+            p.add_argument('--host', default='127.0.0.1')
+            p.add_argument('--port', type=int, default=8099)
+        else:
+            p.add_argument('--payments', type=int, default=500)
+            p.add_argument('--timeout', type=float, default=300.0, help='give up waiting after this many seconds')
+            # Off by default: the run measures the webhook path, not the limiter in front of it
+            p.add_argument('--rate-limit', dest='rate_limit', action='store_true', default=False,
+                           help='keep the app rate limiter on (429s are reported as failures)')
+            p.add_argument('--no-rate-limit', dest='rate_limit', action='store_false',
+                           help='disable the app rate limiter (the default)')
+    args = parser.parse_args(sys.argv[1:] if argv is None else argv)
+    if args.command == 'serve':
+        return serve(args)
+    drive(args)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
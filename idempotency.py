@@ -0,0 +1,82 @@
+import json
+import re
+from datetime import datetime, timedelta
+
+from sqlalchemy import delete, select
+
+from extensions import db
+
+# --- Idempotency Defaults (override through app.config) ---
+IDEMPOTENCY_DEFAULTS = {
+    'IDEMPOTENCY_TTL_HOURS': 24,   # how long a key replays its first result
+}
+HEADER = 'Idempotency-Key'
+# uuid4().hex from the forms; API clients may send any token of this shape
+KEY_PATTERN = re.compile(r'^[A-Za-z0-9_\-]{8,64}$')
+
+
+def new_key():
+    import uuid
+    return uuid.uuid4().hex
+
+
+def request_key(form_value=None):
+    """The key sent with this request (Idempotency-Key header, else the form field), or None."""
+    from flask import request
+    key = request.headers.get(HEADER) or form_value
+    return key if key and KEY_PATTERN.match(key) else None
+
+
+def lookup(session, scope, user_id, key, now=None):
+    """The stored result for a key that has not expired yet, or None."""
+    from models import IdempotencyKey
+    if not key:
+        return None
+    now = now or datetime.utcnow()
+    result = session.execute(select(IdempotencyKey.result).where(
+        IdempotencyKey.user_id == user_id, IdempotencyKey.scope == scope, IdempotencyKey.key == key,
+        IdempotencyKey.expires_at > now)).scalar()
+    return json.loads(result) if result else None
+
+
+def remember(session, scope, user_id, key, result, now=None):
+    """Stores the result in the caller's transaction, so it commits (or not) with the writes it describes.
+
+    A concurrent duplicate then fails on uq_idempotency_keys_key at commit; the
+    caller rolls back and replays lookup() instead.
+    """
+    from flask import current_app
+    from models import IdempotencyKey
+    now = now or datetime.utcnow()
+    ttl = current_app.config.get('IDEMPOTENCY_TTL_HOURS', IDEMPOTENCY_DEFAULTS['IDEMPOTENCY_TTL_HOURS'])
+    # An expired row for the same key would block the insert; it is replaced
+    session.execute(delete(IdempotencyKey).where(
+        IdempotencyKey.user_id == user_id, IdempotencyKey.scope == scope, IdempotencyKey.key == key,
+        IdempotencyKey.expires_at <= now))
+    session.add(IdempotencyKey(user_id=user_id, scope=scope, key=key, result=json.dumps(result),
+                               created_at=now, expires_at=now + timedelta(hours=ttl)))
+
+
+def forget(session, scope, user_id, key):
+    """Drops a key whose stored result can no longer be replayed, in the caller's transaction."""
+    from models import IdempotencyKey
+    session.execute(delete(IdempotencyKey).where(
+        IdempotencyKey.user_id == user_id, IdempotencyKey.scope == scope, IdempotencyKey.key == key))
+
+
+def purge_expired(session=None, now=None, chunk_size=500):
+    """Deletes expired keys in chunks (run by the sweeper). Returns the number deleted."""
+    from models import IdempotencyKey
+    session = session or db.session
+    now = now or datetime.utcnow()
+    purged = 0
+    while True:
+        ids = session.execute(select(IdempotencyKey.id).where(IdempotencyKey.expires_at <= now)
+                              .order_by(IdempotencyKey.expires_at).limit(chunk_size)).scalars().all()
+        if not ids:
+            break
+        purged += session.execute(delete(IdempotencyKey).where(IdempotencyKey.id.in_(ids))).rowcount
+        session.commit()
+        if len(ids) < chunk_size:
+            break
+    return purged
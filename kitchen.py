@@ -0,0 +1,174 @@
+import json
+from datetime import date, datetime, timedelta
+
+from sqlalchemy import and_, or_, update
+
+from extensions import db
+
+# Orders the kitchen still has to make or hand over
+BOARD_STATUSES = ('Confirmed', 'Preparing', 'Ready')
+# Kitchen state machine: action -> (statuses it may move from, status it sets, audit action)
+TRANSITIONS = {
+    'prepare': (('Confirmed',), 'Preparing', 'Orders Preparing'),
+    'ready': (('Confirmed', 'Preparing'), 'Ready', 'Orders Ready'),
+    'collect': (('Ready',), 'Collected', 'Orders Collected'),
+}
+# Order ids accepted by one transition call (a day's board fits; use location + day beyond that)
+MAX_TRANSITION_IDS = 5000
+DEFAULT_WINDOW_MINUTES = 60
+# Overdue orders stay on the board this long after their pickup time
+OVERDUE_MINUTES = 30
+# Changes are re-sent for this long after the cursor, so a write that committed
+# just after a refresh (with an updated_at from just before it) is never missed
+CURSOR_OVERLAP_SECONDS = 5
+
+
+def _board_columns():
+    from models import Order, User
+    return (Order.id, Order.pickup_time, Order.status, Order.items, Order.updated_at, User.username)
+
+
+def _items(raw):
+    # Same fallback as Order.get_items(): unreadable JSON means no drinks
+    try:
+        items = json.loads(raw or '[]')
+    except ValueError:
+        return []
+    return [it for it in items if isinstance(it, dict)] if isinstance(items, list) else []
+
+
+def _serialize(row, window_end, window_start):
+    items = _items(row.items)
+    on_board = (row.status in BOARD_STATUSES and row.pickup_time is not None
+                and window_start <= row.pickup_time < window_end)
+    return {
+        'id': row.id,
+        'pickup_time': row.pickup_time.strftime('%Y-%m-%d %H:%M') if row.pickup_time else None,
+        'status': row.status,
+        'customer': row.username,
+        'drinks': [' / '.join(str(it.get(k) or '?').replace('_', ' ').title() for k in ('flavour', 'thick', 'topping'))
+                   for it in items],
+        # False tells an incrementally refreshing board to drop the card
+        'on_board': on_board,
+    }
+
+
+def _window(minutes, now):
+    return now - timedelta(minutes=OVERDUE_MINUTES), now + timedelta(minutes=minutes)
+
+
+def board(location, minutes=DEFAULT_WINDOW_MINUTES, session=None, now=None):
+    """Full board for a location: orders due in the next `minutes`, earliest pickup first.
+
+    A range scan of ix_orders_location_status_pickup per board status; only the
+    handful of matching rows are read from the table.
+    """
+    from models import Order, User
+    session = session or db.session
+    now = now or datetime.utcnow()
+    start, end = _window(minutes, now)
+    rows = session.query(*_board_columns()).outerjoin(User, User.id == Order.user_id).filter(
+        Order.location == location, Order.status.in_(BOARD_STATUSES),
+        Order.pickup_time >= start, Order.pickup_time < end,
+    ).order_by(Order.pickup_time, Order.id).all()
+    return [_serialize(r, end, start) for r in rows], make_cursor(now)
+
+
+def changes_since(location, cursor, minutes=DEFAULT_WINDOW_MINUTES, session=None, now=None):
+    """Cards to add, update or drop since the cursor.
+
+    That is orders at the location written since the cursor (ix_orders_location_updated_at),
+    plus unchanged board orders whose pickup time has since moved into or out of
+    the window (two short ranges of ix_orders_location_status_pickup).
+    """
+    from models import Order, User
+    session = session or db.session
+    now = now or datetime.utcnow()
+    start, end = _window(minutes, now)
+    since = cursor - timedelta(seconds=CURSOR_OVERLAP_SECONDS)
+    prev_start, prev_end = _window(minutes, since)
+    base = session.query(*_board_columns()).outerjoin(User, User.id == Order.user_id)
+    changed = base.filter(Order.location == location, Order.updated_at > since).all()
+    crossed = base.filter(
+        Order.location == location, Order.status.in_(BOARD_STATUSES),
+        or_(and_(Order.pickup_time >= prev_start, Order.pickup_time < start),
+            and_(Order.pickup_time >= prev_end, Order.pickup_time < end)),
+    ).all()
+    rows = {r.id: r for r in crossed + changed}.values()
+    return [_serialize(r, end, start) for r in sorted(rows, key=lambda r: r.id)], make_cursor(now)
+
+
+class TransitionError(ValueError):
+    """The transition request names no orders, too many, or an unknown action."""
+
+
+def transition(action, order_ids=None, location=None, day=None, actor='system', user_id=None, ip=None,
+               session=None, now=None):
+    """Moves the chosen orders that are in one of the action's from-states to its to-state.
+
+    Orders are chosen by id, or by location and pickup day (a whole day's board).
+    One UPDATE ... WHERE status IN (...) RETURNING id does the work, so the state
+    check happens in SQL and an order another manager already moved is simply
+    not matched. One audit entry covers the whole batch and is linked to each order
+    moved, for the order timelines.
+    Returns {'action', 'status', 'updated': [ids], 'skipped': [ids]}.
+    """
+    from models import Order, AuditLog
+    if action not in TRANSITIONS:
+        raise TransitionError(f'unknown action {action!r}; expected one of {", ".join(TRANSITIONS)}')
+    from_statuses, to_status, audit_action = TRANSITIONS[action]
+    session = session or db.session
+    now = now or datetime.utcnow()
+    table = Order.__table__
+
+    conditions = [table.c.status.in_(from_statuses)]
+    if order_ids is not None:
+        if not isinstance(order_ids, list) or not all(isinstance(i, int) and not isinstance(i, bool) for i in order_ids):
+            raise TransitionError('order_ids must be a list of integers')
+        if len(order_ids) > MAX_TRANSITION_IDS:
+            raise TransitionError(f'at most {MAX_TRANSITION_IDS} order ids per call; select by location and day instead')
+        conditions.append(table.c.id.in_(order_ids))
+    elif location and isinstance(day, date):
+        start = datetime.combine(day, datetime.min.time())
+        conditions += [table.c.location == location, table.c.pickup_time >= start,
+                       table.c.pickup_time < start + timedelta(days=1)]
+    else:
+        raise TransitionError('send order_ids, or location and day (YYYY-MM-DD)')
+
+    try:
+        updated = sorted(session.execute(update(table).where(*conditions).values(
+            status=to_status, updated_at=now, version=table.c.version + 1).returning(table.c.id)).scalars().all())
+        skipped = sorted(set(order_ids) - set(updated)) if order_ids is not None else []
+        if updated:
+            audit = AuditLog(action=audit_action, actor=actor, user_id=user_id, ip=ip, details=json.dumps({
+                'count': len(updated), 'order_ids': updated, 'from': list(from_statuses), 'to': to_status,
+                'location': location, 'day': day.isoformat() if isinstance(day, date) else None,
+                'skipped': skipped}))
+            session.add(audit)
+            audit.link(session, 'order', updated)
+        session.commit()
+    except Exception:
+        session.rollback()
+        raise
+    return {'action': action, 'status': to_status, 'updated': updated, 'skipped': skipped}
+
+
+def make_cursor(now):
+    return now.isoformat()
+
+
+def parse_cursor(cursor):
+    try:
+        return datetime.fromisoformat(cursor) if cursor else None
+    except ValueError:
+        return None
+
+
+def locations(session=None):
+    """Distinct pickup locations with orders on or near the board (for the location picker)."""
+    from models import Order
+    session = session or db.session
+    rows = session.query(Order.location).filter(
+        Order.location.isnot(None), Order.location != '', Order.status.in_(BOARD_STATUSES)
+    ).distinct().order_by(Order.location)
+    return [r.location for r in rows]
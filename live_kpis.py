@@ -0,0 +1,199 @@
+import threading
+import time
+from datetime import datetime, timedelta
+
+from sqlalchemy import func
+
+from extensions import db
+
+# Longest window served; one bucket per minute
+WINDOW_MINUTES = 60
+REPORTED_WINDOWS = (5, 15, 60)
+# Each worker re-reads its counters from the database this often (see LiveKPIs)
+RESEED_SECONDS = 60
+_EPOCH = datetime(1970, 1, 1)
+
+
+def _to_timestamp(dt):
+    # Naive UTC datetimes, as stored by the models (datetime.utcnow)
+    return (dt - _EPOCH).total_seconds()
+
+
+class SlidingWindowCounter:
+    """Per-minute ring buffer of event counts and amounts over the last WINDOW_MINUTES.
+
+    Each slot remembers which minute it belongs to, so stale slots are ignored
+    (and overwritten) instead of being cleared by a timer. Reads touch at most
+    WINDOW_MINUTES slots, a fixed cost independent of traffic.
+    """
+
+    def __init__(self, minutes=WINDOW_MINUTES):
+        self.minutes = minutes
+        self._minute = [None] * minutes
+        self._count = [0] * minutes
+        self._amount = [0.0] * minutes
+
+    def add(self, ts, amount=0.0, count=1):
+        minute = int(ts // 60)
+        slot = minute % self.minutes
+        if self._minute[slot] is not None and self._minute[slot] > minute:
+            return  # older than the window; the slot already holds a newer minute
+        if self._minute[slot] != minute:
+            self._minute[slot] = minute
+            self._count[slot] = 0
+            self._amount[slot] = 0.0
+        self._count[slot] += count
+        self._amount[slot] += amount
+
+    def totals(self, window, now):
+        """Returns (count, amount) for events in the last `window` minutes (current minute included)."""
+        current = int(now // 60)
+        oldest = current - min(window, self.minutes) + 1
+        count, amount = 0, 0.0
+        for slot in range(self.minutes):
+            minute = self._minute[slot]
+            if minute is not None and oldest <= minute <= current:
+                count += self._count[slot]
+                amount += self._amount[slot]
+        return count, amount
+
+
+class LiveKPIs:
+    """Thread-safe, in-process dashboard counters.
+
+    Updated from the order and payment-webhook write paths and seeded from the
+    database. Each worker process keeps its own counters and only sees its own
+    writes, so workers drift apart between seeds; reseed_if_stale() re-reads
+    the database every RESEED_SECONDS, which bounds the disagreement.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.orders = SlidingWindowCounter()
+        self.payments = SlidingWindowCounter()
+        self.pending_payments = 0
+        self._revenue_day = None
+        self._revenue_today = 0.0
+        self._orders_day = None
+        self._orders_today = 0
+        self.seeded_at = None
+
+    def _roll_day(self, now):
+        today = datetime.utcfromtimestamp(now).date()
+        if self._revenue_day != today:
+            self._revenue_day, self._revenue_today = today, 0.0
+        if self._orders_day != today:
+            self._orders_day, self._orders_today = today, 0
+        return today
+
+    def record_order_created(self, created_at=None):
+        ts = _to_timestamp(created_at) if created_at else time.time()
+        with self._lock:
+            self.orders.add(ts)
+            if datetime.utcfromtimestamp(ts).date() == self._roll_day(time.time()):
+                self._orders_today += 1
+            self.pending_payments += 1
+
+    def record_payment_confirmed(self, amount, confirmed_at=None, order_confirmed=True):
+        """Counts a successful payment at the time it was confirmed (its 'Payment Received' audit).
+
+        order_confirmed=False for a payment on an order that was already paid:
+        it is revenue, but the order was not in the pending set.
+        """
+        ts = _to_timestamp(confirmed_at) if confirmed_at else time.time()
+        with self._lock:
+            self.payments.add(ts, amount or 0.0)
+            if datetime.utcfromtimestamp(ts).date() == self._roll_day(time.time()):
+                self._revenue_today += amount or 0.0
+            if order_confirmed:
+                self.pending_payments = max(0, self.pending_payments - 1)
+
+    def record_order_left_pending(self, n=1):
+        """For orders leaving 'Pending Payment' without a payment (e.g. expired)."""
+        with self._lock:
+            self.pending_payments = max(0, self.pending_payments - n)
+
+    def snapshot(self, now=None):
+        now = time.time() if now is None else now
+        with self._lock:
+            self._roll_day(now)
+            data = {'generated_at': datetime.utcfromtimestamp(now).isoformat() + 'Z',
+                    'orders_today': self._orders_today,
+                    'revenue_today': round(self._revenue_today, 2),
+                    'pending_payments': self.pending_payments}
+            for window in REPORTED_WINDOWS:
+                count, _ = self.orders.totals(window, now)
+                paid, amount = self.payments.totals(window, now)
+                data[f'orders_last_{window}m'] = count
+                data[f'payments_last_{window}m'] = paid
+                data[f'revenue_last_{window}m'] = round(amount, 2)
+        return data
+
+    def seed(self, session):
+        """Loads the counters from the database: the last hour, today and the pending set."""
+        from models import Order, AuditLog
+        now = datetime.utcnow()
+        day_start = datetime(now.year, now.month, now.day)
+        since = min(day_start, now - timedelta(minutes=WINDOW_MINUTES))
+        minute = func.strftime('%Y-%m-%d %H:%M:00', Order.created_at)
+
+        fresh = LiveKPIs()
+        fresh._roll_day(_to_timestamp(now))
+        window_start = _to_timestamp(now - timedelta(minutes=WINDOW_MINUTES))
+        # Aggregated per minute in SQL; at most a day's worth of minutes come back
+        for bucket, count in session.query(minute, func.count(Order.id)).filter(
+                Order.created_at >= since).group_by(minute):
+            ts = _to_timestamp(datetime.strptime(bucket, '%Y-%m-%d %H:%M:%S'))
+            if ts >= window_start:
+                fresh.orders.add(ts, count=count)
+            if ts >= _to_timestamp(day_start):
+                fresh._orders_today += count
+
+        # Payments count when they were confirmed, as on the live path: the webhook writes
+        # one 'Payment Received' entry per successful payment, at that moment
+        paid_minute = func.strftime('%Y-%m-%d %H:%M:00', AuditLog.created_at)
+        for bucket, count, amount in session.query(
+                paid_minute, func.count(AuditLog.id), func.sum(func.json_extract(AuditLog.details, '$.amount'))).filter(
+                AuditLog.action == 'Payment Received', AuditLog.created_at >= since,
+                func.json_valid(AuditLog.details) == 1).group_by(paid_minute):
+            ts = _to_timestamp(datetime.strptime(bucket, '%Y-%m-%d %H:%M:%S'))
+            if ts >= window_start:
+                fresh.payments.add(ts, amount or 0.0, count=count)
+            if ts >= _to_timestamp(day_start):
+                fresh._revenue_today += amount or 0.0
+
+        fresh.pending_payments = session.query(func.count(Order.id)).filter(
+            Order.status == 'Pending Payment').scalar() or 0
+
+        with self._lock:
+            self.orders, self.payments = fresh.orders, fresh.payments
+            self.pending_payments = fresh.pending_payments
+            self._revenue_day, self._revenue_today = fresh._revenue_day, fresh._revenue_today
+            self._orders_day, self._orders_today = fresh._orders_day, fresh._orders_today
+            self.seeded_at = time.monotonic()
+
+    def reseed_if_stale(self, session):
+        """Re-seeds from the database if the last seed is older than RESEED_SECONDS."""
+        if self.seeded_at is not None and time.monotonic() - self.seeded_at < RESEED_SECONDS:
+            return False
+        self.seed(session)
+        return True
+
+
+def init_live_kpis(app):
+    """Creates the app's counters and seeds them; call once the tables exist."""
+    kpis = LiveKPIs()
+    with app.app_context():
+        try:
+            kpis.seed(db.session)
+        except Exception as e:
+            print('Live KPI seeding failed; counters start empty:', e)
+        finally:
+            db.session.remove()
+    app.extensions['live_kpis'] = kpis
+    return kpis
+
+
+def live_kpis():
+    from flask import current_app
+    return current_app.extensions['live_kpis']
@@ -0,0 +1,110 @@
+import sqlite3
+import os
+
+# The database lives in the project's instance folder, next to this scripts folder
+DB = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'instance', 'milky_shaky.db')
+TABLE = 'audit_logs'
+COLUMNS = {
+    'entity_type': "VARCHAR(40)",
+    'entity_id': "INTEGER",
+    'user_id': "INTEGER",
+    'ip': "VARCHAR(45)",
+}
+# Rows backfilled per transaction, so the app can keep writing while this runs
+CHUNK = 5000
+USER_ACTIONS = ('Login Success', 'Logout', 'User Registered')
+
+# Fills the new columns from the JSON details of existing rows. COALESCE keeps
+# anything already set, so the script can be re-run safely.
+BACKFILL = f"""
+UPDATE audit_logs SET
+    ip = COALESCE(ip, json_extract(details, '$.ip')),
+    user_id = COALESCE(user_id, json_extract(details, '$.user_id'),
+                       (SELECT id FROM users WHERE audit_logs.action = 'Login Failed' AND users.email = audit_logs.actor)),
+    entity_type = COALESCE(entity_type,
+        CASE WHEN json_extract(details, '$.order_id') IS NOT NULL THEN 'order'
+             WHEN action IN ({', '.join('?' for _ in USER_ACTIONS)}) THEN 'user' END),
+    entity_id = COALESCE(entity_id,
+        CASE WHEN json_extract(details, '$.order_id') IS NOT NULL THEN json_extract(details, '$.order_id')
+             WHEN action IN ({', '.join('?' for _ in USER_ACTIONS)}) THEN json_extract(details, '$.user_id') END)
+WHERE id >= ? AND id < ? AND json_valid(details)
+"""
+# A failed login concerns the account whose email was tried, when it exists (as the login view records it)
+FAILED_LOGINS = """
+UPDATE audit_logs SET entity_type = 'user', entity_id = user_id
+WHERE id >= ? AND id < ? AND action = 'Login Failed' AND entity_type IS NULL AND user_id IS NOT NULL
+"""
+# Batch entries list their ids in details; link each one to its orders for the timelines
+LINKS_TABLE = """
+CREATE TABLE IF NOT EXISTS audit_log_entities (
+    audit_log_id INTEGER NOT NULL REFERENCES audit_logs (id),
+    entity_type VARCHAR(40) NOT NULL,
+    entity_id INTEGER NOT NULL,
+    PRIMARY KEY (audit_log_id, entity_type, entity_id)
+)
+"""
+ORDER_BATCH_ACTIONS = ('Orders Preparing', 'Orders Ready', 'Orders Collected', 'Orders Expired', 'Orders Archived')
+ORDER_LINKS = f"""
+INSERT OR IGNORE INTO audit_log_entities (audit_log_id, entity_type, entity_id)
+SELECT audit_logs.id, 'order', ids.value FROM audit_logs, json_each(CASE WHEN json_valid(audit_logs.details) THEN audit_logs.details ELSE '{{}}' END, '$.order_ids') AS ids
+WHERE audit_logs.id >= ? AND audit_logs.id < ? AND audit_logs.action IN ({', '.join('?' for _ in ORDER_BATCH_ACTIONS)})
+  AND ids.type = 'integer'
+"""
+# Expired payments are linked to their orders (hot or archived)
+PAYMENT_LINKS = """
+INSERT OR IGNORE INTO audit_log_entities (audit_log_id, entity_type, entity_id)
+SELECT audit_logs.id, 'order', {table}.order_id FROM audit_logs, json_each(CASE WHEN json_valid(audit_logs.details) THEN audit_logs.details ELSE '{{}}' END, '$.payment_ids') AS ids
+JOIN {table} ON {table}.id = ids.value
+WHERE audit_logs.id >= ? AND audit_logs.id < ? AND audit_logs.action = 'Payments Expired'
+"""
+PAYMENT_TABLES = ('payments', 'payments_archive')
+# Order events only carry the order id; take the customer from the order (hot or archived)
+ORDER_USERS = """
+UPDATE audit_logs SET user_id = (SELECT user_id FROM {table} WHERE {table}.id = audit_logs.entity_id)
+WHERE id >= ? AND id < ? AND entity_type = 'order' AND user_id IS NULL
+"""
+ORDER_TABLES = ('orders', 'orders_archive')
+
+def get_columns(conn, table):
+    cur = conn.execute(f"PRAGMA table_info('{table}')")
+    return [r[1] for r in cur.fetchall()]
+
+def main():
+    if not os.path.exists(DB):
+        print("DB not found at", DB)
+        return
+    conn = sqlite3.connect(DB)
+    try:
+        cols = get_columns(conn, TABLE)
+        for col, definition in COLUMNS.items():
+            if col in cols:
+                print(f"Column '{col}' already exists in {TABLE}.")
+            else:
+                conn.execute(f"ALTER TABLE {TABLE} ADD COLUMN {col} {definition};")
+                print(f"Added column '{col}' to table '{TABLE}'.")
+        conn.execute(LINKS_TABLE)
+        conn.commit()
+        order_tables = [t for t in ORDER_TABLES if get_columns(conn, t)]
+        payment_tables = [t for t in PAYMENT_TABLES if get_columns(conn, t)]
+
+        max_id = conn.execute(f"SELECT COALESCE(MAX(id), 0) FROM {TABLE}").fetchone()[0]
+        filled = 0
+        for low in range(0, max_id + 1, CHUNK):
+            cur = conn.execute(BACKFILL, USER_ACTIONS + USER_ACTIONS + (low, low + CHUNK))
+            filled += cur.rowcount
+            for table in order_tables:
+                conn.execute(ORDER_USERS.format(table=table), (low, low + CHUNK))
+            conn.execute(FAILED_LOGINS, (low, low + CHUNK))
+            conn.execute(ORDER_LINKS, (low, low + CHUNK) + ORDER_BATCH_ACTIONS)
+            for table in payment_tables:
+                conn.execute(PAYMENT_LINKS.format(table=table), (low, low + CHUNK))
+            conn.commit()
+        print(f"Backfilled {filled} audit rows. The audit indexes are created on the next app start.")
+    except Exception as e:
+        print("Migration failed:", e)
+        conn.rollback()
+    finally:
+        conn.close()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,40 @@
+import sqlite3
+import os
+
+# The database lives in the project's instance folder, next to this scripts folder
+DB = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'instance', 'milky_shaky.db')
+TABLES = ('orders', 'orders_archive')
+COL = 'updated_at'
+DEFINITION = "DATETIME"
+
+def get_columns(conn, table):
+    cur = conn.execute(f"PRAGMA table_info('{table}')")
+    return [r[1] for r in cur.fetchall()]
+
+def main():
+    if not os.path.exists(DB):
+        print("DB not found at", DB)
+        return
+    conn = sqlite3.connect(DB)
+    try:
+        for table in TABLES:
+            cols = get_columns(conn, table)
+            if not cols:
+                print(f"Table '{table}' does not exist yet; create_all() will create it.")
+            elif COL in cols:
+                print(f"Column '{COL}' already exists in {table}.")
+            else:
+                conn.execute(f"ALTER TABLE {table} ADD COLUMN {COL} {DEFINITION};")
+                # Existing rows: last change unknown, use the creation time
+                conn.execute(f"UPDATE {table} SET {COL} = created_at WHERE {COL} IS NULL;")
+                print(f"Added column '{COL}' to table '{table}'.")
+        conn.commit()
+        print("Migration complete. The kitchen board indexes are created on the next app start.")
+    except Exception as e:
+        print("Migration failed:", e)
+        conn.rollback()
+    finally:
+        conn.close()
+
+if __name__ == '__main__':
+    main()
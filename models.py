@@ -1,13 +1,25 @@
 from datetime import datetime
 from flask_login import UserMixin
-from sqlalchemy import Column, Integer, String, DateTime, ForeignKey, Float, Text
+from sqlalchemy import Column, Integer, String, DateTime, Date, ForeignKey, Float, Text, Index, UniqueConstraint
 from sqlalchemy.orm import relationship
 from extensions import db, bcrypt
 import json
+import time
 
 
 
 VAT_RATE = 0.15  # 15%
+LOOKUP_CACHE_TTL = 30  # seconds a cached price/config snapshot stays valid
+# Order statuses that never became a purchase (excluded from the loyalty discount)
+UNPAID_ORDER_STATUSES = ('Pending Payment', 'Expired')
+# Finished orders that the tiering job may move to the archive tables
+ARCHIVABLE_ORDER_STATUSES = ('Confirmed', 'Collected')
+
+
+def invalidate_lookup_cache():
+    """Drops the cached price/config snapshot; call after any Product or Config write."""
+    from flask import current_app
+    current_app.extensions.pop('lookup_cache', None)
 
 # Simple User model
 class User(UserMixin, db.Model):
@@ -30,8 +42,13 @@ class User(UserMixin, db.Model):
         return f'<User {self.username}>'
 
     def completed_orders_count(self):
-        # consider all non-pending payment orders as past purchases
-        return sum(1 for o in getattr(self, 'orders', []) if o.status != 'Pending Payment')
+        # consider all paid (non-pending, non-expired) orders as past purchases;
+        # counted in SQL rather than by lazy-loading every order of the user
+        # (archived orders are all completed, so they count too)
+        from sqlalchemy import func
+        return sum(db.session.query(func.count(model.id)).filter(
+            model.user_id == self.id, model.status.notin_(UNPAID_ORDER_STATUSES)).scalar() or 0
+            for model in (Order, ArchivedOrder))
     @property
     def is_manager(self):
         return self.role == 'manager'
@@ -61,8 +78,8 @@ class Product(db.Model):
     def __repr__(self):
         return f'<Product {self.type}: {self.name} R{self.value}>'
 
-class Order(db.Model):
-    __tablename__ = 'orders'
+# Columns shared by the live orders table and its archive (see archive.py)
+class OrderColumns:
     id = Column(Integer, primary_key=True)
     user_id = Column(Integer, ForeignKey('users.id'))
     created_at = Column(DateTime, default=datetime.utcnow)
@@ -74,7 +91,10 @@ class Order(db.Model):
     vat = Column(Float, default=0.0)
     discount = Column(Float, default=0.0)
     status = Column(String(50), default='Pending Payment')
-    user = relationship('User', backref='orders')
+    # Bumped on every change (ORM and Core updates); drives the kitchen board refresh
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    # Optimistic concurrency: every write bumps it and checks the value it read (see payment_events.py)
+    version = Column(Integer, nullable=False, default=1, server_default='1')
 
     def set_items(self, items_list):
         self.items = json.dumps(items_list)
@@ -84,11 +104,41 @@ class Order(db.Model):
             return json.loads(self.items or "[]")
         except Exception:
             return []
+
+class Order(OrderColumns, db.Model):
+    __tablename__ = 'orders'
+    user = relationship('User', backref='orders')
+
+    __table_args__ = (
+        # status filters and the expiry sweep (oldest pending first)
+        Index('ix_orders_status_created_at', 'status', 'created_at'),
+        # customer order history, newest first (keyset pagination)
+        Index('ix_orders_user_created_at', 'user_id', 'created_at', 'id'),
+        # kitchen board: a store's confirmed orders by pickup time, and its recent changes
+        Index('ix_orders_location_status_pickup', 'location', 'status', 'pickup_time'),
+        Index('ix_orders_location_updated_at', 'location', 'updated_at'),
+        # latest change to any order (cohort report cache key)
+        Index('ix_orders_updated_at', 'updated_at'),
+    )
+    # ORM flushes also compare-and-set on version (StaleDataError if it moved)
+    __mapper_args__ = {'version_id_col': OrderColumns.version}
         
     @staticmethod
-    def _get_lookup_cache():
-        """Fetches and caches prices/configs from the database."""
-        # This is a rudimentary cache; a real app might use Flask-Caching.
+    def _get_lookup_cache(fresh=False):
+        """Fetches and caches prices/configs from the database.
+
+        fresh=True always reads the catalog (and refreshes the cache); order
+        creation uses it, since the price it computes is the one charged.
+        """
+        # This is a rudimentary per-process cache; a real app might use Flask-Caching.
+        # Catalog writes call invalidate_lookup_cache(), but only in their own
+        # process; the TTL bounds how long other workers keep an older snapshot,
+        # so cached prices are only used for previews and quotes.
+        from flask import current_app
+        cached = current_app.extensions.get('lookup_cache')
+        if not fresh and cached and time.monotonic() - cached[0] < LOOKUP_CACHE_TTL:
+            return cached[1]
+
         cache = {
             'prices': {}, # Key: "type_name", Value: price
             'vat_rate': 0.15
@@ -114,15 +164,56 @@ class Order(db.Model):
                 except (ValueError, TypeError):
                     pass # Default to 0.15 if parsing fails
         
+        current_app.extensions['lookup_cache'] = (time.monotonic(), cache)
         return cache
 
     @staticmethod
-    def compute_totals_for_items(items, user=None):
+    def price_item(item, prices):
+        """Returns (price, problems) for one drink; problems are messages without the item number."""
+        flavour = item.get('flavour') or ''
+        thick = item.get('thick') or ''
+        topping = item.get('topping') or ''
+
+        # --- Perform Price Lookup from Cache ---
+        # Construct lookup keys based on submitted item names
+        fprice = prices.get(f"flavour_{flavour}", 0.0)
+        cprice = prices.get(f"consistency_{thick}", 0.0)
+        tprice = prices.get(f"topping_{topping}", 0.0)
+
+        # Validation checks
+        problems = []
+        if not flavour or fprice == 0.0:
+            problems.append(f'invalid flavour: {flavour}')
+        if not thick or cprice == 0.0:
+            problems.append(f'invalid consistency: {thick}')
+        if topping is None or tprice == 0.0: # Check for None or missing topping, assumes 'none' is a valid topping with price 0
+             # Only error if topping is completely missing and it's not the 'none' entry
+             if topping is None or (topping.lower() != 'none' and tprice == 0.0):
+                 problems.append(f'invalid topping: {topping}')
+
+        return float(fprice) + float(cprice) + float(tprice), problems
+
+    @staticmethod
+    def totals(subtotal, completed_orders, vat_rate):
+        """Returns unrounded (discount, vat, total) for a subtotal under the discount policy."""
+        # frequent customer discount policy:
+        # example policy: 5% discount if user has 3+ completed orders
+        discount = 0.05 * subtotal if completed_orders is not None and completed_orders >= 3 else 0.0
+        vat = (subtotal - discount) * vat_rate
+        total = subtotal - discount + vat
+        return discount, vat, total
+
+    @staticmethod
+    def compute_totals_for_items(items, user=None, lookup_cache=None, completed_orders=None):
         """
         Validate items and compute subtotal, vat, discount, total using DB lookups.
+
+        Batch callers (e.g. repricing) can pass a pre-loaded lookup_cache and the
+        user's completed_orders count so no query runs per order.
         """
         # Load the dynamic prices and configs
-        lookup_cache = Order._get_lookup_cache()
+        if lookup_cache is None:
+            lookup_cache = Order._get_lookup_cache()
         
         errors = []
         subtotal = 0.0
@@ -130,50 +221,18 @@ class Order(db.Model):
         
         # --- 1. Validate items and compute price ---
         for idx, it in enumerate(items, start=1):
-            flavour = it.get('flavour') or ''
-            thick = it.get('thick') or ''
-            topping = it.get('topping') or ''
-            
-            # Construct lookup keys based on submitted item names
-            fkey = f"flavour_{flavour}"
-            ckey = f"consistency_{thick}"
-            tkey = f"topping_{topping}"
-            
-            # --- Perform Price Lookup from Cache ---
-            fprice = lookup_cache['prices'].get(fkey, 0.0)
-            cprice = lookup_cache['prices'].get(ckey, 0.0)
-            tprice = lookup_cache['prices'].get(tkey, 0.0)
-
-            # Validation checks
-            if not flavour or fprice == 0.0:
-                errors.append(f'Item {idx}: invalid flavour: {flavour}')
-            if not thick or cprice == 0.0:
-                errors.append(f'Item {idx}: invalid consistency: {thick}')
-            if topping is None or tprice == 0.0: # Check for None or missing topping, assumes 'none' is a valid topping with price 0
-                 # Only error if topping is completely missing and it's not the 'none' entry
-                 if topping is None or (topping.lower() != 'none' and tprice == 0.0):
-                     errors.append(f'Item {idx}: invalid topping: {topping}')
-
-            price = float(fprice) + float(cprice) + float(tprice)
+            price, problems = Order.price_item(it, lookup_cache['prices'])
+            errors.extend(f'Item {idx}: {p}' for p in problems)
             subtotal += price
             items_out.append({**it, 'price': price})
             
         # --- 2. Calculate Discount, VAT, Total ---
-        
-        # frequent customer discount policy:
-        discount = 0.0
-        if user is not None:
+        if completed_orders is None and user is not None:
             try:
-                completed = user.completed_orders_count()
-                # example policy: 5% discount if user has 3+ completed orders
-                if completed >= 3:
-                    discount = 0.05 * subtotal
+                completed_orders = user.completed_orders_count()
             except Exception:
-                discount = 0.0
-        
-        vat_rate = lookup_cache['vat_rate']
-        vat = (subtotal - discount) * vat_rate
-        total = subtotal - discount + vat
+                completed_orders = None
+        discount, vat, total = Order.totals(subtotal, completed_orders, lookup_cache['vat_rate'])
         valid = len(errors) == 0
         
         return valid, errors, round(subtotal,2), round(vat,2), round(discount,2), round(total,2), items_out
@@ -188,16 +247,124 @@ class AuditLog(db.Model):
     actor = Column(String(120))
     details = Column(Text, nullable=True)
     created_at = Column(DateTime, default=datetime.utcnow)
+    # Copied out of details at write time so lookups use an index instead of parsing JSON
+    entity_type = Column(String(40), nullable=True)  # 'order', 'user'
+    entity_id = Column(Integer, nullable=True)
+    user_id = Column(Integer, nullable=True)
+    ip = Column(String(45), nullable=True)
 
-class Payment(db.Model):
-    __tablename__ = 'payments'
+    __table_args__ = (
+        # per-order / per-user timelines
+        Index('ix_audit_logs_entity', 'entity_type', 'entity_id', 'created_at'),
+        Index('ix_audit_logs_user_created_at', 'user_id', 'created_at'),
+        # e.g. failed logins from one address
+        Index('ix_audit_logs_ip_action_created_at', 'ip', 'action', 'created_at'),
+        # recent entries of one action (live KPI seeding counts 'Payment Received')
+        Index('ix_audit_logs_action_created_at', 'action', 'created_at'),
+    )
+
+    def link(self, session, entity_type, entity_ids):
+        """Files this (batch) entry under every one of entity_ids too, e.g. each order a kitchen move touched."""
+        entity_ids = sorted(set(entity_ids))
+        if not entity_ids:
+            return
+        session.flush()  # assigns self.id
+        session.execute(AuditLogEntity.__table__.insert(), [
+            {'audit_log_id': self.id, 'entity_type': entity_type, 'entity_id': entity_id} for entity_id in entity_ids])
+
+class AuditLogEntity(db.Model):
+    # Batch entries (kitchen moves, expiry, archiving) concern many orders; one row per order
+    # lets a timeline find them with an index range instead of parsing every batch's JSON
+    __tablename__ = 'audit_log_entities'
+    audit_log_id = Column(Integer, ForeignKey('audit_logs.id'), primary_key=True)
+    entity_type = Column(String(40), primary_key=True)
+    entity_id = Column(Integer, primary_key=True)
+
+    __table_args__ = (
+        Index('ix_audit_log_entities_entity', 'entity_type', 'entity_id'),
+    )
+
+class PaymentColumns:
     id = Column(Integer, primary_key=True)
-    order_id = Column(Integer, ForeignKey('orders.id'), nullable=False)
     amount = Column(Float, nullable=False)
     provider = Column(String(80), nullable=False, default='simulated_gateway')
     provider_ref = Column(String(128), nullable=True, unique=True)
-    status = Column(String(30), nullable=False, default='Pending')  # Pending, Success, Failed
+    status = Column(String(30), nullable=False, default='Pending')  # Pending, Success, Failed, Expired
+    created_at = Column(DateTime, default=datetime.utcnow)
+    version = Column(Integer, nullable=False, default=1, server_default='1')
+
+class Payment(PaymentColumns, db.Model):
+    __tablename__ = 'payments'
+    order_id = Column(Integer, ForeignKey('orders.id'), nullable=False)
+
+    __table_args__ = (
+        Index('ix_payments_status_created_at', 'status', 'created_at'),
+    )
+    __mapper_args__ = {'version_id_col': PaymentColumns.version}
+
+    def __repr__(self):
+        return f'<Payment {self.id} order={self.order_id} amount={self.amount} status={self.status}>'
+
+# Cold tier: completed orders (and their payments) older than ARCHIVE_AFTER_MONTHS,
+# moved out of the hot tables by archive.py. Same columns; ids are kept.
+class ArchivedOrder(OrderColumns, db.Model):
+    __tablename__ = 'orders_archive'
+
+    __table_args__ = (
+        Index('ix_orders_archive_user_created_at', 'user_id', 'created_at', 'id'),
+        Index('ix_orders_archive_created_at', 'created_at'),
+        Index('ix_orders_archive_updated_at', 'updated_at'),
+    )
+
+    def __repr__(self):
+        return f'<ArchivedOrder {self.id} user={self.user_id} total={self.total} status={self.status}>'
+
+class ArchivedPayment(PaymentColumns, db.Model):
+    __tablename__ = 'payments_archive'
+    order_id = Column(Integer, ForeignKey('orders_archive.id'), nullable=False)
+
+    __table_args__ = (
+        Index('ix_payments_archive_order_id', 'order_id'),
+    )
+
+    def __repr__(self):
+        return f'<ArchivedPayment {self.id} order={self.order_id} amount={self.amount} status={self.status}>'
+
+# Confirmed sales per product and per flavour/consistency/topping combination,
+# bucketed by order day and pickup location (maintained by popularity.py)
+class ProductSale(db.Model):
+    __tablename__ = 'product_sales'
+    id = Column(Integer, primary_key=True)
+    day = Column(Date, nullable=False)
+    location = Column(String(255), nullable=False, default='')
+    kind = Column(String(20), nullable=False)  # flavour, thick, topping or combo
+    key = Column(String(255), nullable=False)  # product key, or 'flavour|thick|topping' for combos
+    quantity = Column(Integer, nullable=False, default=0)
+
+    __table_args__ = (
+        UniqueConstraint('day', 'location', 'kind', 'key', name='uq_product_sales_bucket'),
+        # Covers the top-N query (kind + day range, summed per key) without touching the table
+        Index('ix_product_sales_kind_day', 'kind', 'day', 'key', 'quantity'),
+    )
+
+    def __repr__(self):
+        return f'<ProductSale {self.day} {self.location} {self.kind}={self.key} x{self.quantity}>'
+# Results of form/API submissions by idempotency key, so a retried or double-tapped
+# request replays the first result instead of writing again (see idempotency.py)
+class IdempotencyKey(db.Model):
+    __tablename__ = 'idempotency_keys'
+    id = Column(Integer, primary_key=True)
+    user_id = Column(Integer, nullable=False)
+    scope = Column(String(40), nullable=False)  # 'order', 'payment:<order id>'
+    key = Column(String(64), nullable=False)
+    result = Column(Text, nullable=False)  # JSON, e.g. {"order_id": 12}
     created_at = Column(DateTime, default=datetime.utcnow)
+    expires_at = Column(DateTime, nullable=False)
+
+    __table_args__ = (
+        UniqueConstraint('user_id', 'scope', 'key', name='uq_idempotency_keys_key'),
+        Index('ix_idempotency_keys_expires_at', 'expires_at'),
+    )
 
     def __repr__(self):
-        return f'<Payment {self.id} order={self.order_id} amount={self.amount} status={self.status}>'
\ No newline at end of file
+        return f'<IdempotencyKey {self.scope}:{self.key} user={self.user_id}>'
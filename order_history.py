@@ -0,0 +1,64 @@
+import base64
+from datetime import datetime
+
+from sqlalchemy import and_, or_, tuple_
+
+from extensions import db
+
+PAGE_SIZE = 20
+
+
+def encode_cursor(created_at, order_id):
+    # created_at is nullable (older rows); an empty timestamp stands for NULL
+    raw = f"{created_at.isoformat() if created_at is not None else ''}|{order_id}"
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip('=')
+
+
+def decode_cursor(cursor):
+    """Returns (created_at, id) or None for a missing/garbled cursor; created_at may be None."""
+    if not cursor:
+        return None
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)).decode()
+        created_at, order_id = raw.rsplit('|', 1)
+        return (datetime.fromisoformat(created_at) if created_at else None), int(order_id)
+    except (ValueError, UnicodeDecodeError):
+        return None
+
+
+def _after(model, position):
+    """Rows after `position` in (created_at DESC, id DESC) order; SQLite sorts NULL created_at last."""
+    created_at, order_id = position
+    if created_at is None:
+        return and_(model.created_at.is_(None), model.id < order_id)
+    return or_(tuple_(model.created_at, model.id) < tuple_(created_at, order_id), model.created_at.is_(None))
+
+
+def order_history_page(user_id, cursor=None, page_size=PAGE_SIZE, session=None):
+    """Returns (rows, next_cursor) for one page of a customer's orders, newest first.
+
+    Keyset pagination on (created_at, id) walks ix_orders_user_created_at (and its
+    archive twin), so page 50 costs the same as page 1, and only the columns the list shows are read:
+    the items JSON stays in the database until the detail page asks for it.
+    """
+    from models import Order, ArchivedOrder
+    from archive import merge_newest_first
+    session = session or db.session
+    position = decode_cursor(cursor)
+    tiers = []
+    # Same keyset on the hot table and the archive, merged; once a customer's
+    # recent orders run out only the archive index is doing any work
+    for model in (Order, ArchivedOrder):
+        q = session.query(
+            model.id, model.created_at, model.status, model.pickup_time, model.location, model.total
+        ).filter(model.user_id == user_id)
+        if position is not None:
+            q = q.filter(_after(model, position))
+        # One extra row tells us whether there is another page
+        tiers.append(q.order_by(model.created_at.desc(), model.id.desc()).limit(page_size + 1).all())
+    rows = merge_newest_first(tiers, page_size + 1)
+    next_cursor = None
+    if len(rows) > page_size:
+        rows = rows[:page_size]
+        next_cursor = encode_cursor(rows[-1].created_at, rows[-1].id)
+    return rows, next_cursor
@@ -0,0 +1,308 @@
+"""Applies payment-gateway webhook events with optimistic concurrency.
+
+    python payment_events.py --stress [PAYMENTS] [--threads N] [--processes N]
+
+Webhooks for one payment can arrive together (gateway retries, duplicates, a
+late 'Failed' from an earlier attempt), and webhooks for different payments
+should not queue behind each other. No row is locked while an event is
+decided: the payment and order are read, the next state is worked out, and the
+write is a compare-and-set
+
+    UPDATE payments SET status = ?, version = version + 1 WHERE id = ? AND version = ?
+
+(the same for the order). If another event got there first the UPDATE matches
+no row, the transaction is rolled back and the event is re-read and re-decided,
+a bounded number of times. The state machine makes the re-decision safe:
+Success is final, so a replayed or out-of-order 'Failed' can never undo a
+confirmation, and a duplicate Success finds nothing left to do.
+"""
+import json
+import multiprocessing
+import os
+import random
+import secrets
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter
+from contextlib import redirect_stdout
+from datetime import datetime, timedelta
+
+from sqlalchemy import update
+from sqlalchemy.exc import OperationalError
+
+# Webhook status -> payment statuses it may replace. Anything else is stale.
+PAYMENT_TRANSITIONS = {
+    'Success': ('Pending', 'Failed', 'Expired'),
+    'Failed': ('Pending',),
+}
+# Compare-and-set attempts per event before the gateway is asked to redeliver
+MAX_ATTEMPTS = 5
+# Upper bound of the random pause before attempt n is n * BACKOFF_SECONDS
+BACKOFF_SECONDS = 0.005
+# Sent with 503 when every attempt lost its race (the gateway honours it)
+RETRY_AFTER_SECONDS = 1
+
+
+class Conflict(Exception):
+    """The row changed between the read and the compare-and-set."""
+
+
+def compare_and_set(session, model, row_id, version, **values):
+    """Updates one row only if it still has `version`, and bumps the version.
+
+    Raises Conflict when no row matched, i.e. someone else wrote it first.
+    """
+    table = model.__table__
+    result = session.execute(update(table).where(table.c.id == row_id, table.c.version == version)
+                             .values(version=table.c.version + 1, **values))
+    if result.rowcount != 1:
+        raise Conflict(f'{table.name} {row_id} is no longer at version {version}')
+
+
+def _is_lock_error(error):
+    # A concurrent writer held the database past busy_timeout; same remedy as a lost race
+    message = str(getattr(error, 'orig', error)).lower()
+    return 'locked' in message or 'busy' in message
+
+
+def _apply_once(session, provider_ref, new_status, ip):
+    from models import Payment, Order, AuditLog, UNPAID_ORDER_STATUSES
+    from popularity import record_sale
+    payment = session.query(Payment).filter_by(provider_ref=provider_ref).first()
+    if payment is None:
+        return {'outcome': 'not_found'}
+    if payment.status == new_status:
+        return {'outcome': 'duplicate'}
+    if payment.status not in PAYMENT_TRANSITIONS[new_status]:
+        return {'outcome': 'stale'}
+
+    compare_and_set(session, Payment, payment.id, payment.version, status=new_status)
+    order = session.get(Order, payment.order_id)
+    newly_confirmed = False
+    if order is not None and new_status == 'Success':
+        # a Success after the kitchen has started must not move the order back to 'Confirmed'
+        if order.status in UNPAID_ORDER_STATUSES:
+            compare_and_set(session, Order, order.id, order.version, status='Confirmed',
+                            updated_at=datetime.utcnow())
+            # product/combo sales counters move in the same transaction as the confirmation
+            record_sale(session, order)
+            newly_confirmed = True
+        session.add(AuditLog(action='Payment Received', actor='system',
+                             details=json.dumps({'order_id': order.id, 'payment_id': payment.id, 'amount': payment.amount}),
+                             entity_type='order', entity_id=order.id, user_id=order.user_id, ip=ip))
+    elif order is not None:
+        session.add(AuditLog(action='Payment Failed', actor='system',
+                             details=json.dumps({'order_id': order.id, 'payment_id': payment.id}),
+                             entity_type='order', entity_id=order.id, user_id=order.user_id, ip=ip))
+    session.commit()
+    return {'outcome': 'applied', 'newly_confirmed': newly_confirmed, 'amount': payment.amount,
+            'order_id': order.id if order is not None else None,
+            'user_email': getattr(order.user, 'email', None) if order is not None else None}
+
+
+def apply_payment_event(session, provider_ref, new_status, ip=None):
+    """Applies one webhook event; returns a dict with 'outcome' and 'attempts'.
+
+    Outcomes: 'applied' (committed), 'duplicate' (already in that state),
+    'stale' (superseded, e.g. 'Failed' after 'Success'), 'not_found', or
+    'conflict' when all MAX_ATTEMPTS lost their race. Only 'applied' writes.
+    """
+    if new_status not in PAYMENT_TRANSITIONS:
+        raise ValueError(f'unknown payment status {new_status!r}')
+    for attempt in range(1, MAX_ATTEMPTS + 1):
+        try:
+            result = _apply_once(session, provider_ref, new_status, ip)
+            if result['outcome'] != 'applied':
+                # nothing to write; end the read transaction
+                session.rollback()
+            result['attempts'] = attempt
+            return result
+        except Conflict:
+            session.rollback()
+        except OperationalError as e:
+            session.rollback()
+            if not _is_lock_error(e):
+                raise
+        time.sleep(random.uniform(0, BACKOFF_SECONDS * attempt))
+    return {'outcome': 'conflict', 'attempts': MAX_ATTEMPTS}
+
+
+# --- Stress test ---
+
+def _seed(app, n):
+    """n pending orders with one pending payment each; returns [(order_id, provider_ref)]."""
+    from extensions import db
+    from models import Order, Payment, User
+    with app.app_context():
+        user = User(username='webhook-stress', email='webhook-stress@example.com', password_hash='x')
+        db.session.add(user)
+        db.session.commit()
+        now = datetime.utcnow()
+        item = {'flavour': 'vanilla', 'thick': 'thick', 'topping': 'nuts', 'price': 30.0}
+        db.session.execute(Order.__table__.insert(), [
+            {'user_id': user.id, 'created_at': now, 'pickup_time': now + timedelta(hours=1), 'location': 'Stress',
+             'items': json.dumps([item]), 'status': 'Pending Payment',
+             'subtotal': 30.0, 'vat': 4.5, 'discount': 0.0, 'total': 34.5}
+            for _ in range(n)
+        ])
+        order_ids = [row.id for row in db.session.query(Order.id).filter(Order.user_id == user.id).order_by(Order.id)]
+        refs = [secrets.token_urlsafe(24) for _ in order_ids]
+        db.session.execute(Payment.__table__.insert(), [
+            {'order_id': oid, 'amount': 34.5, 'provider': 'simulated_gateway', 'provider_ref': ref,
+             'status': 'Pending', 'created_at': now}
+            for oid, ref in zip(order_ids, refs)
+        ])
+        db.session.commit()
+    return list(zip(order_ids, refs))
+
+
+def _plan(refs, seed):
+    """Conflicting events per payment: most succeed amid duplicates and stale failures."""
+    rng = random.Random(seed)
+    plans, events = {}, []
+    for ref in refs:
+        if rng.random() < 0.2:
+            plan = ['Failed'] * rng.randint(1, 3)
+        else:
+            plan = ['Success'] * rng.randint(1, 3) + ['Failed'] * rng.randint(1, 3)
+        plans[ref] = plan
+        events.extend((ref, status) for status in plan)
+    rng.shuffle(events)
+    return plans, events
+
+
+def _fire(database_uri, events, threads, start_at=None):
+    """Posts events to /payments/webhook from `threads` threads; returns (status codes, CAS attempts)."""
+    from app import create_app
+    with redirect_stdout(open(os.devnull, 'w')):
+        app = create_app({'SQLALCHEMY_DATABASE_URI': database_uri, 'SWEEPER_ENABLED': False,
+                          'RATE_LIMIT_ENABLED': False})
+    codes, attempts = Counter(), Counter()
+    lock = threading.Lock()
+
+    def worker(chunk):
+        client = app.test_client()
+        local_codes, local_attempts = Counter(), Counter()
+        for ref, status in chunk:
+            for _ in range(10):
+                response = client.post('/payments/webhook', json={'provider_ref': ref, 'status': status})
+                local_codes[response.status_code] += 1
+                local_attempts[int(response.headers.get('X-Webhook-Attempts', 0))] += 1
+                # redeliver like the gateway does
+                if response.status_code != 503:
+                    break
+        with lock:
+            codes.update(local_codes)
+            attempts.update(local_attempts)
+
+    if start_at is not None:
+        time.sleep(max(0.0, start_at - time.time()))
+    pool = [threading.Thread(target=worker, args=(events[i::threads],)) for i in range(threads)]
+    with redirect_stdout(open(os.devnull, 'w')):
+        for t in pool:
+            t.start()
+        for t in pool:
+            t.join()
+    return codes, attempts
+
+
+def _fire_in_process(args):
+    return _fire(*args)
+
+
+def _check(app, plans):
+    """Problems with the final state, as text lines (empty when every invariant holds)."""
+    from extensions import db
+    from models import AuditLog, Order, Payment, ProductSale
+    from popularity import COMBO
+    from sqlalchemy import func
+    problems = []
+    with app.app_context():
+        rows = db.session.query(Payment.provider_ref, Payment.status, Payment.version, Order.id, Order.status,
+                                Order.version).join(Order, Order.id == Payment.order_id).all()
+        received = Counter(order_id for (order_id,) in db.session.query(AuditLog.entity_id).filter(
+            AuditLog.action == 'Payment Received'))
+        sold = db.session.query(func.coalesce(func.sum(ProductSale.quantity), 0)).filter(
+            ProductSale.kind == COMBO, ProductSale.location == 'Stress').scalar()
+    wrong = Counter()
+    for ref, p_status, p_version, order_id, o_status, o_version in rows:
+        succeeded = 'Success' in plans[ref]
+        wrong['payment status'] += p_status != ('Success' if succeeded else 'Failed')
+        wrong['order status'] += o_status != ('Confirmed' if succeeded else 'Pending Payment')
+        wrong['Payment Received audits'] += received[order_id] != (1 if succeeded else 0)
+        # Pending -> Success, or Pending -> Failed -> Success; the order moves once at most
+        wrong['payment version'] += p_version not in ((2, 3) if succeeded else (2,))
+        wrong['order version'] += o_version != (2 if succeeded else 1)
+    for what, n in wrong.items():
+        if n:
+            problems.append(f'{n} payments with a wrong {what}')
+    confirmed = sum(1 for plan in plans.values() if 'Success' in plan)
+    if sold != confirmed:
+        problems.append(f'product_sales counts {sold} drinks for {confirmed} confirmed orders')
+    return problems
+
+
+def stress(n_payments=2000, threads=16, processes=1, seed=1):
+    """Fires conflicting webhook events for n_payments at once and checks the outcome."""
+    from app import create_app
+    from reset_db import insert_initial_data
+    import sqlite3
+
+    workdir = tempfile.mkdtemp(prefix='webhook_stress_')
+    path = os.path.join(workdir, 'stress.db')
+    uri = 'sqlite:///' + path
+    with redirect_stdout(open(os.devnull, 'w')):
+        app = create_app({'SQLALCHEMY_DATABASE_URI': uri, 'SWEEPER_ENABLED': False})
+    conn = sqlite3.connect(path)
+    insert_initial_data(conn)
+    conn.commit()
+    conn.close()
+    sessions = _seed(app, n_payments)
+    plans, events = _plan([ref for _, ref in sessions], seed)
+    print(f"Firing {len(events)} webhook events for {n_payments} payments "
+          f"from {processes} process(es) x {threads} threads")
+
+    if processes <= 1:
+        started = time.time()
+        codes, attempts = _fire(uri, events, threads)
+    else:
+        # each process builds its own app and engine first; they start together so the events really collide
+        started = time.time() + 5.0
+        with multiprocessing.get_context('spawn').Pool(processes) as pool:
+            results = pool.map(_fire_in_process, [(uri, events[i::processes], threads, started)
+                                                  for i in range(processes)])
+        codes, attempts = sum((r[0] for r in results), Counter()), sum((r[1] for r in results), Counter())
+    elapsed = time.time() - started
+
+    problems = _check(app, plans)
+    retried = sum(n for a, n in attempts.items() if a > 1)
+    print(f"  elapsed:   {elapsed:.2f} s ({len(events) / elapsed:.0f} events/s)")
+    print(f"  responses: {dict(sorted(codes.items()))}")
+    print(f"  attempts:  {dict(sorted(attempts.items()))} ({retried} events needed a retry)")
+    print(f"  invariants: {'all hold' if not problems else 'VIOLATED'}")
+    for problem in problems:
+        print(f"    {problem}")
+    return problems
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    if argv[:1] != ['--stress']:
+        print("usage: python payment_events.py --stress [PAYMENTS] [--threads N] [--processes N]")
+        return 1
+    args = argv[1:]
+    options = {'threads': 16, 'processes': 1}
+    for name in options:
+        flag = f'--{name}'
+        if flag in args:
+            i = args.index(flag)
+            options[name] = int(args[i + 1])
+            del args[i:i + 2]
+    problems = stress(int(args[0]) if args else 2000, **options)
+    return 1 if problems else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,149 @@
+import json
+import sys
+from collections import Counter
+from datetime import date, datetime, timedelta
+
+from sqlalchemy import func
+from sqlalchemy.dialects.sqlite import insert
+
+from extensions import db
+
+KINDS = ('flavour', 'thick', 'topping')
+COMBO = 'combo'
+REBUILD_CHUNK = 2000
+# Days of sales the order form looks at when pre-filling a popular combination
+POPULAR_PICK_DAYS = 30
+
+
+def combo_key(item):
+    return '|'.join(str(item.get(k) or '').strip().lower() for k in KINDS)
+
+
+def sale_counts(items):
+    """Counter of (kind, key) -> drinks for one order's items (anything but a list of dicts counts nothing)."""
+    counts = Counter()
+    for item in items if isinstance(items, list) else ():
+        if not isinstance(item, dict):
+            continue
+        for kind in KINDS:
+            value = str(item.get(kind) or '').strip().lower()
+            if value:
+                counts[(kind, value)] += 1
+        if all(item.get(k) for k in KINDS):
+            counts[(COMBO, combo_key(item))] += 1
+    return counts
+
+
+def sale_day(created_at, pickup_time):
+    """The day a sale is counted under: when the order was placed, else its pickup day (None if neither)."""
+    when = created_at or pickup_time
+    return when.date() if when else None
+
+
+def _upsert(session, rows):
+    """Adds rows of {day, location, kind, key, quantity} onto the existing counters."""
+    from models import ProductSale
+    if not rows:
+        return
+    stmt = insert(ProductSale.__table__)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=['day', 'location', 'kind', 'key'],
+        set_={'quantity': ProductSale.__table__.c.quantity + stmt.excluded.quantity})
+    session.execute(stmt, rows)
+
+
+def record_sale(session, order):
+    """Counts a newly confirmed order; call inside the transaction that confirms it.
+
+    Only the counter rows for this order's day and location are touched, so the
+    rankings never need order history at request time.
+    """
+    # an order with neither date is being confirmed now, so it counts today
+    day = sale_day(order.created_at, order.pickup_time) or datetime.utcnow().date()
+    location = (order.location or '').strip()
+    _upsert(session, [
+        {'day': day, 'location': location, 'kind': kind, 'key': key, 'quantity': n}
+        for (kind, key), n in sale_counts(order.get_items()).items()
+    ])
+
+
+def top_sellers(session, kind, start=None, end=None, location=None, limit=5):
+    """[(key, quantity)] best sellers of one kind, for days in [start, end)."""
+    from models import ProductSale
+    total = func.sum(ProductSale.quantity).label('quantity')
+    q = session.query(ProductSale.key, total).filter(ProductSale.kind == kind)
+    if start is not None:
+        q = q.filter(ProductSale.day >= start)
+    if end is not None:
+        q = q.filter(ProductSale.day < end)
+    if location:
+        q = q.filter(ProductSale.location == location)
+    return [(key, quantity) for key, quantity in
+            q.group_by(ProductSale.key).order_by(total.desc(), ProductSale.key).limit(limit)]
+
+
+def rankings(session, start=None, end=None, location=None, limit=5):
+    """Top sellers for every kind plus combinations: {'flavour': [...], ..., 'combo': [...]}."""
+    return {kind: top_sellers(session, kind, start, end, location, limit) for kind in KINDS + (COMBO,)}
+
+
+def popular_pick(session, days=POPULAR_PICK_DAYS, location=None):
+    """The best-selling combination of the last `days` days as {flavour, thick, topping}, or None."""
+    top = top_sellers(session, COMBO, start=date.today() - timedelta(days=days), location=location, limit=1)
+    if not top:
+        return None
+    return dict(zip(KINDS, top[0][0].split('|')))
+
+
+def rebuild(session=None):
+    """Recomputes every counter from the orders and orders_archive tables (one-off backfill / repair)."""
+    from models import ProductSale, Order, ArchivedOrder, UNPAID_ORDER_STATUSES
+    session = session or db.session
+    try:
+        session.query(ProductSale).delete()
+        orders = 0
+        # archived orders are confirmed sales too; counting only the hot table would drop them
+        for model in (Order, ArchivedOrder):
+            last_id = 0
+            while True:
+                chunk = session.query(model.id, model.created_at, model.pickup_time, model.location, model.items).filter(
+                    model.id > last_id, model.status.notin_(UNPAID_ORDER_STATUSES)
+                ).order_by(model.id).limit(REBUILD_CHUNK).all()
+                if not chunk:
+                    break
+                buckets = Counter()
+                for row in chunk:
+                    try:
+                        items = json.loads(row.items or '[]')
+                    except (ValueError, TypeError):
+                        continue
+                    day, location = sale_day(row.created_at, row.pickup_time), (row.location or '').strip()
+                    if day is None:
+                        continue
+                    for (kind, key), n in sale_counts(items).items():
+                        buckets[(day, location, kind, key)] += n
+                _upsert(session, [{'day': d, 'location': loc, 'kind': k, 'key': key, 'quantity': n}
+                                  for (d, loc, k, key), n in buckets.items()])
+                orders += len(chunk)
+                last_id = chunk[-1].id
+        session.commit()
+    except Exception:
+        session.rollback()
+        raise
+    return orders
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    if argv[:1] != ['rebuild']:
+        print("usage: python popularity.py rebuild")
+        return 1
+    from app import create_app
+    app = create_app({'SWEEPER_ENABLED': False})
+    with app.app_context():
+        print(f"Sales counters rebuilt from {rebuild(db.session)} confirmed orders")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,142 @@
+import os
+import random
+import sys
+import tempfile
+import time
+
+# Bounds on one /api/quote request
+MAX_BATCH_CARTS = 5000
+MAX_CART_ITEMS = 100
+FIELDS = ('flavour', 'thick', 'topping')
+
+
+class QuoteError(ValueError):
+    """The request body is not a cart or a list of carts."""
+
+
+def _check_cart(cart, label='items'):
+    if not isinstance(cart, list) or not all(
+            isinstance(it, dict) and all(isinstance(it.get(k), (str, type(None))) for k in FIELDS) for it in cart):
+        raise QuoteError(f'{label} must be a list of {{flavour, thick, topping}} objects with text values')
+    if len(cart) > MAX_CART_ITEMS:
+        raise QuoteError(f'{label} has more than {MAX_CART_ITEMS} drinks')
+
+
+def _quote(valid, errors, subtotal, vat, discount, total, item_prices):
+    return {'valid': valid, 'errors': errors, 'subtotal': subtotal, 'vat': vat,
+            'discount': discount, 'total': total, 'item_prices': item_prices}
+
+
+def quote_cart(items, catalog=None, completed_orders=None):
+    """Prices one cart exactly as an order would be priced (Order.compute_totals_for_items)."""
+    from models import Order
+    _check_cart(items)
+    valid, errors, subtotal, vat, discount, total, items_out = Order.compute_totals_for_items(
+        items, lookup_cache=catalog, completed_orders=completed_orders)
+    return _quote(valid, errors, subtotal, vat, discount, total, [it['price'] for it in items_out])
+
+
+def quote_carts(carts, catalog=None, completed_orders=None):
+    """Prices many carts against one catalog snapshot.
+
+    Partner menus and what-if lists repeat the same few drinks thousands of
+    times, so each distinct (flavour, thick, topping) is priced once through
+    Order.price_item and every cart is then only a sum of table lookups; the
+    discount/VAT step is the same Order.totals the order page uses.
+    """
+    from models import Order
+    if not isinstance(carts, list):
+        raise QuoteError('carts must be a list of carts')
+    if len(carts) > MAX_BATCH_CARTS:
+        raise QuoteError(f'at most {MAX_BATCH_CARTS} carts per request')
+    catalog = catalog or Order._get_lookup_cache()
+    prices, vat_rate = catalog['prices'], catalog['vat_rate']
+    priced = {}
+    results = []
+    for n, cart in enumerate(carts, start=1):
+        _check_cart(cart, f'cart {n}')
+        lines = []
+        for it in cart:
+            key = (it.get('flavour'), it.get('thick'), it.get('topping'))
+            line = priced.get(key)
+            if line is None:
+                line = priced[key] = Order.price_item(it, prices)
+            lines.append(line)
+        errors = [f'Item {idx}: {p}' for idx, (_, problems) in enumerate(lines, start=1) for p in problems]
+        item_prices = [price for price, _ in lines]
+        subtotal = sum(item_prices, 0.0)
+        discount, vat, total = Order.totals(subtotal, completed_orders, vat_rate)
+        results.append(_quote(not errors, errors, round(subtotal, 2), round(vat, 2), round(discount, 2),
+                              round(total, 2), item_prices))
+    return results
+
+
+# --- Benchmark ---
+
+def _random_carts(catalog, n, max_items, seed=1):
+    rng = random.Random(seed)
+    menu = {}
+    for key in catalog['prices']:
+        kind, _, name = key.partition('_')
+        menu.setdefault(kind, []).append(name)
+    return [[{'flavour': rng.choice(menu['flavour']), 'thick': rng.choice(menu['consistency']),
+              'topping': rng.choice(menu['topping'])} for _ in range(rng.randint(1, max_items))]
+            for _ in range(n)]
+
+
+def benchmark(n_carts=50000, max_items=5):
+    """Carts priced per second: one at a time, batched in-process, and through /api/quote."""
+    from app import create_app
+    from models import Order
+    from reset_db import insert_initial_data
+    import sqlite3
+
+    workdir = tempfile.mkdtemp(prefix='quote_bench_')
+    path = os.path.join(workdir, 'bench.db')
+    app = create_app({'SQLALCHEMY_DATABASE_URI': 'sqlite:///' + path, 'SWEEPER_ENABLED': False,
+                      'RATE_LIMIT_ENABLED': False})
+    conn = sqlite3.connect(path)
+    insert_initial_data(conn)
+    conn.commit()
+    conn.close()
+
+    with app.app_context():
+        catalog = Order._get_lookup_cache()
+        carts = _random_carts(catalog, n_carts, max_items)
+        results = {}
+
+        started = time.perf_counter()
+        single = [quote_cart(cart, catalog, completed_orders=0) for cart in carts]
+        results['single'] = time.perf_counter() - started
+
+        started = time.perf_counter()
+        batch = []
+        for i in range(0, n_carts, MAX_BATCH_CARTS):
+            batch.extend(quote_carts(carts[i:i + MAX_BATCH_CARTS], catalog, completed_orders=0))
+        results['batch'] = time.perf_counter() - started
+        assert batch == single, 'batch pricing disagrees with compute_totals_for_items'
+
+    client = app.test_client()
+    started = time.perf_counter()
+    for i in range(0, n_carts, MAX_BATCH_CARTS):
+        response = client.post('/api/quote', json={'carts': carts[i:i + MAX_BATCH_CARTS]})
+        assert response.status_code == 200, response.status_code
+    results['http batch'] = time.perf_counter() - started
+
+    print(f"Quoting {n_carts} carts of 1-{max_items} drinks:")
+    for label, elapsed in results.items():
+        print(f"  {label:<11} {elapsed:7.2f} s  {n_carts / elapsed:10.0f} carts/s")
+    return results
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    if argv[:1] != ['--benchmark']:
+        print("usage: python pricing.py --benchmark [N]")
+        return 1
+    benchmark(int(argv[1]) if len(argv) > 1 else 50000)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,273 @@
+import cProfile
+import io
+import json
+import os
+import pstats
+import random
+import re
+import threading
+import time
+from datetime import datetime
+
+from flask import current_app, g, request
+
+# --- Profiler Defaults (override through app.config) ---
+PROFILER_DEFAULTS = {
+    # Starting values; managers can change both at runtime on /admin/profiles
+    'PROFILER_ENABLED': False,
+    'PROFILER_SAMPLE_RATE': 0.05,        # fraction of requests profiled while enabled
+    'PROFILER_KEEP_PER_ENDPOINT': 5,     # slowest captures kept per endpoint
+    'PROFILER_DIR': None,                # None = <instance>/profiles
+}
+# Workers re-read the runtime switch at most this often
+CONTROL_CHECK_SECONDS = 2
+CONTROL_FILE = 'settings.json'
+# SQL statement shapes kept per capture, by total time
+SQL_SHAPES_KEPT = 20
+# Never profiled: static files and the profiler's own pages
+SKIP_ENDPOINTS = ('static', 'admin_profiles', 'admin_profiles_settings', 'admin_profile_download', 'admin_profile_view')
+
+_SAFE = re.compile(r'[^A-Za-z0-9_.-]')
+_CAPTURE_NAME = re.compile(r'^\d{9}-\d{8}T\d{6}-[0-9a-f]{8}$')
+
+
+class Profiler:
+    """Samples requests with cProfile and keeps the slowest few per endpoint on disk.
+
+    Layout: <dir>/<endpoint>/<duration_ms>-<time>-<rand>.prof (pstats) plus a
+    .json sidecar with the request and its SQL timings. The duration leads the
+    file name, so deciding whether a new capture makes the cut is a directory
+    listing. At most one request per process is profiled at a time.
+    """
+
+    def __init__(self, app):
+        self.directory = app.config['PROFILER_DIR'] or os.path.join(app.instance_path, 'profiles')
+        self.keep = app.config['PROFILER_KEEP_PER_ENDPOINT']
+        self._defaults = {'enabled': bool(app.config['PROFILER_ENABLED']),
+                          'sample_rate': float(app.config['PROFILER_SAMPLE_RATE'])}
+        self._settings = dict(self._defaults)
+        self._control_mtime = None
+        self._checked = 0.0
+        self._busy = threading.Lock()
+
+    # --- Runtime switch, shared by all workers through a small control file ---
+
+    @property
+    def control_path(self):
+        return os.path.join(self.directory, CONTROL_FILE)
+
+    def settings(self):
+        now = time.monotonic()
+        if now - self._checked >= CONTROL_CHECK_SECONDS:
+            self._checked = now
+            try:
+                mtime = os.stat(self.control_path).st_mtime
+            except OSError:
+                mtime = None
+            if mtime != self._control_mtime:
+                self._control_mtime = mtime
+                self._settings = self._read_control() if mtime else dict(self._defaults)
+        return self._settings
+
+    def _read_control(self):
+        try:
+            with open(self.control_path) as f:
+                data = json.load(f)
+            return {'enabled': bool(data['enabled']), 'sample_rate': min(1.0, max(0.0, float(data['sample_rate'])))}
+        except (OSError, ValueError, KeyError, TypeError):
+            return dict(self._defaults)
+
+    def update(self, enabled, sample_rate):
+        settings = {'enabled': bool(enabled), 'sample_rate': min(1.0, max(0.0, float(sample_rate)))}
+        self._write_json(self.control_path, settings)
+        self._settings = settings
+        self._checked = 0.0
+        return settings
+
+    def _write_json(self, path, data):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = f'{path}.{os.getpid()}.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(data, f, indent=1, default=str)
+        os.replace(tmp, path)
+
+    # --- Capturing ---
+
+    def start(self):
+        """Starts profiling this request if it is sampled; returns the capture state or None."""
+        settings = self.settings()
+        if not settings['enabled'] or random.random() >= settings['sample_rate']:
+            return None
+        if not self._busy.acquire(blocking=False):
+            return None
+        from query_budget import start_recording
+        profile = cProfile.Profile()
+        state = {'profile': profile, 'recorder': start_recording(), 'started': time.perf_counter(),
+                 'at': datetime.utcnow()}
+        profile.enable()
+        return state
+
+    def stop(self, state):
+        from query_budget import stop_recording
+        if 'duration' in state:
+            return
+        state['profile'].disable()
+        state['duration'] = time.perf_counter() - state['started']
+        stop_recording(state['recorder'])
+        self._busy.release()
+
+    def save(self, state, endpoint, meta):
+        """Writes the capture if it is among the slowest `keep` for its endpoint."""
+        endpoint = _SAFE.sub('_', endpoint)
+        folder = os.path.join(self.directory, endpoint)
+        duration_ms = min(int(state['duration'] * 1000), 999999999)
+        existing = self._names(folder)
+        if len(existing) >= self.keep and duration_ms <= int(existing[-1][:9]):
+            return None
+        name = f"{duration_ms:09d}-{state['at'].strftime('%Y%m%dT%H%M%S')}-{os.urandom(4).hex()}"
+        os.makedirs(folder, exist_ok=True)
+        state['profile'].dump_stats(os.path.join(folder, name + '.prof'))
+        self._write_json(os.path.join(folder, name + '.json'), {
+            **meta, 'endpoint': endpoint, 'name': name, 'captured_at': state['at'].isoformat(),
+            'duration_ms': round(state['duration'] * 1000, 1), 'sql': _sql_summary(state['recorder']),
+        })
+        # Drop the fastest captures beyond the limit (another worker may race us; missing files are fine)
+        for old in self._names(folder)[self.keep:]:
+            for ext in ('.prof', '.json'):
+                try:
+                    os.remove(os.path.join(folder, old + ext))
+                except OSError:
+                    pass
+        return name
+
+    def _names(self, folder):
+        """Capture names in a folder, slowest first."""
+        try:
+            files = os.listdir(folder)
+        except OSError:
+            return []
+        return sorted((f[:-5] for f in files if f.endswith('.json') and _CAPTURE_NAME.match(f[:-5])), reverse=True)
+
+    # --- Reading captures (manager pages) ---
+
+    def captures(self):
+        """Metadata of every stored capture, grouped by endpoint, slowest first."""
+        result = []
+        try:
+            endpoints = sorted(os.listdir(self.directory))
+        except OSError:
+            return result
+        for endpoint in endpoints:
+            folder = os.path.join(self.directory, endpoint)
+            if not os.path.isdir(folder):
+                continue
+            for name in self._names(folder):
+                try:
+                    with open(os.path.join(folder, name + '.json')) as f:
+                        result.append(json.load(f))
+                except (OSError, ValueError):
+                    continue
+        return result
+
+    def path(self, endpoint, name, ext):
+        """Path of one capture file, or None if the name is not a capture."""
+        if _SAFE.search(endpoint) or endpoint.strip('.') == '' or not _CAPTURE_NAME.match(name):
+            return None
+        path = os.path.join(self.directory, endpoint, name + ext)
+        return path if os.path.exists(path) else None
+
+    def report(self, endpoint, name, limit=40):
+        """(metadata, top functions by cumulative time as text) for one capture."""
+        prof, meta = self.path(endpoint, name, '.prof'), self.path(endpoint, name, '.json')
+        if not prof or not meta:
+            return None, None
+        with open(meta) as f:
+            data = json.load(f)
+        out = io.StringIO()
+        pstats.Stats(prof, stream=out).strip_dirs().sort_stats('cumulative').print_stats(limit)
+        return data, out.getvalue()
+
+
+def _sql_summary(recorder):
+    from query_budget import statement_shape
+    shapes = {}
+    for statement, duration in recorder.queries:
+        s = shapes.setdefault(statement_shape(statement), {'count': 0, 'total_ms': 0.0, 'max_ms': 0.0})
+        s['count'] += 1
+        s['total_ms'] += duration * 1000
+        s['max_ms'] = max(s['max_ms'], duration * 1000)
+    top = sorted(shapes.items(), key=lambda kv: kv[1]['total_ms'], reverse=True)[:SQL_SHAPES_KEPT]
+    return {
+        'count': recorder.count,
+        'total_ms': round(recorder.total_time * 1000, 2),
+        'statements': [{'shape': shape, 'count': s['count'], 'total_ms': round(s['total_ms'], 2),
+                        'max_ms': round(s['max_ms'], 2)} for shape, s in top],
+    }
+
+
+def profiler():
+    return current_app.extensions['profiler']
+
+
+def init_profiler(app):
+    """Registers the sampling hooks. Off until PROFILER_ENABLED or a manager switches it on."""
+    for key, value in PROFILER_DEFAULTS.items():
+        app.config.setdefault(key, value)
+    prof = Profiler(app)
+    app.extensions['profiler'] = prof
+
+    @app.before_request
+    def _start_profile():
+        # unmatched URLs (404s) have no endpoint to file them under
+        if request.endpoint is None or request.endpoint in SKIP_ENDPOINTS:
+            return
+        state = prof.start()
+        if state is not None:
+            g.profile_state = state
+
+    @app.after_request
+    def _stop_profile(response):
+        state = g.get('profile_state')
+        if state is not None:
+            # Stopped before the outer hooks (query budget) finish, so their work is not counted
+            prof.stop(state)
+            state['status'] = response.status_code
+        return response
+
+    @app.teardown_request
+    def _save_profile(exc):
+        state = g.pop('profile_state', None)
+        if state is None:
+            return
+        _finish(prof, state, request.endpoint, {
+            'method': request.method, 'path': request.full_path.rstrip('?'),
+            'status': state.get('status', 500), 'error': repr(exc) if exc else None,
+        })
+
+    return prof
+
+
+def _finish(prof, state, endpoint, meta):
+    prof.stop(state)
+    try:
+        prof.save(state, endpoint, meta)
+    except Exception as e:
+        print('Profiler could not save capture:', e)
+
+
+def defer_to_stream(status=200):
+    """Takes this request's capture away from the request hooks, for a streamed response.
+
+    Returns finish(exc=None), to call when the body is done or abandoned (see
+    reporting.stream_report). It needs no request context and runs only once.
+    """
+    state = g.pop('profile_state', None)
+    if state is None:
+        return lambda exc=None: None
+    prof, endpoint = profiler(), request.endpoint
+    meta = {'method': request.method, 'path': request.full_path.rstrip('?'), 'status': status, 'streamed': True}
+
+    def finish(exc=None):
+        if 'duration' not in state:
+            _finish(prof, state, endpoint, {**meta, 'error': repr(exc) if exc else None})
+    return finish
@@ -0,0 +1,280 @@
+import json
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime, timedelta
+
+from sqlalchemy import and_, case, func, literal, or_, select
+
+from extensions import db
+
+# Admin list views read plain rows with only the columns they display. Nothing
+# here is added to the session's identity map, and the order items JSON never
+# leaves SQLite: json_extract pulls out just the first drink.
+
+# Rows fetched per round trip by the iter_* generators
+STREAM_BATCH = 1000
+
+
+def _label(value):
+    # json_extract hands back numbers as numbers; anything in the JSON is shown as text
+    return str(value).title() if value not in (None, '') else 'N/A'
+
+
+class OrderRow:
+    """One line of the admin_reports orders table."""
+    __slots__ = ('id', 'created_at', 'status', 'first_item_flavour', 'first_item_topping', 'first_item_thick')
+
+    def __init__(self, id, created_at, status, has_items, flavour, topping, thick):
+        self.id = id
+        self.created_at = created_at
+        self.status = status
+        if has_items:
+            self.first_item_flavour = _label(flavour)
+            self.first_item_topping = _label(topping)
+            self.first_item_thick = _label(thick)
+        else:
+            self.first_item_flavour = self.first_item_topping = self.first_item_thick = 'Empty'
+
+
+def iter_report_orders(session, start, end):
+    """OrderRows created in [start, end), newest first, from the hot and archived orders.
+
+    Rows come off a server-side cursor STREAM_BATCH at a time, so a streamed
+    page holds one batch, not the whole range.
+    """
+    from archive import orders_union
+    o = orders_union('id', 'created_at', 'status', 'items', start=start, end=end).c
+    # json_extract raises on malformed JSON; such an order shows as 'Empty', like Order.get_items()
+    valid = func.json_valid(o['items']) == 1
+
+    def first_item(path):
+        return case((valid, func.json_extract(o['items'], path)))
+
+    rows = session.query(
+        o.id, o.created_at, o.status,
+        first_item('$[0]').isnot(None),
+        first_item('$[0].flavour'),
+        first_item('$[0].topping'),
+        first_item('$[0].thick'),
+    ).order_by(o.created_at.desc()).yield_per(STREAM_BATCH)
+    for row in rows:
+        yield OrderRow(*row)
+
+
+def report_orders(session, start, end):
+    return list(iter_report_orders(session, start, end))
+
+
+def count_report_orders(session, start, end):
+    """Number of orders (hot and archived) created in [start, end); a range count on each created_at index."""
+    from archive import orders_union
+    o = orders_union('id', start=start, end=end).c
+    return session.query(func.count(o.id)).scalar()
+
+
+def _audit_columns():
+    from models import AuditLog
+    return (AuditLog.created_at, AuditLog.action, AuditLog.actor, AuditLog.details,
+            AuditLog.entity_type, AuditLog.entity_id, AuditLog.ip)
+
+
+def iter_report_audit_logs(session, start, end, ip=None, action=None):
+    """Audit rows created in [start, end), newest first, optionally for one IP address and/or action."""
+    from models import AuditLog
+    q = session.query(*_audit_columns()).filter(AuditLog.created_at >= start, AuditLog.created_at < end)
+    if ip:
+        q = q.filter(AuditLog.ip == ip)
+    if action:
+        q = q.filter(AuditLog.action == action)
+    yield from q.order_by(AuditLog.created_at.desc()).yield_per(STREAM_BATCH)
+
+
+def entity_timeline(session, entity_type, entity_id):
+    """Every audit row recorded against one order or user, oldest first.
+
+    Rows about the entity alone come from one range of ix_audit_logs_entity; batch
+    rows (kitchen moves, expiry, archiving) through their audit_log_entities links.
+    """
+    from models import AuditLog, AuditLogEntity
+    linked = select(AuditLogEntity.audit_log_id).where(
+        AuditLogEntity.entity_type == entity_type, AuditLogEntity.entity_id == entity_id)
+    return session.query(*_audit_columns()).filter(or_(
+        and_(AuditLog.entity_type == entity_type, AuditLog.entity_id == entity_id),
+        AuditLog.id.in_(linked)
+    )).order_by(AuditLog.created_at, AuditLog.id).all()
+
+
+def lookup_items(session):
+    """(id, name, type, value) rows for the dashboard: products by type and name, then configs."""
+    from models import Product, Config
+    products = session.query(Product.id, Product.name, Product.type, Product.value).order_by(
+        Product.type, Product.name).all()
+    configs = session.query(Config.id, Config.name, literal('Config').label('type'), Config.value).all()
+    return products + configs
+
+
+# --- Benchmark ---
+
+def _orm_report_orders(session, start, end):
+    # What admin_reports did before: hydrate full Orders and decorate them
+    from models import Order
+    orders = session.query(Order).filter(Order.created_at >= start, Order.created_at < end).order_by(
+        Order.created_at.desc()).all()
+    for order in orders:
+        items = order.get_items()
+        if items:
+            order.first_item_flavour = items[0].get('flavour', 'N/A').title()
+            order.first_item_topping = items[0].get('topping', 'N/A').title()
+            order.first_item_thick = items[0].get('thick', 'N/A').title()
+        else:
+            order.first_item_flavour = order.first_item_topping = order.first_item_thick = 'Empty'
+    return orders
+
+
+def _measure(fn):
+    db.session.expunge_all()
+    tracemalloc.start()
+    started = time.perf_counter()
+    rows = fn()
+    elapsed = time.perf_counter() - started
+    # Peak while the result (and, for the ORM, the identity map) is alive
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del rows
+    db.session.expunge_all()
+    return elapsed, peak
+
+
+def benchmark(n_orders=10000, repeat=3):
+    """Seeds a throwaway database with n_orders and compares ORM hydration with projections."""
+    from app import create_app
+    from models import Order, User
+    from reset_db import insert_initial_data
+    import sqlite3
+
+    workdir = tempfile.mkdtemp(prefix='projection_bench_')
+    path = os.path.join(workdir, 'bench.db')
+    app = create_app({'SQLALCHEMY_DATABASE_URI': 'sqlite:///' + path, 'SWEEPER_ENABLED': False})
+    conn = sqlite3.connect(path)
+    insert_initial_data(conn)
+    conn.commit()
+    conn.close()
+
+    with app.app_context():
+        user = User(username='bench', email='bench@example.com', password_hash='x')
+        db.session.add(user)
+        db.session.commit()
+        item = {'flavour': 'vanilla', 'thick': 'thick', 'topping': 'nuts', 'price': 30.0}
+        now = datetime.utcnow()
+        db.session.execute(Order.__table__.insert(), [
+            {'user_id': user.id, 'created_at': now - timedelta(seconds=i), 'pickup_time': now,
+             'location': 'Bench', 'items': json.dumps([item] * (1 + i % 3)), 'status': 'Confirmed',
+             'subtotal': 30.0, 'vat': 4.5, 'discount': 0.0, 'total': 34.5}
+            for i in range(n_orders)
+        ])
+        db.session.commit()
+
+        start, end = now - timedelta(days=1), now + timedelta(days=1)
+        results = {}
+        for label, fn in (('orm', lambda: _orm_report_orders(db.session, start, end)),
+                          ('projection', lambda: report_orders(db.session, start, end))):
+            runs = [_measure(fn) for _ in range(repeat)]
+            results[label] = (min(r[0] for r in runs), max(r[1] for r in runs))
+
+    per = 10000 / n_orders
+    print(f"admin_reports orders query, {n_orders} rows (best of {repeat}, scaled per 10k rows):")
+    for label, (elapsed, peak) in results.items():
+        print(f"  {label:<10} {elapsed * per * 1000:8.1f} ms  {peak * per / 1024 / 1024:7.2f} MiB peak")
+    return results
+
+
+def _fetch_page(client, url):
+    """(seconds to the first body chunk, seconds to the last, bytes) for one GET."""
+    started = time.perf_counter()
+    response = client.get(url, buffered=False)
+    chunks = iter(response.response)
+    first = next(chunks, b'')
+    ttfb = time.perf_counter() - started
+    size = len(first)
+    for chunk in chunks:
+        size += len(chunk)
+    response.close()
+    return ttfb, time.perf_counter() - started, size
+
+
+def page_benchmark(n_rows=100000):
+    """Time to first byte, total time and peak memory of /admin/reports over n_rows orders
+    and n_rows audit entries, rendered in one piece and streamed."""
+    from app import create_app
+    from models import AuditLog, Order, User
+    from reset_db import insert_initial_data
+    import sqlite3
+
+    workdir = tempfile.mkdtemp(prefix='report_page_bench_')
+    path = os.path.join(workdir, 'bench.db')
+    app = create_app({'SQLALCHEMY_DATABASE_URI': 'sqlite:///' + path, 'SWEEPER_ENABLED': False,
+                      'RATE_LIMIT_ENABLED': False, 'WTF_CSRF_ENABLED': False})
+    conn = sqlite3.connect(path)
+    insert_initial_data(conn)
+    conn.commit()
+    conn.close()
+
+    with app.app_context():
+        user = User(username='bench', email='bench@example.com', password_hash='x', role='manager')
+        db.session.add(user)
+        db.session.commit()
+        user_id = user.id
+        item = json.dumps([{'flavour': 'vanilla', 'thick': 'thick', 'topping': 'nuts', 'price': 30.0}])
+        now = datetime.utcnow()
+        for offset in range(0, n_rows, 10000):
+            batch = range(offset, min(offset + 10000, n_rows))
+            db.session.execute(Order.__table__.insert(), [
+                {'user_id': user_id, 'created_at': now - timedelta(seconds=i), 'items': item,
+                 'status': 'Confirmed', 'total': 34.5} for i in batch])
+            db.session.execute(AuditLog.__table__.insert(), [
+                {'action': 'Order Created', 'actor': 'bench', 'created_at': now - timedelta(seconds=i),
+                 'details': json.dumps({'order_id': i + 1, 'total': 34.5})} for i in batch])
+            db.session.commit()
+
+    client = app.test_client()
+    with client.session_transaction() as session:
+        session['_user_id'] = str(user_id)
+        session['_fresh'] = True
+    url = '/admin/reports?start_date={}&end_date={}'.format(
+        (now - timedelta(days=3)).strftime('%Y-%m-%d'), now.strftime('%Y-%m-%d'))
+
+    results = {}
+    for label, streaming in (('rendered', False), ('streamed', True)):
+        app.config['REPORTS_STREAMING'] = streaming
+        _fetch_page(client, url)  # warm caches
+        ttfb, total, size = _fetch_page(client, url)
+        tracemalloc.start()
+        _fetch_page(client, url)
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        results[label] = (ttfb, total, size, peak)
+
+    print(f"/admin/reports with {n_rows} orders and {n_rows} audit entries in range:")
+    for label, (ttfb, total, size, peak) in results.items():
+        print(f"  {label:<9} first byte {ttfb * 1000:8.1f} ms  complete {total * 1000:8.1f} ms  "
+              f"{size / 1024 / 1024:6.1f} MiB page  {peak / 1024 / 1024:7.1f} MiB peak")
+    return results
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    if argv[:1] == ['--benchmark']:
+        benchmark(int(argv[1]) if len(argv) > 1 else 10000)
+    elif argv[:1] == ['--page-benchmark']:
+        page_benchmark(int(argv[1]) if len(argv) > 1 else 100000)
+    else:
+        print("usage: python projections.py --benchmark [N] | --page-benchmark [N]")
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
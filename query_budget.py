@@ -0,0 +1,217 @@
+import re
+import time
+from collections import Counter
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from flask import current_app, g, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+# --- Query Budget Defaults (override through app.config) ---
+QUERY_BUDGET_DEFAULTS = {
+    # 'off', 'log' or 'raise'; None picks 'raise' under TESTING, 'log' under debug, else 'off'
+    'QUERY_BUDGET_MODE': None,
+    'QUERY_BUDGET_DEFAULT': 30,          # max queries per request for endpoints not listed below
+    # endpoint name -> max queries; pinned by tests/test_query_budgets.py
+    'QUERY_BUDGETS': {
+        'orders': 3,             # user, one keyset page per tier
+        'order': 14,             # order POST: pricing, loyalty count, idempotency key, insert, audit
+        'admin_dashboard': 3,
+        'admin_reports': 11,
+    },
+    'QUERY_REPEAT_THRESHOLD': 10,        # same statement shape this often in one request = likely N+1
+}
+
+# Every recorder currently collecting; nested scopes (a test around a request) all see each query
+_active = ContextVar('query_recorders', default=())
+_listening = False
+
+_WS = re.compile(r'\s+')
+_PARAM_LIST = re.compile(r'\((?:\s*\?\s*,)+\s*\?\s*\)')
+_NUMBER = re.compile(r'\b\d+(?:\.\d+)?\b')
+_STRING = re.compile(r"'(?:[^']|'')*'")
+
+
+class QueryBudgetExceeded(AssertionError):
+    """Raised (in 'raise' mode and by the test helpers) when a budget is exceeded."""
+
+
+def statement_shape(statement):
+    """Normalises a statement so executions that differ only by values group together."""
+    shape = _WS.sub(' ', statement).strip()
+    shape = _STRING.sub('?', shape)
+    shape = _NUMBER.sub('?', shape)
+    return _PARAM_LIST.sub('(?...)', shape)
+
+
+class QueryRecorder:
+    """Collects the statements executed while it is active."""
+
+    def __init__(self):
+        self.queries = []
+        self.shapes = Counter()
+
+    def record(self, statement, duration):
+        self.queries.append((statement, duration))
+        self.shapes[statement_shape(statement)] += 1
+
+    @property
+    def count(self):
+        return len(self.queries)
+
+    @property
+    def total_time(self):
+        return sum(d for _, d in self.queries)
+
+    def repeated(self, threshold):
+        """Statement shapes executed at least threshold times, most frequent first."""
+        return [(shape, n) for shape, n in self.shapes.most_common() if n >= threshold]
+
+    def report(self, limit=5):
+        lines = [f'{self.count} queries, {self.total_time * 1000:.1f} ms']
+        for shape, n in self.shapes.most_common(limit):
+            lines.append(f'  {n:4d} x {shape[:160]}')
+        return '\n'.join(lines)
+
+
+def _before_execute(conn, cursor, statement, parameters, context, executemany):
+    if _active.get():
+        conn.info.setdefault('query_started', []).append(time.perf_counter())
+
+
+def _after_execute(conn, cursor, statement, parameters, context, executemany):
+    recorders = _active.get()
+    if not recorders:
+        return
+    started = conn.info.get('query_started')
+    duration = time.perf_counter() - started.pop() if started else 0.0
+    for recorder in recorders:
+        recorder.record(statement, duration)
+
+
+def _listen():
+    # Engine-class listeners see every engine (primary and reporting) in the process
+    global _listening
+    if not _listening:
+        event.listen(Engine, 'before_cursor_execute', _before_execute)
+        event.listen(Engine, 'after_cursor_execute', _after_execute)
+        _listening = True
+
+
+@contextmanager
+def record_queries():
+    """Records every statement executed in this context: `with record_queries() as rec: ...`."""
+    _listen()
+    recorder = QueryRecorder()
+    token = _active.set(_active.get() + (recorder,))
+    try:
+        yield recorder
+    finally:
+        _active.reset(token)
+
+
+def start_recording():
+    """Starts a recorder that spans callbacks (e.g. before/after request); end it with stop_recording()."""
+    _listen()
+    recorder = QueryRecorder()
+    _active.set(_active.get() + (recorder,))
+    return recorder
+
+
+def stop_recording(recorder):
+    # Removed by identity, so recorders may stop in any order
+    _active.set(tuple(r for r in _active.get() if r is not recorder))
+
+
+@contextmanager
+def assert_max_queries(limit, repeat_threshold=None):
+    """Fails if the block runs more than `limit` queries (or repeats one shape too often)."""
+    with record_queries() as recorder:
+        yield recorder
+    if recorder.count > limit:
+        raise QueryBudgetExceeded(f'expected at most {limit} queries, ran {recorder.report()}')
+    if repeat_threshold is not None and recorder.repeated(repeat_threshold):
+        raise QueryBudgetExceeded(f'statement repeated {repeat_threshold}+ times (N+1?): {recorder.report()}')
+
+
+def _mode(app):
+    mode = app.config['QUERY_BUDGET_MODE']
+    if mode is None:
+        mode = 'raise' if app.testing else 'log' if app.debug else 'off'
+    return mode
+
+
+def init_query_budget(app):
+    """Checks every request against its query budget when QUERY_BUDGET_MODE is not 'off'."""
+    for key, value in QUERY_BUDGET_DEFAULTS.items():
+        app.config.setdefault(key, value)
+    _listen()
+
+    @app.before_request
+    def _start_recording():
+        if _mode(current_app) == 'off':
+            return
+        recorder = QueryRecorder()
+        g.query_recorder = recorder
+        g.query_recorder_token = _active.set(_active.get() + (recorder,))
+
+    @app.after_request
+    def _check_budget(response):
+        recorder = g.pop('query_recorder', None)
+        if recorder is None:
+            return response
+        _active.reset(g.pop('query_recorder_token'))
+        response.headers['X-Query-Count'] = str(recorder.count)
+        _check(current_app, request.endpoint or request.path, recorder)
+        return response
+
+    @app.teardown_request
+    def _stop_recording(exc):
+        # after_request is skipped when the view raised; still stop recording
+        if 'query_recorder' in g:
+            g.pop('query_recorder')
+            _active.reset(g.pop('query_recorder_token'))
+
+
+def _check(app, endpoint, recorder):
+    config = app.config
+    budget = config['QUERY_BUDGETS'].get(endpoint, config['QUERY_BUDGET_DEFAULT'])
+    repeated = recorder.repeated(config['QUERY_REPEAT_THRESHOLD'])
+
+    problems = []
+    if recorder.count > budget:
+        problems.append(f'{recorder.count} queries (budget {budget})')
+    if repeated:
+        problems.append(f'{len(repeated)} statement shape(s) repeated '
+                        f'{config["QUERY_REPEAT_THRESHOLD"]}+ times (N+1?)')
+    if problems:
+        message = f'Query budget exceeded on {endpoint}: {", ".join(problems)}\n{recorder.report()}'
+        if _mode(app) == 'raise':
+            raise QueryBudgetExceeded(message)
+        print(message)
+
+
+def defer_to_stream():
+    """Takes this request's recorder away from the request hooks, for a streamed response.
+
+    Returns finish(), to call when the body is done or abandoned (see
+    reporting.stream_report): it stops recording and checks the budget, needs no
+    request context and runs only once. A streamed response has no X-Query-Count
+    header, because the headers go out before its queries run.
+    """
+    recorder = g.pop('query_recorder', None)
+    if recorder is None:
+        return lambda: None
+    g.pop('query_recorder_token')
+    app, endpoint = current_app._get_current_object(), request.endpoint or request.path
+    done = []
+
+    def finish():
+        if done:
+            return
+        done.append(True)
+        # the body may be read or closed outside the request's context; stop by identity
+        stop_recording(recorder)
+        _check(app, endpoint, recorder)
+    return finish
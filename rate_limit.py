@@ -0,0 +1,249 @@
+import math
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from functools import wraps
+
+from flask import current_app, request, jsonify
+from flask_login import current_user
+
+# --- Rate Limit Defaults (override through app.config) ---
+# per_minute: sustained rate; burst: bucket size; by: which keys get a bucket
+# ('ip', 'user' = logged-in user, 'email' = client IP plus the email tried on a form,
+#  'ref' = the payment provider_ref in a JSON body, else the client IP)
+# failures_only: keys only charged through record_failure(); requests just need a token left
+# max_in_flight: concurrent requests allowed in the view before shedding (None = no cap)
+RATE_LIMIT_DEFAULTS = {
+    'RATE_LIMIT_ENABLED': True,
+    'RATE_LIMIT_STORE': 'memory',          # 'memory' (per process) or 'sqlite' (shared by workers)
+    'RATE_LIMIT_SQLITE_PATH': None,        # default: instance/rate_limits.db
+    'RATE_LIMITS': {
+        # Keyed by IP plus email, not email alone, so nobody can lock a real user out from elsewhere
+        'login': {'per_minute': 10, 'burst': 5, 'by': ('ip', 'email'), 'failures_only': ('email',),
+                  'max_in_flight': 8},
+        'order': {'per_minute': 6, 'burst': 3, 'by': ('ip', 'user'), 'max_in_flight': 16},
+        # Per payment, not per IP: a provider posts every confirmation from a few fixed addresses,
+        # so an IP bucket would cap genuine confirmations. One payment's retries and duplicates
+        # still share a bucket; max_in_flight sheds a flood of bogus refs.
+        'payments_webhook': {'per_minute': 60, 'burst': 20, 'by': ('ref',), 'max_in_flight': 32},
+        'quote': {'per_minute': 120, 'burst': 30, 'by': ('ip', 'user'), 'max_in_flight': 8},
+    },
+}
+# Memory store: least recently used keys beyond this are forgotten (they start full again)
+MAX_MEMORY_KEYS = 100000
+# SQLite store: rows idle this long are purged
+SQLITE_IDLE_SECONDS = 3600
+
+
+def _refill(tokens, updated, now, rate, burst):
+    return min(burst, tokens + max(0.0, now - updated) * rate)
+
+
+class MemoryStore:
+    """Token buckets held in this process only."""
+
+    def __init__(self, max_keys=MAX_MEMORY_KEYS):
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+        self.max_keys = max_keys
+
+    def take(self, key, rate, burst, now, cost=1):
+        """Returns the tokens available before this request, spending `cost` if there are enough."""
+        with self._lock:
+            tokens, updated = self._buckets.pop(key, (burst, now))
+            tokens = _refill(tokens, updated, now, rate, burst)
+            self._buckets[key] = (tokens - cost if tokens >= cost else tokens, now)
+            while len(self._buckets) > self.max_keys:
+                self._buckets.popitem(last=False)
+            return tokens
+
+    def __len__(self):
+        return len(self._buckets)
+
+
+class SQLiteStore:
+    """Token buckets in a small SQLite file so every worker process shares them.
+
+    Kept out of the main database on purpose: limiter writes must never queue
+    behind (or in front of) order writes.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        self._takes = 0
+        conn = self._conn()
+        conn.execute("CREATE TABLE IF NOT EXISTS buckets (key TEXT PRIMARY KEY, tokens REAL NOT NULL, updated REAL NOT NULL)")
+
+    def _conn(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=1.0, isolation_level=None)
+            conn.execute('PRAGMA journal_mode = WAL')
+            # Limiter state is disposable; skip fsyncs
+            conn.execute('PRAGMA synchronous = OFF')
+            self._local.conn = conn
+        return conn
+
+    def take(self, key, rate, burst, now, cost=1):
+        conn = self._conn()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            row = conn.execute('SELECT tokens, updated FROM buckets WHERE key = ?', (key,)).fetchone()
+            tokens = burst if row is None else _refill(row[0], row[1], now, rate, burst)
+            conn.execute(
+                'INSERT INTO buckets (key, tokens, updated) VALUES (?, ?, ?) '
+                'ON CONFLICT(key) DO UPDATE SET tokens = excluded.tokens, updated = excluded.updated',
+                (key, tokens - cost if tokens >= cost else tokens, now))
+            self._takes += 1
+            if self._takes % 1000 == 0:
+                conn.execute('DELETE FROM buckets WHERE updated < ?', (now - SQLITE_IDLE_SECONDS,))
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+        return tokens
+
+    def __len__(self):
+        return self._conn().execute('SELECT count(*) FROM buckets').fetchone()[0]
+
+
+class RateLimiter:
+    """Per-endpoint token buckets plus an in-flight cap used for load shedding."""
+
+    def __init__(self, store, limits):
+        self.store = store
+        self.limits = limits
+        self._lock = threading.Lock()
+        self.in_flight = {name: 0 for name in limits}
+        self.stats = {name: {'allowed': 0, 'limited': 0, 'shed': 0} for name in limits}
+
+    def _keys(self, name, by):
+        """[(bucket key, kind)] for the current request, IP first."""
+        keys = []
+        if 'ip' in by:
+            keys.append((f'{name}:ip:{request.remote_addr}', 'ip'))
+        if 'user' in by:
+            if current_user.is_authenticated:
+                keys.append((f'{name}:user:{current_user.get_id()}', 'user'))
+        if 'email' in by and request.form.get('email'):
+            # The account being tried, from this address only
+            keys.append((f"{name}:email:{request.remote_addr}:{request.form['email'].strip().lower()}", 'email'))
+        if 'ref' in by:
+            payload = request.get_json(silent=True)
+            ref = payload.get('provider_ref') if isinstance(payload, dict) else None
+            if isinstance(ref, str) and ref:
+                keys.append((f'{name}:ref:{ref[:64]}', 'ref'))
+            else:
+                keys.append((f'{name}:ip:{request.remote_addr}', 'ip'))
+        return keys
+
+    def check(self, name):
+        """Returns None if the request may proceed, else the Retry-After seconds.
+
+        Stops at the first key that is over its limit, so a blocked request
+        does not keep draining the caller's other buckets.
+        """
+        limit = self.limits[name]
+        rate = limit['per_minute'] / 60.0
+        now = time.time()
+        failures_only = limit.get('failures_only', ())
+        for key, kind in self._keys(name, limit.get('by', ('ip',))):
+            tokens = self.store.take(key, rate, limit['burst'], now, cost=0 if kind in failures_only else 1)
+            if tokens < 1:
+                return math.ceil((1 - tokens) / rate) if rate > 0 else 60
+        return None
+
+    def record_failure(self, name):
+        """Charges the failures_only buckets of the current request (e.g. a wrong password)."""
+        limit = self.limits[name]
+        failures_only = limit.get('failures_only', ())
+        now = time.time()
+        for key, kind in self._keys(name, limit.get('by', ('ip',))):
+            if kind in failures_only:
+                self.store.take(key, limit['per_minute'] / 60.0, limit['burst'], now)
+
+    def enter(self, name):
+        cap = self.limits[name].get('max_in_flight')
+        with self._lock:
+            if cap is not None and self.in_flight[name] >= cap:
+                return False
+            self.in_flight[name] += 1
+            return True
+
+    def leave(self, name):
+        with self._lock:
+            self.in_flight[name] -= 1
+
+    def count(self, name, outcome):
+        with self._lock:
+            self.stats[name][outcome] += 1
+
+    def state(self):
+        with self._lock:
+            endpoints = {name: {**self.limits[name], 'by': list(self.limits[name].get('by', ('ip',))),
+                                'in_flight': self.in_flight[name], **self.stats[name]}
+                         for name in self.limits}
+        return {'store': type(self.store).__name__, 'tracked_keys': len(self.store), 'endpoints': endpoints}
+
+
+def init_rate_limits(app):
+    for key, value in RATE_LIMIT_DEFAULTS.items():
+        app.config.setdefault(key, value)
+    if app.config['RATE_LIMIT_STORE'] == 'sqlite':
+        path = app.config['RATE_LIMIT_SQLITE_PATH'] or os.path.join(app.instance_path, 'rate_limits.db')
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        store = SQLiteStore(path)
+    else:
+        store = MemoryStore()
+    app.extensions['rate_limiter'] = RateLimiter(store, app.config['RATE_LIMITS'])
+
+
+def record_failure(name):
+    """Call from a rate-limited view when the attempt failed (see failures_only)."""
+    limiter = current_app.extensions.get('rate_limiter')
+    if limiter is not None and current_app.config['RATE_LIMIT_ENABLED'] and name in limiter.limits:
+        limiter.record_failure(name)
+
+
+def _too_many(message, retry_after, status=429):
+    if request.is_json or request.path.startswith('/payments/'):
+        response = jsonify({'error': message, 'retry_after': retry_after})
+        response.status_code = status
+    else:
+        response = current_app.response_class(message, status=status, mimetype='text/plain')
+    response.headers['Retry-After'] = str(retry_after)
+    return response
+
+
+def rate_limited(name, methods=('POST',)):
+    """Applies the RATE_LIMITS[name] bucket and in-flight cap to a view.
+
+    Over-limit requests get an immediate 429 with Retry-After; requests arriving
+    while max_in_flight are already running are shed with a 503 before they can
+    queue on the database.
+    """
+    def decorator(f):
+        @wraps(f)
+        def decorated_function(*args, **kwargs):
+            limiter = current_app.extensions.get('rate_limiter')
+            if (limiter is None or not current_app.config['RATE_LIMIT_ENABLED']
+                    or name not in limiter.limits or request.method not in methods):
+                return f(*args, **kwargs)
+
+            retry_after = limiter.check(name)
+            if retry_after is not None:
+                limiter.count(name, 'limited')
+                return _too_many('Too many requests; please slow down.', retry_after)
+            if not limiter.enter(name):
+                limiter.count(name, 'shed')
+                return _too_many('Server busy; please retry shortly.', 1, status=503)
+            limiter.count(name, 'allowed')
+            try:
+                return f(*args, **kwargs)
+            finally:
+                limiter.leave(name)
+        return decorated_function
+    return decorator
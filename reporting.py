@@ -0,0 +1,218 @@
+import sys
+import time
+import sqlite3
+from functools import wraps
+
+from flask import Response, g, current_app, stream_template, stream_with_context
+from sqlalchemy import create_engine, event
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.orm import sessionmaker
+
+from extensions import db
+
+# --- Reporting Defaults (override through app.config) ---
+# Separate, small pool so report traffic can never take connections from checkout
+REPORTING_DEFAULTS = {
+    'REPORTING_DATABASE_URI': None,        # e.g. a replica URL; default is a mode=ro view of the primary file
+    'REPORTING_POOL_SIZE': 2,
+    'REPORTING_MAX_OVERFLOW': 0,
+    'REPORTING_POOL_TIMEOUT': 5,           # seconds to wait for a reporting connection
+    'REPORTING_STATEMENT_TIMEOUT': 10.0,   # seconds before a report query is interrupted
+    'SQLITE_WAL': True,                    # WAL lets readers and the writer run side by side
+    'SQLITE_BUSY_TIMEOUT_MS': 5000,
+    'REPORTS_STREAMING': True,             # stream large admin pages (see stream_report)
+}
+
+# Checked by the SQLite progress handler every N virtual machine instructions
+_PROGRESS_STEPS = 10000
+# Streamed pages are sent in pieces of about this many characters
+STREAM_CHUNK_CHARS = 16 * 1024
+
+
+def _is_sqlite_file(url):
+    return url.get_backend_name() == 'sqlite' and url.database not in (None, '', ':memory:')
+
+
+def _install_statement_timeout(engine, timeout):
+    """Aborts any statement on engine that runs longer than timeout seconds."""
+    if engine.dialect.name == 'sqlite':
+        @event.listens_for(engine, 'connect')
+        def _set_progress_handler(dbapi_conn, record):
+            state = record.info
+            state['deadline'] = None
+
+            def _abort_if_overdue():
+                deadline = state.get('deadline')
+                return 1 if deadline is not None and time.monotonic() > deadline else 0
+
+            dbapi_conn.set_progress_handler(_abort_if_overdue, _PROGRESS_STEPS)
+            # Belt and braces: refuse writes even if the URL is not mode=ro
+            dbapi_conn.execute('PRAGMA query_only = ON')
+
+        @event.listens_for(engine, 'before_cursor_execute')
+        def _start_clock(conn, cursor, statement, parameters, context, executemany):
+            conn.info['deadline'] = time.monotonic() + timeout
+
+        # SQLite does most of a SELECT's work while its rows are fetched, so the
+        # clock keeps running after execute() returns (streamed results included)
+        # and only stops when the connection goes back to the pool
+        @event.listens_for(engine, 'checkin')
+        def _stop_clock(dbapi_conn, record):
+            record.info['deadline'] = None
+
+    elif engine.dialect.name == 'postgresql':
+        @event.listens_for(engine, 'connect')
+        def _set_statement_timeout(dbapi_conn, record):
+            cur = dbapi_conn.cursor()
+            cur.execute(f"SET statement_timeout = {int(timeout * 1000)}")
+            cur.execute("SET default_transaction_read_only = on")
+            cur.close()
+
+
+def _configure_primary(app, engine):
+    """Applies SQLite pragmas to the primary (read/write) engine."""
+    if not _is_sqlite_file(engine.url):
+        return
+
+    @event.listens_for(engine, 'connect')
+    def _set_pragmas(dbapi_conn, record):
+        cur = dbapi_conn.cursor()
+        if app.config['SQLITE_WAL']:
+            cur.execute('PRAGMA journal_mode = WAL')
+        cur.execute(f"PRAGMA busy_timeout = {int(app.config['SQLITE_BUSY_TIMEOUT_MS'])}")
+        cur.close()
+
+
+def init_reporting(app):
+    """Creates the read-only reporting engine for app and wires request teardown."""
+    for key, value in REPORTING_DEFAULTS.items():
+        app.config.setdefault(key, value)
+
+    with app.app_context():
+        primary = db.engine
+        _configure_primary(app, primary)
+
+        uri = app.config['REPORTING_DATABASE_URI']
+        if uri:
+            url = uri
+        elif _is_sqlite_file(primary.url):
+            # Same file, opened read-only: reports share no connections with writers
+            url = f"sqlite:///file:{primary.url.database}?mode=ro&uri=true"
+        else:
+            url = None
+
+        if url is None:
+            # In-memory databases (tests) cannot be opened twice; share the primary
+            engine = primary
+        else:
+            engine = create_engine(
+                url,
+                pool_size=app.config['REPORTING_POOL_SIZE'],
+                max_overflow=app.config['REPORTING_MAX_OVERFLOW'],
+                pool_timeout=app.config['REPORTING_POOL_TIMEOUT'],
+                pool_pre_ping=True,
+            )
+            _install_statement_timeout(engine, float(app.config['REPORTING_STATEMENT_TIMEOUT']))
+
+    app.extensions['reporting_engine'] = engine
+    app.extensions['reporting_sessionmaker'] = sessionmaker(bind=engine, autoflush=False, expire_on_commit=False)
+
+    @app.teardown_appcontext
+    def _close_report_session(exc):
+        # A streamed page still reads through the session after the view returns;
+        # the teardown that follows its last chunk closes it (see stream_report)
+        if g.pop('report_streaming', False):
+            return
+        session = g.pop('report_session', None)
+        if session is not None:
+            session.close()
+
+
+def report_session():
+    """Returns the read-only session for the current request, opening it on first use."""
+    if 'report_session' not in g:
+        g.report_session = current_app.extensions['reporting_sessionmaker']()
+    return g.report_session
+
+
+def _is_timeout(exc):
+    orig = getattr(exc, 'orig', None)
+    if isinstance(orig, sqlite3.OperationalError):
+        return 'interrupted' in str(orig)
+    return 'statement timeout' in str(orig)
+
+
+def reporting_view(f):
+    """Routes a view's queries to the reporting session (available as g.report_session).
+
+    Queries that hit REPORTING_STATEMENT_TIMEOUT are answered with a 503 instead
+    of tying up a worker.
+    """
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        report_session()
+        try:
+            return f(*args, **kwargs)
+        except OperationalError as e:
+            if not _is_timeout(e):
+                raise
+            print('Reporting query timed out:', e)
+            return ('Report query timed out; try a narrower date range.', 503)
+    return decorated_function
+
+
+def stream_report(template_name, **context):
+    """Renders a report template as it is sent, instead of building the page first.
+
+    Pass generators (e.g. projections.iter_report_orders) for the long tables:
+    the browser gets the page head at once and memory stays at one batch of rows
+    plus one chunk of HTML, whatever the date range. Jinja yields very small
+    pieces, so they are joined into STREAM_CHUNK_CHARS chunks before sending.
+    The report session stays open until the last chunk, or until the response
+    is closed without being read.
+    """
+    g.report_streaming = True
+    parts = stream_template(template_name, **context)
+
+    # after_request runs before the tables are queried, so the profile and the query
+    # budget are finished here: after the last chunk, or when the response is closed
+    # without its body being read (HEAD, a client gone before the first chunk)
+    from profiler import defer_to_stream as defer_profile
+    from query_budget import defer_to_stream as defer_query_budget
+    finish_profile, finish_query_budget = defer_profile(), defer_query_budget()
+    session = g.get('report_session')
+
+    def finish(exc=None):
+        try:
+            finish_profile(exc)
+            finish_query_budget()
+        finally:
+            if session is not None:
+                session.close()
+
+    # Runs with the request context pushed; the teardown after it closes the report session
+    @stream_with_context
+    def chunks():
+        buffer, size, error = [], 0, None
+        try:
+            for part in parts:
+                buffer.append(part)
+                size += len(part)
+                if size >= STREAM_CHUNK_CHARS:
+                    yield ''.join(buffer)
+                    buffer, size = [], 0
+        except OperationalError as e:
+            # The status line is already sent, so a timeout cannot become a 503 here
+            if not _is_timeout(e):
+                raise
+            print('Reporting query timed out while streaming:', e)
+            error = e
+            buffer.append('<p>Report query timed out; try a narrower date range.</p>')
+        finally:
+            parts.close()
+            finish(error or sys.exc_info()[1])
+        yield ''.join(buffer)
+
+    response = Response(chunks(), mimetype='text/html')
+    response.call_on_close(finish)
+    return response
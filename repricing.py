@@ -0,0 +1,221 @@
+import json
+import os
+import sys
+import time
+import tempfile
+from datetime import datetime, timedelta
+
+from sqlalchemy import bindparam, exists, func, update
+
+from extensions import db
+
+PENDING_STATUS = 'Pending Payment'
+DEFAULT_CHUNK_SIZE = 500
+# Keep the report small even when thousands of orders change
+SAMPLE_LIMIT = 50
+
+
+def _completed_orders_by_user(session):
+    """One GROUP BY per tier instead of a lazy `user.orders` load per order (mirrors User.completed_orders_count)."""
+    from models import Order, ArchivedOrder, UNPAID_ORDER_STATUSES
+    counts = {}
+    # archived orders are all completed, so they keep counting towards the loyalty discount
+    for model in (Order, ArchivedOrder):
+        rows = session.query(model.user_id, func.count(model.id)).filter(
+            model.status.notin_(UNPAID_ORDER_STATUSES)
+        ).group_by(model.user_id).all()
+        for user_id, count in rows:
+            counts[user_id] = counts.get(user_id, 0) + count
+    return counts
+
+
+def _pending_orders_chunks(session, chunk_size):
+    """Yields pending orders in primary-key order, chunk_size rows at a time.
+
+    Only the columns needed for pricing are selected, and keyset pagination on id
+    keeps every chunk an index range scan however far into the table we are.
+    Orders with a payment session still open are skipped: the customer is paying
+    the amount they were shown.
+    """
+    from models import Order, Payment
+    in_flight = exists().where(Payment.order_id == Order.id, Payment.status == 'Pending')
+    last_id = 0
+    while True:
+        rows = session.query(
+            Order.id, Order.user_id, Order.items,
+            Order.subtotal, Order.vat, Order.discount, Order.total
+        ).filter(
+            Order.status == PENDING_STATUS,
+            Order.id > last_id,
+            ~in_flight
+        ).order_by(Order.id).limit(chunk_size).all()
+        if not rows:
+            return
+        last_id = rows[-1].id
+        yield rows
+
+
+def _update_statement():
+    from models import Order
+    # The status check is repeated in the UPDATE so an order confirmed while the
+    # job runs is never overwritten.
+    return update(Order.__table__).where(
+        Order.__table__.c.id == bindparam('b_id'),
+        Order.__table__.c.status == PENDING_STATUS
+    ).values(
+        items=bindparam('b_items'),
+        subtotal=bindparam('b_subtotal'),
+        vat=bindparam('b_vat'),
+        discount=bindparam('b_discount'),
+        total=bindparam('b_total'),
+        version=Order.__table__.c.version + 1,
+    )
+
+
+def reprice_pending_orders(session=None, chunk_size=DEFAULT_CHUNK_SIZE, dry_run=False):
+    """Re-runs Order.compute_totals_for_items for every pending order against the current catalog.
+
+    Changed orders are written with one executemany UPDATE per chunk and the
+    whole run is committed as a single transaction. Returns a summary dict.
+    """
+    from models import Order, invalidate_lookup_cache
+    session = session or db.session
+    started = time.perf_counter()
+
+    # One fresh catalog snapshot for the whole run, so every order sees the same prices
+    invalidate_lookup_cache()
+    lookup_cache = Order._get_lookup_cache()
+    completed = _completed_orders_by_user(session)
+    stmt = _update_statement()
+
+    report = {'scanned': 0, 'changed': 0, 'invalid': 0, 'dry_run': dry_run,
+              'total_delta': 0.0, 'changes': [], 'elapsed': 0.0}
+
+    try:
+        for rows in _pending_orders_chunks(session, chunk_size):
+            updates = []
+            for row in rows:
+                report['scanned'] += 1
+                try:
+                    items = json.loads(row.items or '[]')
+                except Exception:
+                    items = []
+                valid, errors, subtotal, vat, discount, total, items_out = Order.compute_totals_for_items(
+                    items, lookup_cache=lookup_cache, completed_orders=completed.get(row.user_id, 0))
+                if not valid:
+                    # An item left the menu; leave the order for a human to resolve
+                    report['invalid'] += 1
+                    continue
+                old = (row.subtotal or 0.0, row.vat or 0.0, row.discount or 0.0, row.total or 0.0)
+                if old == (subtotal, vat, discount, total):
+                    continue
+
+                report['changed'] += 1
+                report['total_delta'] += total - old[3]
+                if len(report['changes']) < SAMPLE_LIMIT:
+                    report['changes'].append({'order_id': row.id, 'old_total': old[3], 'new_total': total})
+                updates.append({'b_id': row.id, 'b_items': json.dumps(items_out), 'b_subtotal': subtotal,
+                                'b_vat': vat, 'b_discount': discount, 'b_total': total})
+
+            if updates and not dry_run:
+                session.execute(stmt, updates)
+
+        if dry_run:
+            session.rollback()
+        else:
+            session.commit()
+    except Exception:
+        session.rollback()
+        raise
+
+    report['total_delta'] = round(report['total_delta'], 2)
+    report['elapsed'] = time.perf_counter() - started
+    return report
+
+
+def _reprice_one_at_a_time(session, limit):
+    """The naive ORM approach, kept only as the benchmark baseline."""
+    from models import Order
+    for order in session.query(Order).filter(Order.status == PENDING_STATUS).limit(limit).all():
+        valid, errors, subtotal, vat, discount, total, items_out = Order.compute_totals_for_items(
+            order.get_items(), user=order.user)
+        if valid:
+            order.set_items(items_out)
+            order.subtotal, order.vat, order.discount, order.total = subtotal, vat, discount, total
+            session.commit()
+
+
+def benchmark(n_orders=20000, chunk_size=DEFAULT_CHUNK_SIZE, baseline_limit=1000):
+    """Seeds a throwaway database with n_orders pending orders and times both approaches.
+
+    The one-at-a-time baseline only processes baseline_limit orders; it is too
+    slow to run over the full set.
+    """
+    from app import create_app
+    from models import Order, Product, User
+    from reset_db import insert_initial_data
+    import sqlite3
+
+    workdir = tempfile.mkdtemp(prefix='reprice_bench_')
+    path = os.path.join(workdir, 'bench.db')
+    app = create_app({'SQLALCHEMY_DATABASE_URI': 'sqlite:///' + path, 'SWEEPER_ENABLED': False})
+    conn = sqlite3.connect(path)
+    insert_initial_data(conn)
+    conn.commit()
+    conn.close()
+
+    with app.app_context():
+        users = [User(username=f'bench{i}', email=f'bench{i}@example.com', password_hash='x') for i in range(200)]
+        db.session.add_all(users)
+        db.session.commit()
+        item = {'flavour': 'vanilla', 'thick': 'thick', 'topping': 'nuts'}
+        now = datetime.utcnow()
+        db.session.execute(Order.__table__.insert(), [
+            {'user_id': users[i % len(users)].id, 'created_at': now, 'pickup_time': now + timedelta(hours=1),
+             'location': 'Bench', 'items': json.dumps([item] * (1 + i % 3)), 'status': PENDING_STATUS,
+             'subtotal': 0.0, 'vat': 0.0, 'discount': 0.0, 'total': 0.0}
+            for i in range(n_orders)
+        ])
+        db.session.commit()
+
+        results = {}
+        counts = {'bulk': n_orders, 'orm': min(n_orders, baseline_limit)}
+        for label, price in (('bulk', 11.0), ('orm', 12.0)):
+            db.session.query(Product).filter(Product.type == 'Flavour', Product.name == 'Vanilla').update({'value': price})
+            db.session.commit()
+            started = time.perf_counter()
+            if label == 'bulk':
+                reprice_pending_orders(chunk_size=chunk_size)
+            else:
+                _reprice_one_at_a_time(db.session, counts['orm'])
+            results[label] = time.perf_counter() - started
+
+        dry = reprice_pending_orders(chunk_size=chunk_size, dry_run=True)
+
+    print(f"Repricing pending orders (chunk size {chunk_size}):")
+    for label, elapsed in results.items():
+        print(f"  {label:<5} {counts[label]:7d} orders {elapsed:8.2f} s  {counts[label] / elapsed:10.0f} orders/s")
+    print(f"  dry run scanned {dry['scanned']} orders in {dry['elapsed']:.2f} s, {dry['changed']} would change")
+    return results
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    if argv and argv[0] == '--benchmark':
+        benchmark(int(argv[1]) if len(argv) > 1 else 20000)
+        return 0
+
+    from app import create_app
+    app = create_app({'SWEEPER_ENABLED': False})
+    with app.app_context():
+        report = reprice_pending_orders(dry_run='--dry-run' in argv)
+    print(f"{'Dry run: ' if report['dry_run'] else ''}scanned {report['scanned']} pending orders, "
+          f"{report['changed']} changed (net R{report['total_delta']:.2f}), "
+          f"{report['invalid']} with items no longer on the menu, in {report['elapsed']:.2f} s")
+    for change in report['changes']:
+        print(f"  Order {change['order_id']}: R{change['old_total']:.2f} -> R{change['new_total']:.2f}")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -6,11 +6,20 @@ from datetime import datetime
 
 # --- Configuration ---
 DB_PATH = os.path.join(os.path.dirname(__file__), 'instance', 'milky_shaky.db')
+# Known-good state written by `python db_snapshot.py snapshot`. When present the
+# reset restores it page-for-page instead of deleting rows one table at a time.
+SNAPSHOT_PATH = os.path.join(os.path.dirname(__file__), 'instance', 'milky_shaky.snapshot.db')
 
 # Tables containing user-generated/transactional data to be cleared
+# (children before parents: payments before orders, archived rows before users)
 TABLES_TO_CLEAR = [
+    'product_sales',
+    'idempotency_keys',
+    'payments_archive',
     'payments',
+    'orders_archive',
     'orders',
+    'audit_log_entities',
     'audit_logs',
     'users', # WARNING: Uncomment this line to delete ALL user accounts.
     # 'products', # Only clear if you want to ensure a full refresh of lookup items
@@ -94,11 +103,26 @@ def insert_initial_data(conn):
     else:
         print("'config' table already contains data. Skipping insertion.")
 
+def restore_snapshot():
+    """Restores the database from SNAPSHOT_PATH via the SQLite backup API."""
+    from db_snapshot import restore
+    print("--- Restoring Snapshot ---")
+    restore(SNAPSHOT_PATH, DB_PATH)
+    print(f"Restored {DB_PATH} from {SNAPSHOT_PATH}")
+
 def main():
     if not os.path.exists(DB_PATH):
         print("Database not found at", DB_PATH)
         return
 
+    if os.path.exists(SNAPSHOT_PATH):
+        try:
+            restore_snapshot()
+            print("\nDatabase reset to snapshot. All users will need to log in again.")
+        except Exception as e:
+            print("FATAL ERROR during restore:", e)
+        return
+
     # Use isolation_level=None for autocommit, or manage transactions manually
     conn = sqlite3.connect(DB_PATH) 
     
@@ -110,6 +134,9 @@ def main():
         insert_initial_data(conn)
         
         conn.commit()
+
+        # Step 3: Return the freed pages to the OS so the file does not stay bloated
+        conn.execute("VACUUM")
         print("\nDatabase reset and lookup data confirmed. All users (if not cleared) will need to log in again.")
 
     except Exception as e:
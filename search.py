@@ -0,0 +1,198 @@
+import re
+import sys
+import time
+
+from sqlalchemy import text
+
+from extensions import db
+
+PAGE_SIZE = 20
+BACKFILL_CHUNK = 5000
+SCOPES = ('orders', 'customers', 'audit')
+
+# Text values of an order's items JSON ("vanilla thick nuts"), without keys or prices.
+# Malformed JSON indexes as no items: json_tree() would raise and fail the order write itself.
+_ITEMS_TEXT = ("(SELECT group_concat(j.value, ' ') FROM json_tree("
+               "CASE WHEN json_valid({items}) THEN {items} ELSE '[]' END) j WHERE j.type = 'text')")
+_CUSTOMER_TEXT = "(SELECT u.username || ' ' || u.email FROM users u WHERE u.id = {user_id})"
+
+# --- Schema ---
+# users_fts and audit_fts are external-content tables: the text stays in the base
+# table and the index only stores tokens. orders_fts keeps its own copy because it
+# mixes in the customer's name/email and flattened item names.
+DDL = [
+    "CREATE VIRTUAL TABLE IF NOT EXISTS users_fts USING fts5("
+    "username, email, content='users', content_rowid='id', tokenize='unicode61')",
+    "CREATE VIRTUAL TABLE IF NOT EXISTS audit_fts USING fts5("
+    "action, actor, details, content='audit_logs', content_rowid='id', tokenize='unicode61')",
+    "CREATE VIRTUAL TABLE IF NOT EXISTS orders_fts USING fts5("
+    "order_no, customer, location, status, items, tokenize='unicode61')",
+]
+
+# Sync triggers, by name. init_search drops and recreates them on every start,
+# so a changed definition reaches existing databases.
+TRIGGERS = [
+    # users (a rename also refreshes the customer text copied into orders_fts)
+    "CREATE TRIGGER users_fts_ai AFTER INSERT ON users BEGIN "
+    "INSERT INTO users_fts(rowid, username, email) VALUES (new.id, new.username, new.email); END",
+    "CREATE TRIGGER users_fts_ad AFTER DELETE ON users BEGIN "
+    "INSERT INTO users_fts(users_fts, rowid, username, email) VALUES ('delete', old.id, old.username, old.email); END",
+    "CREATE TRIGGER users_fts_au AFTER UPDATE OF username, email ON users BEGIN "
+    "INSERT INTO users_fts(users_fts, rowid, username, email) VALUES ('delete', old.id, old.username, old.email); "
+    "INSERT INTO users_fts(rowid, username, email) VALUES (new.id, new.username, new.email); "
+    "UPDATE orders_fts SET customer = " + _CUSTOMER_TEXT.format(user_id='new.id')
+    + " WHERE rowid IN (SELECT id FROM orders WHERE user_id = new.id); END",
+
+    # audit_logs
+    "CREATE TRIGGER audit_fts_ai AFTER INSERT ON audit_logs BEGIN "
+    "INSERT INTO audit_fts(rowid, action, actor, details) VALUES (new.id, new.action, new.actor, new.details); END",
+    "CREATE TRIGGER audit_fts_ad AFTER DELETE ON audit_logs BEGIN "
+    "INSERT INTO audit_fts(audit_fts, rowid, action, actor, details) "
+    "VALUES ('delete', old.id, old.action, old.actor, old.details); END",
+    "CREATE TRIGGER audit_fts_au AFTER UPDATE OF action, actor, details ON audit_logs BEGIN "
+    "INSERT INTO audit_fts(audit_fts, rowid, action, actor, details) "
+    "VALUES ('delete', old.id, old.action, old.actor, old.details); "
+    "INSERT INTO audit_fts(rowid, action, actor, details) VALUES (new.id, new.action, new.actor, new.details); END",
+
+    # orders (total/VAT-only updates do not touch the index)
+    "CREATE TRIGGER orders_fts_ai AFTER INSERT ON orders BEGIN "
+    "INSERT INTO orders_fts(rowid, order_no, customer, location, status, items) VALUES (new.id, new.id, "
+    + _CUSTOMER_TEXT.format(user_id='new.user_id') + ", new.location, new.status, "
+    + _ITEMS_TEXT.format(items='new.items') + "); END",
+    "CREATE TRIGGER orders_fts_ad AFTER DELETE ON orders BEGIN "
+    "DELETE FROM orders_fts WHERE rowid = old.id; END",
+    "CREATE TRIGGER orders_fts_au AFTER UPDATE OF user_id, location, status, items ON orders BEGIN "
+    "DELETE FROM orders_fts WHERE rowid = old.id; "
+    "INSERT INTO orders_fts(rowid, order_no, customer, location, status, items) VALUES (new.id, new.id, "
+    + _CUSTOMER_TEXT.format(user_id='new.user_id') + ", new.location, new.status, "
+    + _ITEMS_TEXT.format(items='new.items') + "); END",
+]
+
+_SEARCHES = {
+    'orders': (
+        "SELECT o.id, o.created_at, o.status, o.location, o.total, u.email AS customer, "
+        "snippet(orders_fts, -1, '[', ']', '…', 12) AS snippet "
+        "FROM orders_fts JOIN orders o ON o.id = orders_fts.rowid LEFT JOIN users u ON u.id = o.user_id "
+        "WHERE orders_fts MATCH :q ORDER BY bm25(orders_fts) LIMIT :limit OFFSET :offset"
+    ),
+    'customers': (
+        "SELECT u.id, u.username, u.email, u.role, u.created_at, "
+        "snippet(users_fts, -1, '[', ']', '…', 12) AS snippet "
+        "FROM users_fts JOIN users u ON u.id = users_fts.rowid "
+        "WHERE users_fts MATCH :q ORDER BY bm25(users_fts) LIMIT :limit OFFSET :offset"
+    ),
+    'audit': (
+        "SELECT a.id, a.created_at, a.action, a.actor, a.details, "
+        "snippet(audit_fts, -1, '[', ']', '…', 16) AS snippet "
+        "FROM audit_fts JOIN audit_logs a ON a.id = audit_fts.rowid "
+        "WHERE audit_fts MATCH :q ORDER BY bm25(audit_fts) LIMIT :limit OFFSET :offset"
+    ),
+}
+
+
+def fts_available(session=None):
+    session = session or db.session
+    try:
+        return session.execute(text("SELECT sqlite_compileoption_used('ENABLE_FTS5')")).scalar() == 1
+    except Exception:
+        return False
+
+
+def init_search(app):
+    """Creates the FTS5 tables and sync triggers; call once the base tables exist."""
+    with app.app_context():
+        if db.engine.dialect.name != 'sqlite' or not fts_available():
+            print('Admin search disabled: SQLite FTS5 is not available.')
+            app.config['SEARCH_ENABLED'] = False
+            return
+        try:
+            created = db.session.execute(text(
+                "SELECT count(*) FROM sqlite_master WHERE name = 'orders_fts'")).scalar() == 0
+            for stmt in DDL:
+                db.session.execute(text(stmt))
+            for stmt in TRIGGERS:
+                name = stmt.split()[2]
+                db.session.execute(text(f"DROP TRIGGER IF EXISTS {name}"))
+                db.session.execute(text(stmt))
+            db.session.commit()
+        except Exception as e:
+            db.session.rollback()
+            print('Admin search disabled: could not create FTS tables:', e)
+            app.config['SEARCH_ENABLED'] = False
+            return
+        app.config['SEARCH_ENABLED'] = True
+        if created:
+            # First start on an existing database: index the rows already there
+            backfill(db.session)
+
+
+def to_match_query(raw):
+    """Turns free text into a safe FTS5 query: every word must match, as a prefix.
+
+    Words are quoted, so characters like @ . - : or quotes in user input can
+    never be parsed as FTS5 syntax ("bob@x.com" becomes the phrase bob x com).
+    """
+    terms = [t for t in re.split(r'\s+', (raw or '').strip()) if t][:10]
+    return ' '.join('"' + t.replace('"', '""') + '"*' for t in terms)
+
+
+def search(session, scope, raw_query, page=1, page_size=PAGE_SIZE):
+    """Returns (rows, has_more) for one scope, best matches first."""
+    if scope not in _SEARCHES:
+        raise ValueError(f'unknown search scope: {scope}')
+    q = to_match_query(raw_query)
+    if not q:
+        return [], False
+    page = max(1, int(page))
+    # Fetch one extra row to know whether there is a next page without a COUNT(*)
+    rows = session.execute(text(_SEARCHES[scope]), {
+        'q': q, 'limit': page_size + 1, 'offset': (page - 1) * page_size}).mappings().all()
+    return [dict(r) for r in rows[:page_size]], len(rows) > page_size
+
+
+def _rebuild_orders(session, chunk=BACKFILL_CHUNK):
+    session.execute(text("DELETE FROM orders_fts"))
+    last_id = 0
+    while True:
+        max_id = session.execute(text(
+            "SELECT max(id) FROM (SELECT id FROM orders WHERE id > :last ORDER BY id LIMIT :n)"),
+            {'last': last_id, 'n': chunk}).scalar()
+        if max_id is None:
+            break
+        session.execute(text(
+            "INSERT INTO orders_fts(rowid, order_no, customer, location, status, items) "
+            "SELECT o.id, o.id, " + _CUSTOMER_TEXT.format(user_id='o.user_id') + ", o.location, o.status, "
+            + _ITEMS_TEXT.format(items='o.items') + " FROM orders o WHERE o.id > :last AND o.id <= :max"),
+            {'last': last_id, 'max': max_id})
+        session.commit()
+        last_id = max_id
+
+
+def backfill(session=None):
+    """(Re)builds all search indexes from the base tables."""
+    session = session or db.session
+    started = time.perf_counter()
+    session.execute(text("INSERT INTO users_fts(users_fts) VALUES ('rebuild')"))
+    session.execute(text("INSERT INTO audit_fts(audit_fts) VALUES ('rebuild')"))
+    session.commit()
+    _rebuild_orders(session)
+    for table in ('users_fts', 'audit_fts', 'orders_fts'):
+        session.execute(text(f"INSERT INTO {table}({table}) VALUES ('optimize')"))
+    session.commit()
+    print(f"Search indexes rebuilt in {time.perf_counter() - started:.2f} s")
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    if argv[:1] != ['backfill']:
+        print("usage: python search.py backfill")
+        return 1
+    from app import create_app
+    app = create_app({'SWEEPER_ENABLED': False})
+    with app.app_context():
+        backfill(db.session)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
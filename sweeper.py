@@ -0,0 +1,141 @@
+import json
+import sys
+import threading
+import time
+from datetime import datetime, timedelta
+
+from sqlalchemy import update
+
+from extensions import db
+
+# --- Sweeper Defaults (override through app.config) ---
+SWEEPER_DEFAULTS = {
+    'SWEEPER_ENABLED': True,
+    'SWEEPER_INTERVAL_SECONDS': 300,
+    'PAYMENT_SESSION_TTL_MINUTES': 30,     # unanswered gateway sessions
+    'PENDING_ORDER_TTL_MINUTES': 24 * 60,  # unpaid orders release their pickup slot
+    'SWEEPER_CHUNK_SIZE': 500,
+}
+# Short pause between chunks so request writers get the lock in between
+CHUNK_PAUSE_SECONDS = 0.05
+
+
+def _expire_in_chunks(session, model, pending_status, cutoff, chunk_size, audit_action, id_key, order_id_column):
+    """Moves rows still in pending_status and older than cutoff to 'Expired'.
+
+    Each chunk is one short transaction: an indexed (status, created_at) lookup
+    of up to chunk_size ids, one UPDATE ... WHERE id IN (...) RETURNING that
+    re-checks the status, and a single audit entry for the whole batch, linked
+    to the order of every expired row.
+    """
+    from models import AuditLog
+    table = model.__table__
+    expired = 0
+    while True:
+        ids = [row.id for row in session.query(model.id).filter(
+            model.status == pending_status, model.created_at < cutoff
+        ).order_by(model.created_at).limit(chunk_size)]
+        if not ids:
+            break
+        order_ids = session.execute(update(table).where(
+            table.c.id.in_(ids), table.c.status == pending_status
+        ).values(status='Expired', version=table.c.version + 1).returning(table.c[order_id_column])).scalars().all()
+        audit = AuditLog(action=audit_action, actor='system', details=json.dumps({
+            'count': len(order_ids), id_key: ids, 'cutoff': cutoff.isoformat()}))
+        session.add(audit)
+        audit.link(session, 'order', order_ids)
+        session.commit()
+        expired += len(order_ids)
+        if len(ids) < chunk_size:
+            break
+        time.sleep(CHUNK_PAUSE_SECONDS)
+    return expired
+
+
+def sweep(session=None, now=None, payment_ttl=None, order_ttl=None, chunk_size=None):
+    """Expires stale Pending payments, then stale 'Pending Payment' orders, then purges
+    expired idempotency keys. Returns the counts."""
+    from flask import current_app
+    from models import Order, Payment
+    session = session or db.session
+    config = current_app.config
+    now = now or datetime.utcnow()
+    payment_ttl = payment_ttl if payment_ttl is not None else config.get('PAYMENT_SESSION_TTL_MINUTES', 30)
+    order_ttl = order_ttl if order_ttl is not None else config.get('PENDING_ORDER_TTL_MINUTES', 24 * 60)
+    chunk_size = chunk_size or config.get('SWEEPER_CHUNK_SIZE', 500)
+
+    try:
+        payments = _expire_in_chunks(session, Payment, 'Pending', now - timedelta(minutes=payment_ttl),
+                                     chunk_size, 'Payments Expired', 'payment_ids', 'order_id')
+        orders = _expire_in_chunks(session, Order, 'Pending Payment', now - timedelta(minutes=order_ttl),
+                                   chunk_size, 'Orders Expired', 'order_ids', 'id')
+        from idempotency import purge_expired
+        keys = purge_expired(session, now, chunk_size)
+    except Exception:
+        session.rollback()
+        raise
+
+    if orders and 'live_kpis' in current_app.extensions:
+        current_app.extensions['live_kpis'].record_order_left_pending(orders)
+    return {'payments_expired': payments, 'orders_expired': orders, 'idempotency_keys_purged': keys}
+
+
+class Sweeper:
+    """Runs sweep() every SWEEPER_INTERVAL_SECONDS on a daemon thread.
+
+    Every worker process may run one; the status re-check in each UPDATE makes
+    overlapping sweeps harmless.
+    """
+
+    def __init__(self, app):
+        self.app = app
+        self.interval = app.config['SWEEPER_INTERVAL_SECONDS']
+        self._stop = threading.Event()
+        self._thread = None
+        self.last_run = None
+        self.last_result = None
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='payment-sweeper', daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def _run(self):
+        # Wait one interval first so start-up is not slowed down
+        while not self._stop.wait(self.interval):
+            with self.app.app_context():
+                try:
+                    self.last_result = sweep()
+                    self.last_run = datetime.utcnow()
+                    if any(self.last_result.values()):
+                        print('Sweeper:', self.last_result)
+                except Exception as e:
+                    print('Sweeper error:', e)
+                finally:
+                    db.session.remove()
+
+
+def init_sweeper(app):
+    for key, value in SWEEPER_DEFAULTS.items():
+        app.config.setdefault(key, value)
+    if not app.config['SWEEPER_ENABLED'] or app.config.get('TESTING'):
+        return None
+    sweeper = Sweeper(app)
+    app.extensions['sweeper'] = sweeper
+    sweeper.start()
+    return sweeper
+
+
+def main():
+    from app import create_app
+    app = create_app({'SWEEPER_ENABLED': False})
+    with app.app_context():
+        print(sweep())
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
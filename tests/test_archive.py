@@ -0,0 +1,77 @@
+"""Archive tiering: completed orders move to orders_archive and still count everywhere they did."""
+import pytest
+from sqlalchemy import text
+
+PAID = 4
+
+
+@pytest.fixture
+def archived(app, customer, place_order, pay):
+    """PAID confirmed orders archived; one pending order with an open session and one without stay hot."""
+    from extensions import db
+    from archive import archive_orders
+    for _ in range(PAID + 2):
+        assert place_order(customer).status_code == 302
+    for order_id in range(1, PAID + 1):
+        pay(customer, order_id)
+    # the newest payment belongs to a hot order, so the archived ids can never be reused
+    pay(customer, PAID + 1, status=None)
+    with app.app_context():
+        db.session.execute(text("UPDATE orders SET created_at = '2020-01-01 10:00:00.000000' WHERE id <= :n"),
+                           {'n': PAID})
+        db.session.commit()
+        assert archive_orders(db.session) == {'orders': PAID, 'payments': PAID}
+    return list(range(1, PAID + 1))
+
+
+def test_archived_orders_stay_visible_to_the_customer(app, customer, archived):
+    from extensions import db
+    from models import ArchivedOrder, Order
+    with app.app_context():
+        assert db.session.query(Order.id).order_by(Order.id).all() == [(PAID + 1,), (PAID + 2,)]
+        assert db.session.query(ArchivedOrder).count() == PAID
+    assert customer.get(f'/orders/{archived[0]}').status_code == 200
+    assert customer.get(f'/orders/{archived[0]}/receipt').status_code == 200
+    page = customer.get('/orders').get_data(as_text=True)
+    assert all(f'/orders/{order_id}' in page for order_id in archived)
+
+
+def test_archived_orders_keep_the_loyalty_discount(app, customer, archived, place_order):
+    from extensions import db
+    from models import Order, User
+    with app.app_context():
+        user = db.session.query(User).filter_by(email='customer@example.com').one()
+        assert user.completed_orders_count() == PAID
+    assert place_order(customer).status_code == 302
+    with app.app_context():
+        assert db.session.query(Order.discount).order_by(Order.id.desc()).limit(1).scalar() > 0
+
+
+def test_repricing_counts_archived_orders(app, customer, archived, place_order):
+    from extensions import db
+    from models import Order
+    from repricing import reprice_pending_orders
+    # placed after the archiving, so it already has the loyalty discount
+    assert place_order(customer).status_code == 302
+    with app.app_context():
+        new_id, total = db.session.query(Order.id, Order.total).order_by(Order.id.desc()).first()
+        report = reprice_pending_orders(db.session, dry_run=True)
+    changed = {c['order_id']: c['new_total'] for c in report['changes']}
+    # the catalog did not change: the new order keeps its total, and the one placed
+    # before any order was paid gains the discount it has earned since
+    assert new_id not in changed
+    assert changed == {PAID + 2: total}
+
+
+def test_best_seller_rebuild_keeps_archived_sales(app, archived):
+    from extensions import db
+    from popularity import COMBO, rebuild, rankings
+    with app.app_context():
+        before = rankings(db.session)[COMBO]
+        assert rebuild(db.session) == PAID
+        assert rankings(db.session)[COMBO] == before == [('vanilla|thick|nuts', PAID)]
+
+
+def test_timeline_lists_the_archiving(app, manager, archived):
+    page = manager.get(f'/admin/orders/{archived[0]}/timeline').get_data(as_text=True)
+    assert 'Payment Received' in page and 'Orders Archived' in page
@@ -0,0 +1,79 @@
+"""Idempotency keys: a retried order or Pay Now replays its first result instead of writing again."""
+import json
+from datetime import datetime, timedelta
+
+import pytest
+
+KEY = 'retry-0123456789'
+
+
+@pytest.fixture
+def order_ids(app, customer, place_order):
+    from extensions import db
+    from models import Order
+    for _ in range(2):
+        assert place_order(customer).status_code == 302
+    with app.app_context():
+        return [oid for (oid,) in db.session.query(Order.id).order_by(Order.id)]
+
+
+def _payments(app, order_id):
+    from extensions import db
+    from models import Payment
+    with app.app_context():
+        return [(p.provider_ref, p.status) for p in
+                db.session.query(Payment).filter_by(order_id=order_id).order_by(Payment.id)]
+
+
+def _pay_now(client, order_id, key=KEY):
+    return client.post(f'/orders/{order_id}/pay/submit', data={'submit': 'y', 'idempotency_key': key})
+
+
+def test_order_retry_creates_one_order(app, customer):
+    from extensions import db
+    from models import Order
+    pickup = (datetime.utcnow() + timedelta(hours=1)).strftime('%Y-%m-%dT%H:%M')
+    data = {'number_of_milkshakes': 1, 'pickup_time': pickup, 'location': 'Main St', 'idempotency_key': KEY,
+            'order_data': json.dumps([{'flavour': 'vanilla', 'thick': 'thick', 'topping': 'nuts'}])}
+    for _ in range(2):
+        assert customer.post('/order', data=data).status_code == 302
+    with app.app_context():
+        assert db.session.query(Order).count() == 1
+
+
+def test_pay_now_retry_replays_the_open_session(app, customer, order_ids):
+    first = _pay_now(customer, order_ids[0])
+    second = _pay_now(customer, order_ids[0])
+    assert first.status_code == second.status_code == 200
+    payments = _payments(app, order_ids[0])
+    assert len(payments) == 1
+    assert payments[0][0].encode() in second.data
+
+
+def test_pay_now_key_is_scoped_to_the_order(app, customer, order_ids):
+    # the same key on another order must not show the first order's payment
+    _pay_now(customer, order_ids[0])
+    response = _pay_now(customer, order_ids[1])
+    assert response.status_code == 200
+    [(ref, status)] = _payments(app, order_ids[1])
+    assert ref.encode() in response.data
+    assert _payments(app, order_ids[0])[0][0].encode() not in response.data
+
+
+def test_pay_now_after_a_failed_session_opens_a_new_one(app, customer, order_ids):
+    _pay_now(customer, order_ids[0])
+    ref = _payments(app, order_ids[0])[0][0]
+    assert app.test_client().post('/payments/webhook', json={'provider_ref': ref, 'status': 'Failed'}).status_code == 200
+    response = _pay_now(customer, order_ids[0])
+    assert response.status_code == 200
+    payments = _payments(app, order_ids[0])
+    assert [status for _, status in payments] == ['Failed', 'Pending']
+    assert payments[1][0].encode() in response.data
+
+
+def test_pay_now_on_a_paid_order_redirects(app, customer, order_ids, pay):
+    pay(customer, order_ids[0], idempotency_key=KEY)
+    response = _pay_now(customer, order_ids[0])
+    assert response.status_code == 302
+    assert response.headers['Location'].endswith(f'/orders/{order_ids[0]}')
+    assert len(_payments(app, order_ids[0])) == 1
@@ -0,0 +1,89 @@
+"""Payment webhooks: compare-and-set writes, retries after a lost race, duplicates and stale events."""
+import pytest
+
+import payment_events
+
+
+@pytest.fixture
+def order_id(app, customer, place_order):
+    from extensions import db
+    from models import Order
+    assert place_order(customer, 2).status_code == 302
+    with app.app_context():
+        return db.session.query(Order.id).order_by(Order.id.desc()).limit(1).scalar()
+
+
+def _webhook(app, ref, status):
+    return app.test_client().post('/payments/webhook', json={'provider_ref': ref, 'status': status})
+
+
+def _state(app, order_id):
+    from extensions import db
+    from models import AuditLog, Order, Payment, ProductSale
+    from popularity import COMBO
+    from sqlalchemy import func
+    with app.app_context():
+        order = db.session.get(Order, order_id)
+        payments = [p.status for p in db.session.query(Payment).filter_by(order_id=order_id).order_by(Payment.id)]
+        received = db.session.query(AuditLog).filter_by(action='Payment Received', entity_id=order_id).count()
+        sold = db.session.query(func.coalesce(func.sum(ProductSale.quantity), 0)).filter(ProductSale.kind == COMBO).scalar()
+        return order.status, order.version, payments, received, sold
+
+
+def test_compare_and_set_rejects_a_stale_version(app, customer, pay, order_id):
+    from extensions import db
+    from models import Payment
+    ref = pay(customer, order_id, status=None)
+    with app.app_context():
+        payment = db.session.query(Payment).filter_by(provider_ref=ref).one()
+        with pytest.raises(payment_events.Conflict):
+            payment_events.compare_and_set(db.session, Payment, payment.id, payment.version + 1, status='Success')
+        db.session.rollback()
+        assert db.session.get(Payment, payment.id).status == 'Pending'
+
+
+def test_lost_race_is_retried(app, customer, pay, order_id, monkeypatch):
+    ref = pay(customer, order_id, status=None)
+    real, calls = payment_events.compare_and_set, []
+
+    def lose_first_race(session, model, row_id, version, **values):
+        calls.append(model.__tablename__)
+        if len(calls) == 1:
+            raise payment_events.Conflict('another webhook wrote first')
+        return real(session, model, row_id, version, **values)
+
+    monkeypatch.setattr(payment_events, 'compare_and_set', lose_first_race)
+    response = _webhook(app, ref, 'Success')
+    assert response.status_code == 200
+    assert response.headers['X-Webhook-Attempts'] == '2'
+    assert response.headers['X-Webhook-Outcome'] == 'applied'
+    # confirmed once: one audit and the drinks counted once, despite the retry
+    assert _state(app, order_id) == ('Confirmed', 2, ['Success'], 1, 2)
+
+
+def test_every_race_lost_asks_for_redelivery(app, customer, pay, order_id, monkeypatch):
+    ref = pay(customer, order_id, status=None)
+
+    def always_lose(*args, **kwargs):
+        raise payment_events.Conflict('another webhook wrote first')
+
+    monkeypatch.setattr(payment_events, 'compare_and_set', always_lose)
+    monkeypatch.setattr(payment_events, 'BACKOFF_SECONDS', 0)
+    response = _webhook(app, ref, 'Success')
+    assert response.status_code == 503
+    assert 'Retry-After' in response.headers
+    assert _state(app, order_id) == ('Pending Payment', 1, ['Pending'], 0, 0)
+
+
+def test_duplicates_and_late_failures_change_nothing(app, customer, pay, order_id):
+    ref = pay(customer, order_id)
+    assert _webhook(app, ref, 'Success').headers['X-Webhook-Outcome'] == 'duplicate'
+    assert _webhook(app, ref, 'Failed').headers['X-Webhook-Outcome'] == 'stale'
+    assert _state(app, order_id) == ('Confirmed', 2, ['Success'], 1, 2)
+
+
+def test_success_after_a_failed_attempt_confirms(app, customer, pay, order_id):
+    ref = pay(customer, order_id, status='Failed')
+    assert _state(app, order_id)[0] == 'Pending Payment'
+    assert _webhook(app, ref, 'Success').headers['X-Webhook-Outcome'] == 'applied'
+    assert _state(app, order_id) == ('Confirmed', 2, ['Success'], 1, 2)
@@ -0,0 +1,71 @@
+"""Per-route query budgets (QUERY_BUDGETS): a new N+1 on these pages fails the build."""
+import pytest
+
+from query_budget import QueryBudgetExceeded
+
+# Enough rows that a per-row query would blow the budget
+ORDERS = 8
+PAID = 5
+
+
+@pytest.fixture
+def history(app, customer, place_order):
+    from extensions import db
+    from models import Order, Payment
+    for n in range(ORDERS):
+        assert place_order(customer, 1 + n % 3).status_code == 302
+    with app.app_context():
+        order_ids = [oid for (oid,) in db.session.query(Order.id).order_by(Order.id).limit(PAID)]
+    for order_id in order_ids:
+        assert customer.post(f'/orders/{order_id}/pay/submit', data={'submit': 'y'}).status_code == 200
+        with app.app_context():
+            ref = db.session.query(Payment.provider_ref).filter_by(order_id=order_id).scalar()
+        assert app.test_client().post('/payments/webhook', json={'provider_ref': ref, 'status': 'Success'}).status_code == 200
+
+
+def _within_budget(app, query_budget, endpoint, request):
+    config = app.config
+    with query_budget(config['QUERY_BUDGETS'][endpoint], config['QUERY_REPEAT_THRESHOLD']) as recorder:
+        response = request()
+        # streamed pages run their table queries while the body is read
+        response.get_data()
+    assert response.status_code in (200, 302), response.status_code
+    return recorder
+
+
+def test_order_history(app, customer, history, query_budget):
+    _within_budget(app, query_budget, 'orders', lambda: customer.get('/orders'))
+
+
+def test_order_form(app, customer, history, query_budget):
+    _within_budget(app, query_budget, 'order', lambda: customer.get('/order'))
+
+
+def test_order_submit(app, customer, history, query_budget, place_order):
+    recorder = _within_budget(app, query_budget, 'order', lambda: place_order(customer, 5))
+    assert recorder.count > 0
+
+
+def test_admin_dashboard(app, manager, history, query_budget):
+    _within_budget(app, query_budget, 'admin_dashboard', lambda: manager.get('/admin'))
+
+
+def test_admin_reports(app, manager, history, query_budget):
+    _within_budget(app, query_budget, 'admin_reports', lambda: manager.get('/admin/reports'))
+
+
+def test_budget_is_enforced_per_request(app, customer, history):
+    # Under TESTING the budget check raises inside the request, so an N+1 cannot pass silently
+    app.config['QUERY_BUDGETS'] = {**app.config['QUERY_BUDGETS'], 'orders': 1}
+    with pytest.raises(QueryBudgetExceeded):
+        customer.get('/orders')
+
+
+def test_repeated_statement_fails(app, query_budget):
+    from sqlalchemy import text
+    from extensions import db
+    with app.app_context():
+        with pytest.raises(QueryBudgetExceeded):
+            with query_budget(100, repeat_threshold=3):
+                for n in range(3):
+                    db.session.execute(text('SELECT :n'), {'n': n})
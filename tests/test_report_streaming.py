@@ -0,0 +1,50 @@
+"""Streamed /admin/reports: the profiler and query budget end with the body, read or not."""
+import pytest
+
+from query_budget import QueryBudgetExceeded, _active
+
+
+@pytest.fixture
+def app_config(tmp_path):
+    return {'PROFILER_ENABLED': True, 'PROFILER_SAMPLE_RATE': 1.0, 'PROFILER_DIR': str(tmp_path / 'profiles')}
+
+
+def _profiler_idle(app):
+    busy = app.extensions['profiler']._busy
+    if not busy.acquire(blocking=False):
+        return False
+    busy.release()
+    return True
+
+
+def test_streamed_report_is_profiled_to_the_end(app, manager, query_budget):
+    with query_budget(app.config['QUERY_BUDGETS']['admin_reports']) as recorder:
+        response = manager.get('/admin/reports')
+        response.get_data()
+    response.close()
+    assert response.status_code == 200
+    assert _profiler_idle(app)
+    assert _active.get() == ()
+    captures = [c for c in app.extensions['profiler'].captures() if c['endpoint'] == 'admin_reports']
+    assert captures and captures[0]['streamed']
+    # the capture saw every query the page ran, table queries included
+    assert captures[0]['sql']['count'] == recorder.count
+
+
+def test_head_request_releases_the_profiler_and_recorders(app, manager):
+    # Werkzeug sends no body for HEAD, so the streamed generator never runs
+    response = manager.head('/admin/reports')
+    response.close()
+    assert response.status_code == 200
+    assert _profiler_idle(app)
+    assert _active.get() == ()
+    # the next request is profiled again
+    manager.get('/admin/reports').get_data()
+    assert len([c for c in app.extensions['profiler'].captures() if c['endpoint'] == 'admin_reports']) == 2
+
+
+def test_streamed_report_budget_is_enforced(app, manager):
+    app.config['QUERY_BUDGETS'] = {**app.config['QUERY_BUDGETS'], 'admin_reports': 1}
+    response = manager.get('/admin/reports')
+    with pytest.raises(QueryBudgetExceeded):
+        response.get_data()
@@ -0,0 +1,59 @@
+"""Repricing pending orders after a catalog change (/admin/reprice and repricing.py)."""
+import pytest
+from sqlalchemy import text
+
+
+@pytest.fixture
+def orders(app, customer, place_order, pay):
+    """Order 1 pending, order 2 pending with an open payment session, order 3 confirmed."""
+    for _ in range(3):
+        assert place_order(customer).status_code == 302
+    pay(customer, 2, status=None)
+    pay(customer, 3)
+    return [1, 2, 3]
+
+
+def _totals(app):
+    from extensions import db
+    from models import Order
+    with app.app_context():
+        return dict(db.session.query(Order.id, Order.total).order_by(Order.id).all())
+
+
+def _raise_vanilla(app, value):
+    from extensions import db
+    with app.app_context():
+        db.session.execute(text("UPDATE products SET value = :v WHERE type = 'Flavour' AND lower(name) = 'vanilla'"), {'v': value})
+        db.session.commit()
+
+
+def test_dry_run_changes_nothing(app, manager, orders):
+    before = _totals(app)
+    _raise_vanilla(app, 20.0)
+    response = manager.post('/admin/reprice', data={'dry_run': 'y'})
+    assert response.status_code == 302
+    assert _totals(app) == before
+
+
+def test_reprice_updates_only_pending_orders_without_a_session(app, manager, orders):
+    from extensions import db
+    from models import AuditLog
+    before = _totals(app)
+    _raise_vanilla(app, 20.0)
+    assert manager.post('/admin/reprice', data={'submit': 'y'}).status_code == 302
+    after = _totals(app)
+    # 10 more before VAT (15%)
+    assert after[1] == pytest.approx(before[1] + 11.5)
+    # an open payment session and a confirmed order keep the amount the customer saw
+    assert after[2] == before[2] and after[3] == before[3]
+    with app.app_context():
+        assert db.session.query(AuditLog).filter_by(action='Orders Repriced').count() == 1
+
+
+def test_reprice_is_idempotent(app, orders):
+    from extensions import db
+    from repricing import reprice_pending_orders
+    _raise_vanilla(app, 20.0)
+    with app.app_context():
+        assert reprice_pending_orders(db.session)['changed'] == 1
+        assert reprice_pending_orders(db.session)['changed'] == 0